@@ -0,0 +1,49 @@
+"""Add materialized path to resource tree
+
+Adds column ``mpath`` with its index, and the triggers that maintain it, then
+computes it for all existing nodes.
+
+Databases set up from scratch by ``pym.res.setup`` already have all of this;
+stamp them with this revision instead.
+
+Revision ID: 3a1f0c9d7b21
+Revises: None
+Create Date: 2026-10-18 10:12:40.318406
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a1f0c9d7b21'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from pym.res.setup import (SQL_FUNC_RESOURCE_TREE_MPATH,
+    SQL_FUNC_RESOURCE_TREE_MPATH_MOVE, SQL_TRIGGERS_RESOURCE_TREE_MPATH,
+    SQL_REBUILD_RESOURCE_TREE_MPATH)
+
+
+def upgrade():
+    op.add_column('resource_tree',
+        sa.Column('mpath', postgresql.ARRAY(sa.Integer()), nullable=True),
+        schema='pym')
+    op.create_index('resource_tree_mpath_ix', 'resource_tree', ['mpath'],
+        schema='pym', postgresql_using='gin')
+    op.execute(SQL_FUNC_RESOURCE_TREE_MPATH)
+    op.execute(SQL_FUNC_RESOURCE_TREE_MPATH_MOVE)
+    for sql in SQL_TRIGGERS_RESOURCE_TREE_MPATH:
+        op.execute(sql)
+    op.execute(SQL_REBUILD_RESOURCE_TREE_MPATH)
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS resource_tree_mpath_move_trg"
+        " ON pym.resource_tree")
+    op.execute("DROP TRIGGER IF EXISTS resource_tree_mpath_trg"
+        " ON pym.resource_tree")
+    op.execute("DROP FUNCTION IF EXISTS pym.resource_tree_mpath_move()")
+    op.execute("DROP FUNCTION IF EXISTS pym.resource_tree_mpath()")
+    op.drop_index('resource_tree_mpath_ix', 'resource_tree', schema='pym')
+    op.drop_column('resource_tree', 'mpath', schema='pym')
@@ -0,0 +1,30 @@
+"""Add index for ordered children of a resource node
+
+Relationship ``ResourceNode.children`` and the children queries order by
+``coalesce(sortix, DEFAULT_SORTIX)`` and name. This index serves them without
+sorting.
+
+Revision ID: 7c4e2b8f1a06
+Revises: 3a1f0c9d7b21
+Create Date: 2026-10-18 10:31:07.652210
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c4e2b8f1a06'
+down_revision = '3a1f0c9d7b21'
+
+from alembic import op
+import sqlalchemy as sa
+
+from pym.res.models import DEFAULT_SORTIX
+
+
+def upgrade():
+    op.execute("CREATE INDEX resource_tree_children_ix ON pym.resource_tree"
+        " (parent_id, coalesce(sortix, {}), name, id)".format(
+            int(DEFAULT_SORTIX)))
+
+
+def downgrade():
+    op.drop_index('resource_tree_children_ix', 'resource_tree', schema='pym')
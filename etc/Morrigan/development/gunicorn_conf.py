@@ -1,2 +1,4 @@
 workers = 4
 bind = '127.0.0.1:7099'
+# Warms up the cache if rc setting cache.warmup.on_start is true
+from pym.warmup import post_worker_init
@@ -9,12 +9,16 @@ from pyramid.threadlocal import get_current_request
 from pyramid.i18n import get_localizer, TranslationStringFactory
 import deform
 from pyramid_mailer import Mailer
+import pym.cache
 import pym.duh_view
 import pym.i18n
 import pym.models
 import pym.res
+import pym.security
 import pym.res.models
+import pym.res.traversal
 import pym.auth.manager
+import pym.auth.throttle
 import pym.lib
 
 from .rc import Rc
@@ -73,6 +77,8 @@ def includeme(config):
 
     # Init resource root
     config.set_root_factory(res.models.root_factory)
+    config.add_traverser(res.traversal.ResourceNodeTraverser,
+        res.models.ResourceNode)
 
     # Init session
     session_factory = session_factory_from_settings(config.registry.settings)
@@ -85,7 +91,12 @@ def includeme(config):
     auth_pol = SessionAuthenticationPolicy(
         callback=group_finder
     )
-    authz_pol = ACLAuthorizationPolicy()
+    rc = config.registry.settings['rc']
+    if rc.g('auth.authz_policy', 'acl').lower() == 'bitmask':
+        from .auth.authorization import BitmaskAuthorizationPolicy
+        authz_pol = BitmaskAuthorizationPolicy()
+    else:
+        authz_pol = ACLAuthorizationPolicy()
     config.add_request_method(get_current_user, 'user', reify=True)
     config.set_authentication_policy(auth_pol)
     config.set_authorization_policy(authz_pol)
@@ -122,10 +133,22 @@ def includeme(config):
 
     # View predicates from pyramid_duh
     config.include(duh_view)
-    # Redis
-    config.include('pyramid_redis')
+    # Redis: Clients share the connection pool of the cache regions. None if
+    # Redis is not configured.
+    config.add_request_method(lambda request: pym.cache.get_redis_client(),
+        'redis', reify=True)
 
 
 def init_auth(rc):
     pym.auth.manager.PASSWORD_SCHEME = rc.g('auth.password_scheme',
         pym.auth.manager.PASSWORD_SCHEME).lower()
+    pym.security.configure_pwd_context(pym.auth.manager.PASSWORD_SCHEME,
+        rounds=rc.g('auth.password_rounds', 0),
+        keep_schemes=rc.g('auth.password_keep_schemes',
+            pym.security.KEEP_SCHEMES))
+    pym.auth.throttle.configure(rc)
+    pym.security.pwd_verifier.configure(
+        max_workers=rc.g('auth.pwd_verifier.max_workers', 2),
+        max_pending=rc.g('auth.pwd_verifier.max_pending', 20),
+        timeout=rc.g('auth.pwd_verifier.timeout', 10)
+    )
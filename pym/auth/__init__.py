@@ -25,9 +25,6 @@ def group_finder(userid, request):
         return []
     # Insert current user
     gg = ['u:' + str(usr.uid)]
-    # That's all if she is not member of any group.
-    if not usr.groups:
-        return gg
-    # Append groups
-    gg += ['g:' + str(g[0]) for g in usr.groups]
+    # Append groups, nested ones are already resolved
+    gg += ['g:' + str(gid) for gid in usr.group_ids]
     return gg
\ No newline at end of file
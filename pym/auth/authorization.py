@@ -0,0 +1,154 @@
+import threading
+
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.location import lineage
+from pyramid.security import Allow, ALL_PERMISSIONS, ACLAllowed, ACLDenied
+import sqlalchemy as sa
+
+from pym.cache import LruCache
+from pym.models import DbSession
+from pym.res.models import ResourceNode
+from .models import Permission, acl_version
+
+
+ALL_BITS = -1
+"""Mask of :data:`pyramid.security.ALL_PERMISSIONS`."""
+
+
+class BitmaskAuthorizationPolicy(ACLAuthorizationPolicy):
+    """
+    ACL authorization policy that evaluates permissions as bitsets.
+
+    Each permission of the permission tree gets a bit. The compiled ACL of a
+    resource node, which already contains the implied parent and child
+    permissions, is converted once into a list of ``(allow, principal, mask)``
+    and cached per node and ACL version. For a set of principals we further
+    cache per node the masks of permissions that are decided as allowed or
+    denied.
+
+    A check then walks the lineage and stops at the first node which decided
+    the permission's bit. This gives the same first-match-wins semantics as
+    :class:`~pyramid.authorization.ACLAuthorizationPolicy`, because a bit is
+    decided by the first matching ACE in the ACL's order, i.e. ``sortix``.
+
+    Permissions that are not in the permission tree get their own bit when
+    they are first seen, in an ACL or in a check. So, as with the ACL policy,
+    only an ACE that names such a permission, or ``ALL_PERMISSIONS``, decides
+    it.
+
+    If the lineage contains anything else than persistent resource nodes, we
+    fall back to the ACL policy.
+    """
+
+    def __init__(self, max_entries=10000):
+        super().__init__()
+        self._bits = (None, {})
+        self._bits_lock = threading.Lock()
+        self._node_masks = LruCache(max_entries)
+        self._decided = LruCache(max_entries)
+
+    def permits(self, context, principals, permission):
+        nodes = list(lineage(context))
+        if not all(isinstance(n, ResourceNode) and n.id is not None
+                for n in nodes):
+            return super().permits(context, principals, permission)
+        version = acl_version.get()
+        bits = self._get_bits(context, version)
+        bit = self._get_bit(bits, permission)
+        principals = frozenset(principals)
+        for node in nodes:
+            allowed, denied = self._get_decided(node, version, bits,
+                principals)
+            if allowed & bit:
+                return ACLAllowed(self._find_ace(node, principals, permission),
+                    node.__acl__(), permission, principals, node)
+            if denied & bit:
+                return ACLDenied(self._find_ace(node, principals, permission),
+                    node.__acl__(), permission, principals, node)
+        return ACLDenied('<default deny>', context.__acl__(), permission,
+            principals, context)
+
+    def _get_bits(self, context, version):
+        """
+        Returns dict that maps permission names to their bit.
+        """
+        bits_version, bits = self._bits
+        if bits_version == version:
+            return bits
+        with self._bits_lock:
+            bits_version, bits = self._bits
+            if bits_version == version:
+                return bits
+            sess = sa.inspect(context).session
+            if not sess:
+                sess = DbSession()
+            perms = Permission.load_all(sess)
+            names = sorted(k for k in perms.keys() if isinstance(k, str))
+            bits = {name: 1 << i for i, name in enumerate(names)}
+            self._bits = (version, bits)
+            return bits
+
+    def _get_bit(self, bits, name):
+        """
+        Returns the bit of a permission name, adding one for unknown names.
+        """
+        try:
+            return bits[name]
+        except KeyError:
+            with self._bits_lock:
+                return bits.setdefault(name, 1 << len(bits))
+
+    def _get_node_masks(self, node, version, bits):
+        """
+        Returns the node's ACL as tuple of ``(allow, principal, mask)``.
+        """
+        key = (node.id, version)
+        masks = self._node_masks.get(key)
+        if masks is None:
+            masks = []
+            for action, principal, perms in node.__acl__():
+                if perms is ALL_PERMISSIONS:
+                    mask = ALL_BITS
+                elif isinstance(perms, str):
+                    mask = self._get_bit(bits, perms)
+                else:
+                    mask = 0
+                    for p in perms:
+                        mask |= self._get_bit(bits, p)
+                masks.append((action == Allow, principal, mask))
+            masks = tuple(masks)
+            self._node_masks.set(key, masks)
+        return masks
+
+    def _get_decided(self, node, version, bits, principals):
+        """
+        Returns 2-tuple with masks of allowed and denied permissions.
+        """
+        key = (node.id, version, principals)
+        decided = self._decided.get(key)
+        if decided is None:
+            allowed = denied = 0
+            for allow, principal, mask in self._get_node_masks(node, version,
+                    bits):
+                if principal not in principals:
+                    continue
+                mask &= ~(allowed | denied)
+                if allow:
+                    allowed |= mask
+                else:
+                    denied |= mask
+            decided = (allowed, denied)
+            self._decided.set(key, decided)
+        return decided
+
+    @staticmethod
+    def _find_ace(node, principals, permission):
+        """
+        Returns the ACE that decided the permission, for the result's message.
+        """
+        for ace in node.__acl__():
+            perms = ace[2]
+            if isinstance(perms, str):
+                perms = [perms]
+            if ace[1] in principals and permission in perms:
+                return ace
@@ -11,6 +11,7 @@ from pym.cache import FromCache
 from .models import (User, Group, GroupMember)
 from .const import SYSTEM_UID
 from .events import BeforeUserLoggedIn, UserLoggedIn, UserLoggedOut
+from .throttle import login_throttle
 
 
 PASSWORD_SCHEME = 'pbkdf2_sha512'
@@ -23,11 +24,14 @@ def load_by_principal(principal):
     """
     Loads a user instance by principal.
     """
+    tag = 'user-lookup:{}'.format(principal)
     sess = DbSession()
     try:
         p = sess.query(User).options(
             FromCache("auth_short_term",
-                cache_key='auth:user:{}'.format(principal))
+                cache_key='auth:user:{}'.format(principal),
+                tags=[tag, lambda rr: ['user:{}'.format(u.id) for u in rr]],
+                compact=True, negative_key=tag)
         ).filter(
             User.principal == principal
         ).one()
@@ -36,12 +40,18 @@ def load_by_principal(principal):
     return p
 
 
-def _login(request, filter_, pwd, remote_addr):
+def _login(request, login, filter_, pwd, remote_addr):
     """
     Performs login.
 
     Called by the ``login_by...`` functions which initialise the filter.
+
+    Raises :class:`pym.exc.AuthThrottledError` before touching the DB if
+    there were too many attempts for this login or from this address, see
+    :mod:`pym.auth.throttle`.
     """
+    login_throttle.check(login, login_throttle.client_addr(remote_addr,
+        request.headers.get('X-Forwarded-For')))
     filter_.append(User.is_enabled == True)
     filter_.append(User.is_blocked == False)
     sess = DbSession()
@@ -52,9 +62,14 @@ def _login(request, filter_, pwd, remote_addr):
     # We have found the requested user, now broadcast this info so that
     # preparations can take place before we actually log him in.
     request.registry.notify(BeforeUserLoggedIn(request, u))
-    # Now log user in
-    if not pym.security.pwd_context.verify(pwd, u.pwd):
+    # Now log user in. Verification runs in a worker process.
+    ok, new_hash = pym.security.pwd_verifier.verify_and_update(pwd, u.pwd)
+    if not ok:
         raise AuthError('Wrong credentials')
+    # Hash has outdated scheme or rounds
+    if new_hash:
+        u.pwd = new_hash
+    login_throttle.reset(login)
     # And save some stats
     u.login_time = datetime.datetime.now()
     u.login_ip = remote_addr
@@ -101,7 +116,7 @@ def login_by_principal(request, principal, pwd, remote_addr):
     """
     _check_credentials(principal, pwd)
     filter_ = [User.principal == principal]
-    return _login(request, filter_, pwd, remote_addr)
+    return _login(request, principal, filter_, pwd, remote_addr)
 
 
 def login_by_email(request, email, pwd, remote_addr):
@@ -112,7 +127,7 @@ def login_by_email(request, email, pwd, remote_addr):
     """
     _check_credentials(email, pwd)
     filter_ = [User.email == email]
-    return _login(request, filter_, pwd, remote_addr)
+    return _login(request, email, filter_, pwd, remote_addr)
 
 
 # noinspection PyUnusedLocal
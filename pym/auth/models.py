@@ -15,7 +15,8 @@ from pym.models import (
 from pym.models.types import CleanUnicode
 import pym.lib
 import pym.exc
-from pym.cache import region_auth_long_term
+from pym.cache import (region_auth_long_term, LruCache, VersionCounter,
+    tag_keys, session_for)
 
 from .events import UserAuthError
 from .const import (NOBODY_UID, NOBODY_PRINCIPAL, NOBODY_EMAIL,
@@ -144,6 +145,15 @@ class GroupMember(DbBase, DefaultMixin):
     member_user = relationship('User', foreign_keys=[member_user_id])
     member_group = relationship('Group', foreign_keys=[member_group_id])
 
+    def cache_tags(self):
+        """
+        Returns the cache tags to invalidate if this membership changed.
+        """
+        state = sa.inspect(self)
+        user_ids = {state.dict.get('member_user_id')}
+        user_ids.update(state.attrs.member_user_id.history.deleted)
+        return ['user:{}'.format(x) for x in user_ids if x is not None]
+
 
 class User(DbBase, DefaultMixin):
     """
@@ -248,13 +258,88 @@ class User(DbBase, DefaultMixin):
     """List of groups we are directly member of. Call :meth:`load_all_groups` to
     get all."""
 
+    @staticmethod
+    def groups_cache_key(uid):
+        """
+        Returns the cache key of the groups of a user.
+
+        The key contains the current :data:`group_version`, so that changed
+        memberships are picked up without deleting cached values.
+        """
+        return 'auth:groups_for_user:{}:{}'.format(uid, group_version.get())
+
     def load_all_groups(self):
+        """
+        Returns the groups this user is member of, directly or via other
+        groups.
+
+        :return: Tuple of 2-tuples (group ID, group name), ordered by ID.
+        """
+        key = self.groups_cache_key(self.id)
+        uid = self.id
+        own_sess = sa.inspect(self).session
+
         def creator():
-            # TODO Load nested groups
-            return [(x.id, x.name) for x in self.groups]
-        key = 'auth:groups_for_user:{}'.format(self.id)
+            tag_keys(region_auth_long_term, [key],
+                ['user:{}'.format(uid)])
+            # May run in the background, so do not touch self
+            sess = session_for(own_sess)
+            return User.load_groups_for_users(sess, [uid])[uid]
+
         return region_auth_long_term.get_or_create(key, creator)
 
+    @staticmethod
+    def load_groups_for_users(sess, user_ids):
+        """
+        Loads the groups of several users with one query.
+
+        Nested memberships are resolved with a recursive query. It uses UNION
+        instead of UNION ALL, so that cycles of groups terminate.
+
+        :param sess: A DB session
+        :param user_ids: List of user IDs
+        :return: Dict that maps each user ID to a tuple of 2-tuples (group ID,
+            group name), as cached by :meth:`load_all_groups`.
+        """
+        groups = {uid: [] for uid in user_ids}
+        t = GroupMember.__table__
+        tree = sa.select([
+            t.c.member_user_id.label('user_id'), t.c.group_id
+        ]).where(
+            t.c.member_user_id.in_(list(groups.keys()))
+        ).cte('member_groups', recursive=True)
+        gm = t.alias('gm')
+        tree = tree.union(
+            sa.select([
+                tree.c.user_id, gm.c.group_id
+            ]).where(
+                gm.c.member_group_id == tree.c.group_id
+            )
+        )
+        gt = Group.__table__
+        rs = sess.execute(
+            sa.select([
+                tree.c.user_id, gt.c.id, gt.c.name
+            ]).select_from(
+                tree.join(gt, gt.c.id == tree.c.group_id)
+            ).order_by(
+                tree.c.user_id, gt.c.id
+            )
+        )
+        for r in rs:
+            groups[r[0]].append((r[1], r[2]))
+        return {uid: tuple(gg) for uid, gg in groups.items()}
+
+    def cache_tags(self):
+        """
+        Returns the cache tags to invalidate if this user changed.
+        """
+        state = sa.inspect(self)
+        principals = {state.dict.get('principal')}
+        principals.update(state.attrs.principal.history.deleted)
+        return ['user:{}'.format(state.dict.get('id') or state.identity[0])] \
+            + ['user-lookup:{}'.format(p) for p in principals if p is not None]
+
     def __repr__(self):
         return "<{name}(id={id}, principal='{p}', email='{e}'>".format(
             id=self.id, p=self.principal, e=self.email, name=self.__class__.__name__)
@@ -440,6 +525,7 @@ class Permission(DbBase, DefaultMixin):
                 },
             }
         """
+        sess = session_for(sess)
         tree = {}
         # This query returns all permissions with their parents.
         # Some permissions may have no parents.
@@ -561,6 +647,20 @@ class Ace(DbBase, DefaultMixin):
     descr = sa.orm.deferred(sa.Column(sa.UnicodeText, nullable=True))
     """Optional description."""
 
+    def cache_tags(self):
+        """
+        Returns the cache tags of the resource node this ACE belongs to.
+        """
+        from pym.res.models import node_cache_tags_by_id
+        state = sa.inspect(self)
+        resource_ids = {state.dict.get('resource_id')}
+        resource_ids.update(state.attrs.resource_id.history.deleted)
+        tags = []
+        for rid in resource_ids:
+            if rid is not None:
+                tags += node_cache_tags_by_id(state.session, rid)
+        return tags
+
     def to_pyramid_ace(self, perms):
         if self.user_id:
             princ = 'u:' + str(self.user_id)
@@ -584,6 +684,106 @@ class Ace(DbBase, DefaultMixin):
                )
 
 
+acl_version = VersionCounter('auth:acl_version', region_auth_long_term)
+"""
+Version of all ACEs and the permission tree.
+
+Bumped whenever an :class:`Ace` or :class:`Permission` is changed.
+"""
+
+group_version = VersionCounter('auth:group_version', region_auth_long_term)
+"""
+Version of all group memberships.
+
+Bumped whenever a :class:`GroupMember` or :class:`Group` is changed. Part of
+the cache key of :meth:`User.load_all_groups`.
+"""
+
+user_version = VersionCounter('auth:user_version', region_auth_long_term)
+"""
+Version of each user, maintained per user ID.
+
+Bumped whenever a :class:`User` is changed. Validates the user snapshot that
+:class:`CurrentUser` keeps in the session.
+"""
+
+compiled_acl_cache = LruCache(max_entries=10000)
+"""
+In-process cache of compiled ACLs, keyed by (resource ID, ACL version).
+"""
+
+
+def compile_acl(aces, perms):
+    """
+    Compiles ACEs of a resource into an ACL for Pyramid's authorization policy.
+
+    Granting a permission also grants all of its parents, denying a permission
+    also denies all of its children, see :class:`Permission`.
+
+    :param aces: List of :class:`Ace`, in the order they are to be evaluated.
+    :param perms: Permission tree as returned by :meth:`Permission.load_all`.
+    :return: ACL as tuple of 3-tuples.
+    """
+    acl = []
+    for ace in aces:
+        pyr_ace = ace.to_pyramid_ace(perms)
+        acl.append(pyr_ace)
+        p = perms[ace.permission_id]
+        # If allow, allow all parents
+        if ace.allow:
+            implied = p['parents']
+        # If deny, deny all children
+        else:
+            implied = p['children']
+        if implied:
+            for x in implied:
+                acl.append((pyr_ace[0], pyr_ace[1], x[1]))
+    return tuple(acl)
+
+
+# Bump the ACL version only after the changes are committed, otherwise other
+# processes might compile the ACL from the old data again.
+# noinspection PyUnusedLocal
+def acl_after_flush_listener(session, flush_context):
+    for o in session.new | session.dirty | session.deleted:
+        if isinstance(o, Permission):
+            session.info['pym.auth.acl_changed'] = True
+            session.info['pym.auth.permissions_changed'] = True
+        elif isinstance(o, Ace):
+            session.info['pym.auth.acl_changed'] = True
+        elif isinstance(o, (GroupMember, Group)):
+            session.info['pym.auth.groups_changed'] = True
+        elif isinstance(o, User):
+            session.info.setdefault('pym.auth.changed_users', set()).add(o.id)
+
+
+def acl_after_commit_listener(session):
+    if session.info.pop('pym.auth.permissions_changed', False):
+        Permission.load_all.invalidate(session)
+    if session.info.pop('pym.auth.acl_changed', False):
+        acl_version.bump()
+    if session.info.pop('pym.auth.groups_changed', False):
+        group_version.bump()
+    for uid in session.info.pop('pym.auth.changed_users', ()):
+        user_version.bump(uid)
+
+
+# Rolling back a savepoint keeps the flags, they may stem from changes before
+# it. Bumping a version once too often is harmless.
+def acl_after_rollback_listener(session, previous_transaction):
+    if previous_transaction.nested:
+        return
+    session.info.pop('pym.auth.permissions_changed', None)
+    session.info.pop('pym.auth.acl_changed', None)
+    session.info.pop('pym.auth.groups_changed', None)
+    session.info.pop('pym.auth.changed_users', None)
+
+sa.event.listen(sa.orm.Session, 'after_flush', acl_after_flush_listener)
+sa.event.listen(sa.orm.Session, 'after_commit', acl_after_commit_listener)
+sa.event.listen(sa.orm.Session, 'after_soft_rollback',
+    acl_after_rollback_listener)
+
+
 class ActivityLog(DbBase):
     __tablename__ = "activity_log"
     __table_args__ = (
@@ -621,13 +821,25 @@ def get_vw_group_member_browse():
 
 
 class CurrentUser(object):
+    """
+    The user of the current request.
+
+    After the user was loaded, a snapshot of its identity, groups and display
+    fields is kept in the session. Following requests restore the user from
+    the snapshot without querying DB or cache, as long as
+    :data:`user_version` of this user and :data:`group_version` did not
+    change.
+    """
 
     SESS_KEY = 'auth:current_user'
+    SNAPSHOT_FORMAT = 1
+    """Increment if the layout of the snapshot changes."""
 
     def __init__(self, request):
         self._request = request
         self._metadata = None
-        self._groups = []
+        self._groups = ()
+        self.group_ids = ()
         self.uid = None
         self.principal = None
         self.init_nobody()
@@ -651,6 +863,9 @@ class CurrentUser(object):
         """
         Initialises authenticated user.
         """
+        # Get versions first: if they are bumped while we load, the snapshot
+        # is reloaded next time.
+        versions = self._versions(u.id)
         self.uid = u.id
         self.principal = u.principal
         self.groups = u.load_all_groups()
@@ -658,6 +873,35 @@ class CurrentUser(object):
         self._metadata['first_name'] = u.first_name
         self._metadata['last_name'] = u.last_name
         self._metadata['display_name'] = u.display_name
+        self._request.session[self.__class__.SESS_KEY] = (
+            self.SNAPSHOT_FORMAT, versions, self.uid, self.principal,
+            self._groups, dict(self._metadata))
+
+    def init_from_snapshot(self, principal):
+        """
+        Initialises authenticated user from the snapshot in the session.
+
+        :param principal: Principal of the authenticated user
+        :return: True on success, False if there is no snapshot or it is
+            outdated.
+        """
+        try:
+            fmt, versions, uid, p, groups, metadata = \
+                self._request.session[self.__class__.SESS_KEY]
+        except (KeyError, TypeError, ValueError):
+            return False
+        if fmt != self.SNAPSHOT_FORMAT or p != principal \
+                or versions != self._versions(uid):
+            return False
+        self.uid = uid
+        self.principal = p
+        self.groups = groups
+        self._metadata = dict(metadata)
+        return True
+
+    @staticmethod
+    def _versions(uid):
+        return user_version.get(uid), group_version.get()
 
     def is_auth(self):
         """Tells whether user is authenticated, i.e. is not nobody
@@ -665,12 +909,7 @@ class CurrentUser(object):
         return self.uid != NOBODY_UID
 
     def is_wheel(self):
-        if not self._groups:
-            return False
-        for g in self._groups:
-            if g.id == WHEEL_RID:
-                return True
-        return False
+        return WHEEL_RID in self.group_ids
 
     def login(self, login, pwd, remote_addr):
         """
@@ -758,7 +997,8 @@ class CurrentUser(object):
         # mlgg.debug("Setting groups: {}".format([str(x) for x in groups]))
         # for x in traceback.extract_stack(limit=7):
         #     mlgg.debug("{}".format(x))
-        self._groups = v
+        self._groups = tuple(v)
+        self.group_ids = tuple(g[0] for g in self._groups)
 
     @property
     def preferred_locale(self):
@@ -786,6 +1026,6 @@ def get_current_user(request):
     #mlgg.debug("get user: {}".format(request.path))
     principal = pyramid.security.unauthenticated_userid(request)
     cusr = CurrentUser(request)
-    if principal is not None:
+    if principal is not None and not cusr.init_from_snapshot(principal):
         cusr.load_by_principal(principal)
     return cusr
@@ -0,0 +1,278 @@
+"""
+Throttling of login attempts.
+
+Each login attempt takes a token from two buckets, one for the login, i.e.
+principal or email, and one for the client's address. A bucket holds at most
+``capacity`` tokens and regains ``rate`` tokens per second. If a bucket is
+empty, the attempt is rejected before we query the DB or verify the
+password, and no token is taken. A successful login refills the bucket of
+its login.
+"""
+import logging
+import threading
+import time
+
+from pym.cache import LruCache, get_redis_client
+from pym.exc import AuthThrottledError
+
+
+mlgg = logging.getLogger(__name__)
+
+
+class MemoryBucketStore(object):
+    """
+    Keeps token buckets in-process.
+
+    Each process counts on its own, so with several processes an attacker
+    gets proportionally more attempts. Use :class:`RedisBucketStore` then.
+    """
+
+    def __init__(self, max_entries=100000):
+        self._buckets = LruCache(max_entries)
+        self._lock = threading.Lock()
+
+    def take(self, buckets, now=None):
+        """
+        Takes a token from each bucket, but only if none of them is empty.
+
+        :param buckets: List of 3-tuples (key, capacity, rate). Capacity is
+            the max number of tokens, rate the tokens regained per second.
+        :param now: Optional. Current time in seconds.
+        :return: 2-tuple (allowed, seconds until each bucket has a token
+            again)
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            levels = []
+            wait = 0
+            for key, capacity, rate in buckets:
+                tokens, ts = self._buckets.get(key, (capacity, now))
+                tokens = min(capacity, tokens + max(0, now - ts) * rate)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+                levels.append((key, tokens))
+            allowed = wait == 0
+            for key, tokens in levels:
+                self._buckets.set(key, (tokens - 1 if allowed else tokens,
+                    now))
+        return allowed, wait
+
+    def reset(self, key):
+        """
+        Refills a bucket.
+        """
+        self._buckets.delete(key)
+
+
+class RedisBucketStore(object):
+    """
+    Keeps token buckets in Redis, shared by all processes.
+
+    Buckets are hashes which expire once they would be full again. Each
+    attempt costs one round trip.
+    """
+
+    KEY_PREFIX = 'pym:throttle:'
+
+    SCRIPT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i])
+    local rate = tonumber(ARGV[2 * i + 1])
+    local b = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(b[1])
+    local ts = tonumber(b[2])
+    if tokens == nil or ts == nil then
+        tokens = capacity
+        ts = now
+    end
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+    levels[i] = tokens
+end
+local allowed = 0
+if wait == 0 then
+    allowed = 1
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i])
+    local rate = tonumber(ARGV[2 * i + 1])
+    local tokens = levels[i] - allowed
+    redis.call('HMSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return {allowed, tostring(wait)}
+"""
+
+    def __init__(self, client=None):
+        self._client = client
+        self._script = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_redis_client()
+            if self._client is None:
+                raise ValueError("Redis is not configured")
+        return self._client
+
+    def take(self, buckets, now=None):
+        """
+        Takes a token from each bucket, see :meth:`MemoryBucketStore.take`.
+        """
+        if now is None:
+            now = time.time()
+        if self._script is None:
+            self._script = self.client.register_script(self.SCRIPT)
+        args = [now]
+        for key, capacity, rate in buckets:
+            args += [capacity, rate]
+        allowed, wait = self._script(
+            keys=[self.KEY_PREFIX + b[0] for b in buckets], args=args)
+        return bool(allowed), float(wait)
+
+    def reset(self, key):
+        """
+        Refills a bucket.
+        """
+        self.client.delete(self.KEY_PREFIX + key)
+
+
+class LoginThrottle(object):
+    """
+    Rate limit of login attempts per login and per remote address.
+
+    :param store: Instance of :class:`MemoryBucketStore` or
+        :class:`RedisBucketStore`
+    :param login_capacity: Attempts per login in a burst
+    :param login_rate: Attempts per login and second in the long run
+    :param addr_capacity: Attempts per remote address in a burst
+    :param addr_rate: Attempts per remote address and second in the long run
+    :param trusted_proxies: Addresses of proxies whose header
+        ``X-Forwarded-For`` we trust, see :meth:`client_addr`.
+
+    If the store fails, e.g. because Redis is down or not configured, we fall
+    back to in-process buckets rather than lock everybody out.
+    """
+
+    def __init__(self, store, login_capacity=5, login_rate=1 / 60,
+            addr_capacity=20, addr_rate=1 / 6, trusted_proxies=()):
+        self.enabled = True
+        self.store = store
+        self.fallback_store = MemoryBucketStore()
+        self.trusted_proxies = frozenset(trusted_proxies)
+        self.login_capacity = login_capacity
+        self.login_rate = login_rate
+        self.addr_capacity = addr_capacity
+        self.addr_rate = addr_rate
+
+    @staticmethod
+    def _login_key(login):
+        # Principals and emails are case-insensitive
+        return 'login:' + login.lower()
+
+    def client_addr(self, remote_addr, forwarded_for=None):
+        """
+        Returns the address of the client to throttle.
+
+        ``remote_addr`` is the address of the peer. Behind a reverse proxy
+        that is the proxy, and the client is found in ``X-Forwarded-For``.
+        Anybody can send that header, though. So we only look into it if the
+        peer is one of :attr:`trusted_proxies`, and take the last address in
+        it that is not a trusted proxy itself.
+
+        :param remote_addr: Address of the peer, e.g. ``request.remote_addr``
+        :param forwarded_for: Optional. Value of header ``X-Forwarded-For``
+        :return: The address
+        """
+        if not forwarded_for or remote_addr not in self.trusted_proxies:
+            return remote_addr
+        addrs = [a.strip() for a in forwarded_for.split(',')]
+        for addr in reversed(addrs):
+            if addr and addr not in self.trusted_proxies:
+                return addr
+        return remote_addr
+
+    def check(self, login, remote_addr):
+        """
+        Takes a token for the login and one for the address.
+
+        Tokens are only taken if both buckets have one, so rejected attempts
+        from one address do not use up the attempts for a login, and vice
+        versa.
+
+        :param login: Principal or email
+        :param remote_addr: Address of the client, see :meth:`client_addr`.
+        :raises pym.exc.AuthThrottledError: If one of the buckets is empty.
+        """
+        if not self.enabled:
+            return
+        buckets = [(self._login_key(login), self.login_capacity,
+            self.login_rate)]
+        if remote_addr:
+            buckets.append(('addr:' + remote_addr, self.addr_capacity,
+                self.addr_rate))
+        # noinspection PyBroadException
+        try:
+            allowed, wait = self.store.take(buckets)
+        except Exception as exc:
+            mlgg.warning("Throttle store failed, using in-process buckets:"
+                " {}".format(exc))
+            allowed, wait = self.fallback_store.take(buckets)
+        if not allowed:
+            raise AuthThrottledError("Too many login attempts",
+                retry_after=wait)
+
+    def reset(self, login):
+        """
+        Refills the bucket of a login, e.g. after a successful login.
+        """
+        if not self.enabled:
+            return
+        key = self._login_key(login)
+        self.fallback_store.reset(key)
+        # noinspection PyBroadException
+        try:
+            self.store.reset(key)
+        except Exception as exc:
+            mlgg.warning("Throttle store failed: {}".format(exc))
+
+
+login_throttle = LoginThrottle(MemoryBucketStore())
+"""Throttle used by the login functions of :mod:`pym.auth.manager`."""
+
+
+def configure(rc):
+    """
+    Configures :data:`login_throttle` from rc settings.
+
+    Settings are ``auth.throttle.enabled``, ``auth.throttle.store`` ('memory'
+    or 'redis'), ``auth.throttle.login_capacity``,
+    ``auth.throttle.login_interval``, ``auth.throttle.addr_capacity``,
+    ``auth.throttle.addr_interval`` and ``auth.throttle.trusted_proxies``.
+    Intervals are the seconds in which one token is regained.
+
+    :param rc: Instance of :class:`~pym.rc.Rc`
+    """
+    lt = login_throttle
+    lt.enabled = rc.g('auth.throttle.enabled', True)
+    store = rc.g('auth.throttle.store', 'memory')
+    if store == 'redis':
+        lt.store = RedisBucketStore()
+    elif store == 'memory':
+        lt.store = MemoryBucketStore()
+    else:
+        raise ValueError("Unknown throttle store: '{}'".format(store))
+    lt.login_capacity = rc.g('auth.throttle.login_capacity',
+        lt.login_capacity)
+    lt.login_rate = 1 / rc.g('auth.throttle.login_interval',
+        1 / lt.login_rate)
+    lt.addr_capacity = rc.g('auth.throttle.addr_capacity', lt.addr_capacity)
+    lt.addr_rate = 1 / rc.g('auth.throttle.addr_interval', 1 / lt.addr_rate)
+    lt.trusted_proxies = frozenset(rc.g('auth.throttle.trusted_proxies',
+        []) or [])
@@ -77,6 +77,10 @@ class LogInOutView(object):
             pwd = self.request.POST['pwd']
             self.request.user.login(login=login, pwd=pwd,
                 remote_addr=self.request.remote_addr)
+        except (pym.exc.AuthThrottledError, pym.exc.AuthBusyError):
+            msg = "Too many login attempts, please try again later."
+            self.request.session.flash(dict(kind="error", text=msg))
+            return HTTPFound(location=self.login_url)
         except pym.exc.AuthError:
             msg = "Wrong credentials!"
             self.request.session.flash(dict(kind="error", text=msg))
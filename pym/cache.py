@@ -1,14 +1,146 @@
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+import uuid
+import zlib
+
 import sqlalchemy as sa
+import sqlalchemy.orm.attributes
+import sqlalchemy.orm.exc
 import sqlalchemy.orm.interfaces
 import sqlalchemy.orm.query as saqry
 import sqlalchemy.orm.session
+import sqlalchemy.sql.visitors
 
 # noinspection PyPackageRequirements
-from dogpile.cache import make_region
+from dogpile.cache.region import register_backend, CacheRegion
+# noinspection PyPackageRequirements
+from dogpile.cache.backends.redis import RedisBackend
+# noinspection PyPackageRequirements
+from dogpile.cache.api import CacheBackend
 # noinspection PyPackageRequirements
 from dogpile.cache.api import NO_VALUE
 
-# TODO Fetch config settings from RC
+
+mlgg = logging.getLogger(__name__)
+
+
+class CacheStats(object):
+    """
+    Counts cache usage per region and key prefix in this process.
+
+    Recorded are hits and misses, the number and duration of value creations,
+    the number and pickled size of stored values, and the number and duration
+    of waits for the dogpile lock.
+
+    Keys are grouped by the longest registered prefix they start with, see
+    :meth:`add_prefix`. Keys of :class:`CachingQuery` without explicit key,
+    ``'query:<hash>:...'``, are grouped by the hash of their statement.
+    Entries of :class:`NegativeCache` are counted under ``'neg:'`` plus the
+    prefix of the looked up key.
+    """
+
+    FIELDS = ('hits', 'misses', 'creates', 'create_time', 'sets', 'set_size',
+        'lock_waits', 'lock_wait_time')
+    SUFFIXES = (':children', ':acl')
+
+    def __init__(self, prefixes=()):
+        self.enabled = True
+        self._prefixes = set(prefixes)
+        self._data = {}
+        self._lock = threading.Lock()
+        self.since = time.time()
+
+    def add_prefix(self, prefix):
+        """
+        Registers a key prefix to group by.
+        """
+        self._prefixes.add(prefix)
+
+    def key_prefix(self, key):
+        """
+        Returns the prefix under which a key is counted.
+        """
+        neg = ''
+        if key.startswith('neg:'):
+            neg, key = 'neg:', key[4:]
+        if key.startswith('query:'):
+            i = key.find(':', 6)
+            return neg + (key[:i + 1] if i > 0 else key)
+        best = ''
+        for p in self._prefixes:
+            if len(p) > len(best) and key.startswith(p):
+                best = p
+        if not best:
+            return neg + key.split(':', 1)[0] + ':'
+        for suffix in self.SUFFIXES:
+            if key.endswith(suffix):
+                return neg + best + '*' + suffix
+        return neg + best
+
+    def record(self, region_name, key, **kwargs):
+        """
+        Adds values to the counters of a key's prefix.
+
+        :param region_name: Name of the region
+        :param key: The cache key
+        :param kwargs: Field names of :attr:`FIELDS` and the values to add.
+        """
+        if not self.enabled or region_name is None:
+            return
+        k = (region_name, self.key_prefix(key))
+        with self._lock:
+            try:
+                counters = self._data[k]
+            except KeyError:
+                counters = self._data[k] = dict.fromkeys(self.FIELDS, 0)
+            for f, v in kwargs.items():
+                counters[f] += v
+
+    def snapshot(self):
+        """
+        Returns the current numbers.
+
+        :return: List of dicts, one per region and prefix, sorted by region
+            and prefix. Besides the fields of :attr:`FIELDS`, each dict has
+            keys ``region``, ``prefix``, ``hit_ratio``, ``avg_create_time``,
+            ``avg_size`` and ``avg_lock_wait_time``. Times are in seconds,
+            sizes in bytes.
+        """
+        with self._lock:
+            data = [(k, dict(v)) for k, v in self._data.items()]
+        rr = []
+        for (region_name, prefix), counters in sorted(data):
+            r = counters
+            r['region'] = region_name
+            r['prefix'] = prefix
+            lookups = r['hits'] + r['misses']
+            r['hit_ratio'] = r['hits'] / lookups if lookups else None
+            r['avg_create_time'] = r['create_time'] / r['creates'] \
+                if r['creates'] else None
+            r['avg_size'] = r['set_size'] / r['sets'] if r['sets'] else None
+            r['avg_lock_wait_time'] = r['lock_wait_time'] / r['lock_waits'] \
+                if r['lock_waits'] else None
+            rr.append(r)
+        return rr
+
+    def reset(self):
+        """
+        Sets all counters to zero.
+        """
+        with self._lock:
+            self._data.clear()
+            self.since = time.time()
+
+
+cache_stats = CacheStats(['resource:', 'auth:user:', 'auth:groups_for_user:'])
+"""Statistics of the cache regions of this process."""
 
 
 def _stringify(s):
@@ -20,6 +152,8 @@ def _stringify(s):
 # noinspection PyUnusedLocal
 def default_keygen(namespace, fn, **kwargs):
     fname = fn.__name__
+    cache_stats.add_prefix('default:{namespace}:{fname}:'.format(
+        namespace=namespace, fname=fname))
 
     def generate_key(*arg):
         return 'default:{namespace}:{fname}:{other}'.format(
@@ -32,6 +166,8 @@ def default_keygen(namespace, fn, **kwargs):
 # noinspection PyUnusedLocal
 def auth_short_term_keygen(namespace, fn, **kwargs):
     fname = fn.__name__
+    cache_stats.add_prefix('auth:short_term:{namespace}:{fname}:'.format(
+        namespace=namespace, fname=fname))
 
     def generate_key(*arg):
         return 'auth:short_term:{namespace}:{fname}:{other}'.format(
@@ -44,6 +180,8 @@ def auth_short_term_keygen(namespace, fn, **kwargs):
 # noinspection PyUnusedLocal
 def auth_long_term_keygen(namespace, fn, **kwargs):
     fname = fn.__name__
+    cache_stats.add_prefix('auth:long_term:{namespace}:{fname}:'.format(
+        namespace=namespace, fname=fname))
 
     def generate_key(*arg):
         return 'auth:long_term:{namespace}:{fname}:{other}'.format(
@@ -53,50 +191,964 @@ def auth_long_term_keygen(namespace, fn, **kwargs):
     return generate_key
 
 
-region_default = make_region(
+class LruCache(object):
+    """
+    Simple thread-safe in-process cache with a bounded number of entries.
+
+    If the cache is full, the least recently used entry is discarded.
+
+    Optionally, entries expire after ``ttl`` seconds, and the cache is also
+    bounded by the total ``size`` of its entries, as told by :meth:`set`.
+    ``on_evict`` is called with key and value of each entry that is
+    discarded because the cache is full.
+
+    Values are returned as stored, not copied. Store immutable values, e.g.
+    pickled ones, if callers must not see each other's changes.
+    """
+
+    def __init__(self, max_entries=1000, ttl=None, max_size=None,
+            on_evict=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.size = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires, size = self._data[key]
+            except KeyError:
+                return default
+            if expires and expires < time.time():
+                del self._data[key]
+                self.size -= size
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, size=0):
+        expires = time.time() + self.ttl if self.ttl else None
+        evicted = []
+        with self._lock:
+            old = self._data.get(key)
+            if old:
+                self.size -= old[2]
+            self._data[key] = (value, expires, size)
+            self.size += size
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries or (
+                    self.max_size and self.size > self.max_size
+                    and len(self._data) > 1):
+                k, (v, _, old_size) = self._data.popitem(last=False)
+                self.size -= old_size
+                evicted.append((k, v))
+        if self.on_evict is not None:
+            for k, v in evicted:
+                self.on_evict(k, v)
+
+    def delete(self, key):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old:
+                self.size -= old[2]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_connection_pool(url=None, db=0, max_connections=0, timeout=20):
+    """
+    Returns the Redis connection pool that this process shares.
+
+    The first call creates the pool, later calls return it and ignore the
+    arguments. The pool is bounded: if all ``max_connections`` are in use, a
+    caller waits up to ``timeout`` seconds for a free one, then gets a
+    ``redis.ConnectionError``. After a fork, redis-py discards the
+    connections of the parent by itself.
+
+    Each region with backend ``pym.cache.two_tier_redis`` keeps one
+    connection busy for its invalidation listener.
+
+    :param url: Redis URL. Required for the first call.
+    :param db: Number of the Redis database
+    :param max_connections: Max number of connections, default 50.
+    :param timeout: Seconds to wait for a free connection.
+    :return: Instance of ``redis.BlockingConnectionPool``
+    """
+    global _pool
+    if _pool is not None:
+        return _pool
+    with _pool_lock:
+        if _pool is None:
+            if not url:
+                raise ValueError("Redis connection pool is not configured")
+            import redis
+            kw = {'db': db, 'timeout': timeout}
+            if max_connections:
+                kw['max_connections'] = max_connections
+            _pool = redis.BlockingConnectionPool.from_url(url, **kw)
+    return _pool
+
+
+def get_redis_client():
+    """
+    Returns a Redis client that uses the shared connection pool.
+
+    Clients are cheap, they only borrow a connection from the pool for each
+    command.
+
+    :return: Instance of ``redis.StrictRedis``, or None if no pool is
+        configured, e.g. because the cache backend is 'memory'.
+    """
+    if _pool is None:
+        return None
+    import redis
+    return redis.StrictRedis(connection_pool=_pool)
+
+
+class TwoTierRedisBackend(RedisBackend):
+    """
+    Redis backend with an in-process cache in front.
+
+    Values read from or written to Redis are also kept in a bounded
+    per-process LRU cache, so that hot keys cost no round trip. The local
+    cache keeps them pickled, and each read unpickles a fresh copy: callers
+    may modify what they get, e.g. cached lists or instances merged into a
+    session, without changing the value other threads get.
+
+    Writes and deletions are published on a Redis channel. Each process
+    listens on it in a background thread and drops the keys other processes
+    changed from its local cache. Local entries also expire after
+    ``local_expiration_time`` seconds, in case a message got lost.
+
+    Additional arguments:
+
+    - ``local_max_entries``: Max number of locally cached keys, default 10000.
+    - ``local_max_size``: Max total size of locally cached values in bytes,
+      measured as pickled, default 64 MB.
+    - ``local_expiration_time``: Seconds, default 60.
+    - ``invalidation_channel``: Name of the channel, default
+      'pym:cache:invalidate'.
+    - ``connection_pool``: Optional. A ``redis.ConnectionPool`` to use instead
+      of creating a client from ``url``, ``host`` etc., see
+      :func:`get_connection_pool`.
+    - ``region_name``: Optional. Name under which the size of stored values
+      is recorded in :data:`cache_stats`.
+    """
+
+    def __init__(self, arguments):
+        self.connection_pool = arguments.get('connection_pool')
+        self.region_name = arguments.get('region_name')
+        super().__init__(arguments)
+        self.local_max_entries = arguments.get('local_max_entries', 10000)
+        self.local_max_size = arguments.get('local_max_size', 64 * 1024 * 1024)
+        self.local_expiration_time = arguments.get('local_expiration_time', 60)
+        self.invalidation_channel = arguments.get('invalidation_channel',
+            'pym:cache:invalidate')
+        self._local = LruCache(self.local_max_entries,
+            ttl=self.local_expiration_time, max_size=self.local_max_size)
+        self._sender_id = uuid.uuid4().hex
+        self._pid = None
+        self._pid_lock = threading.Lock()
+        # Incremented by each invalidation we receive. If it changes while we
+        # fetch a value from Redis, the value may already be stale.
+        self._generation = 0
+
+    def _create_client(self):
+        if self.connection_pool is None:
+            return super()._create_client()
+        import redis
+        return redis.StrictRedis(connection_pool=self.connection_pool)
+
+    def _check_pid(self):
+        # The listener thread does not survive a fork, and the local cache of
+        # the parent may be outdated.
+        if self._pid == os.getpid():
+            return
+        with self._pid_lock:
+            if self._pid == os.getpid():
+                return
+            self._local.clear()
+            self._sender_id = uuid.uuid4().hex
+            th = threading.Thread(target=self._listen,
+                name='pym-cache-invalidation')
+            th.daemon = True
+            th.start()
+            self._pid = os.getpid()
+
+    def _listen(self):
+        while True:
+            # noinspection PyBroadException
+            try:
+                pubsub = self.client.pubsub()
+                pubsub.subscribe(self.invalidation_channel)
+                for msg in pubsub.listen():
+                    if msg['type'] != 'message':
+                        continue
+                    data = msg['data']
+                    if isinstance(data, bytes):
+                        data = data.decode('utf-8')
+                    sender, key = data.split('|', 1)
+                    if sender != self._sender_id:
+                        self._generation += 1
+                        self._local.delete(key)
+            except Exception:
+                mlgg.exception("Cache invalidation listener failed")
+            # We may have missed messages
+            self._local.clear()
+            time.sleep(1)
+
+    def _publish(self, keys, pipe=None):
+        p = pipe or self.client.pipeline()
+        for key in keys:
+            p.publish(self.invalidation_channel,
+                '{}|{}'.format(self._sender_id, key))
+        if not pipe:
+            p.execute()
+
+    def get_mutex(self, key):
+        if not self.distributed_lock:
+            return None
+        # The lock may be released by another thread than the one that
+        # acquired it, see BackgroundRefresher.
+        return self.client.lock('_lock{0}'.format(key), self.lock_timeout,
+            self.lock_sleep, thread_local=False)
+
+    def get(self, key):
+        self._check_pid()
+        raw = self._local.get(key)
+        if raw is not None:
+            return pickle.loads(raw)
+        gen = self._generation
+        raw = self.client.get(key)
+        if raw is None:
+            return NO_VALUE
+        if gen == self._generation:
+            self._local.set(key, raw, len(raw))
+        return pickle.loads(raw)
+
+    def get_multi(self, keys):
+        self._check_pid()
+        raws = {}
+        missing = []
+        for key in keys:
+            raw = self._local.get(key)
+            if raw is None:
+                missing.append(key)
+            else:
+                raws[key] = raw
+        if missing:
+            gen = self._generation
+            for key, raw in zip(missing, self.client.mget(missing)):
+                if raw is None:
+                    continue
+                if gen == self._generation:
+                    self._local.set(key, raw, len(raw))
+                raws[key] = raw
+        return [pickle.loads(raws[key]) if key in raws else NO_VALUE
+            for key in keys]
+
+    def set(self, key, value):
+        self._check_pid()
+        raw = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        p = self.client.pipeline()
+        if self.redis_expiration_time:
+            p.setex(key, self.redis_expiration_time, raw)
+        else:
+            p.set(key, raw)
+        self._publish([key], p)
+        p.execute()
+        cache_stats.record(self.region_name, key, sets=1, set_size=len(raw))
+        # Keep it pickled: the value may contain instances bound to a session
+        self._local.set(key, raw, len(raw))
+
+    def set_multi(self, mapping):
+        self._check_pid()
+        p = self.client.pipeline()
+        raws = {}
+        for key, value in mapping.items():
+            raw = raws[key] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            if self.redis_expiration_time:
+                p.setex(key, self.redis_expiration_time, raw)
+            else:
+                p.set(key, raw)
+        self._publish(mapping.keys(), p)
+        p.execute()
+        for key, raw in raws.items():
+            cache_stats.record(self.region_name, key, sets=1,
+                set_size=len(raw))
+            self._local.set(key, raw, len(raw))
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        self._check_pid()
+        keys = list(keys)
+        if not keys:
+            return
+        for key in keys:
+            self._local.delete(key)
+        p = self.client.pipeline()
+        p.delete(*keys)
+        self._publish(keys, p)
+        p.execute()
+
+register_backend('pym.cache.two_tier_redis', 'pym.cache',
+    'TwoTierRedisBackend')
+
+
+class MemoryLruBackend(CacheBackend):
+    """
+    In-process backend with bounded size.
+
+    Like the local tier of :class:`TwoTierRedisBackend`, values are stored
+    pickled, so that cached instances are never bound to a session, and each
+    read returns a fresh copy.
+
+    Arguments:
+
+    - ``max_entries``: Max number of keys, default 10000.
+    - ``max_size``: Max total size of the values in bytes, measured as
+      pickled, default 64 MB.
+    - ``expiration_time``: Seconds after which a value is dropped, default
+      none.
+    - ``region_name``: Optional. Name under which the size of stored values
+      is recorded in :data:`cache_stats`.
+    """
+
+    def __init__(self, arguments):
+        self.region_name = arguments.get('region_name')
+        self._cache = LruCache(arguments.get('max_entries', 10000),
+            ttl=arguments.get('expiration_time'),
+            max_size=arguments.get('max_size', 64 * 1024 * 1024))
+
+    def get(self, key):
+        raw = self._cache.get(key)
+        return NO_VALUE if raw is None else pickle.loads(raw)
+
+    def get_multi(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value):
+        raw = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        cache_stats.record(self.region_name, key, sets=1, set_size=len(raw))
+        self._cache.set(key, raw, len(raw))
+
+    def set_multi(self, mapping):
+        for key, value in mapping.items():
+            self.set(key, value)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self._cache.delete(key)
+
+register_backend('pym.cache.memory_lru', 'pym.cache', 'MemoryLruBackend')
+
+
+_refresh_local = threading.local()
+
+
+def session_for(sess):
+    """
+    Returns the DB session a cache creator should use.
+
+    Creators that run in the background, see :class:`BackgroundRefresher`,
+    must not use the session of the request that triggered them. There, this
+    returns a separate session on the same bind, which is closed after the
+    creator has finished. Otherwise, ``sess`` itself is returned.
+
+    :param sess: Session of the caller
+    :return: A session
+    """
+    sessions = getattr(_refresh_local, 'sessions', None)
+    if sessions is None:
+        return sess
+    bind = sess.bind if sess is not None else None
+    for s in sessions:
+        if s.bind is bind:
+            return s
+    # noinspection PyProtectedMember
+    s = sa.orm.Session(bind=bind, autoflush=False,
+        query_cls=sess._query_cls if sess is not None else saqry.Query)
+    sessions.append(s)
+    return s
+
+
+class BackgroundRefresher(object):
+    """
+    Creation runner that recomputes expired values in background threads.
+
+    Configure a region with ``expiration_time`` shorter than the lifetime of
+    the values in the backend, and pass an instance of this class as
+    ``async_creation_runner`` to :func:`~dogpile.cache.make_region`. Then, if
+    a value has expired, dogpile keeps serving the stale value while we
+    recompute it here. Only if there is no value at all, the request has to
+    wait.
+
+    At most ``max_workers`` threads per process run creators. If more than
+    ``max_pending`` refreshes are waiting, further ones are skipped; the stale
+    value is served until a later request retries.
+
+    Like dogpile does for synchronous creation, a recomputed value is only
+    stored if ``should_cache_fn`` of :meth:`PymCacheRegion.get_or_create`
+    accepts it. Then its ``on_store`` is called.
+    """
+
+    def __init__(self, max_workers=2, max_pending=100):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._pid = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Worker threads do not survive a fork
+        if self._pid != os.getpid():
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers)
+            self._pid = os.getpid()
+            self._pending = 0
+        return self._executor
+
+    def __call__(self, cache, key, creator, mutex):
+        with self._lock:
+            executor = self._get_executor()
+            if self._pending >= self.max_pending:
+                mlgg.warning("Too many pending cache refreshes, skipped"
+                    " '{}'".format(key))
+                mutex.release()
+                return
+            self._pending += 1
+        executor.submit(self._run, cache, key, creator, mutex)
+
+    def _run(self, cache, key, creator, mutex):
+        _refresh_local.sessions = []
+        try:
+            value = creator()
+            should_cache_fn = getattr(creator, 'should_cache_fn', None)
+            if should_cache_fn is None or should_cache_fn(value):
+                cache.set(key, value)
+                on_store = getattr(creator, 'on_store', None)
+                if on_store is not None:
+                    on_store(value)
+        except Exception:
+            mlgg.exception("Failed to refresh cache key '{}'".format(key))
+        finally:
+            for s in _refresh_local.sessions:
+                s.close()
+            _refresh_local.sessions = None
+            mutex.release()
+            with self._lock:
+                self._pending -= 1
+
+
+MAX_KEY_LENGTH = 250
+"""Keys longer than this are hashed by :func:`mangle_key`."""
+
+
+def mangle_key(key):
+    """
+    Key mangler for regions that hashes long keys.
+
+    Short keys are used as-is. Of long keys we keep a prefix, so that they
+    still may be told apart when inspecting the cache, and replace the rest by
+    its SHA1 hash.
+    """
+    if len(key) <= MAX_KEY_LENGTH:
+        return key
+    return key[:MAX_KEY_LENGTH - 46] + ':sha1:' + hashlib.sha1(
+        key.encode('utf-8')).hexdigest()
+
+
+class _TimedMutex(object):
+    """
+    Wraps a dogpile mutex and records how long acquiring it blocked.
+    """
+
+    def __init__(self, mutex, region_name, key):
+        self.mutex = mutex
+        self.region_name = region_name
+        self.key = key
+
+    def acquire(self, *args, **kwargs):
+        blocking = args[0] if args else kwargs.get('blocking', True)
+        if blocking is False:
+            return self.mutex.acquire(*args, **kwargs)
+        t0 = time.time()
+        try:
+            return self.mutex.acquire(*args, **kwargs)
+        finally:
+            cache_stats.record(self.region_name, self.key, lock_waits=1,
+                lock_wait_time=time.time() - t0)
+
+    def release(self):
+        return self.mutex.release()
+
+
+class PymCacheRegion(CacheRegion):
+    """
+    Cache region that records its usage in :data:`cache_stats`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._deletions = 0
+
+    @property
+    def generation(self):
+        """
+        Changes whenever keys of this region were deleted, by this process or,
+        as far as the backend learns of it, by other processes.
+        """
+        return self._deletions, getattr(self.backend, '_generation', 0)
+
+    def delete(self, key):
+        self._deletions += 1
+        super().delete(key)
+
+    def delete_multi(self, keys):
+        self._deletions += 1
+        super().delete_multi(keys)
+
+    def get(self, key, expiration_time=None, ignore_expiration=False):
+        value = super().get(key, expiration_time=expiration_time,
+            ignore_expiration=ignore_expiration)
+        if value is NO_VALUE:
+            cache_stats.record(self.name, key, misses=1)
+        else:
+            cache_stats.record(self.name, key, hits=1)
+        return value
+
+    def get_or_create(self, key, creator, expiration_time=None,
+            should_cache_fn=None, on_store=None):
+        """
+        Like ``CacheRegion.get_or_create()``.
+
+        :param on_store: Optional. Called with the created value after it was
+            stored, also if it was created by the async creation runner. Not
+            called for values that ``should_cache_fn`` rejected.
+        """
+        created = []
+        thread = threading.current_thread()
+
+        def timed_creator():
+            # Values created by the async creation runner are stored there
+            if threading.current_thread() is not thread:
+                return creator()
+            t0 = time.time()
+            try:
+                value = creator()
+                created.append(value)
+                return value
+            finally:
+                if cache_stats.enabled:
+                    cache_stats.record(self.name, key, creates=1,
+                        create_time=time.time() - t0)
+
+        # The async creation runner gets the creator only, so it finds
+        # should_cache_fn and on_store here, see BackgroundRefresher.
+        timed_creator.should_cache_fn = should_cache_fn
+        timed_creator.on_store = on_store
+        value = super().get_or_create(key, timed_creator,
+            expiration_time=expiration_time, should_cache_fn=should_cache_fn)
+        if created and on_store is not None and (should_cache_fn is None
+                or should_cache_fn(created[0])):
+            on_store(created[0])
+        if not cache_stats.enabled:
+            return value
+        # A background refresh counts as hit, the stale value was served.
+        if created:
+            cache_stats.record(self.name, key, misses=1)
+        else:
+            cache_stats.record(self.name, key, hits=1)
+        return value
+
+    def _mutex(self, key):
+        mutex = super()._mutex(key)
+        if not cache_stats.enabled:
+            return mutex
+        return _TimedMutex(mutex, self.name, key)
+
+
+region_default = PymCacheRegion(
+    name='default',
+    key_mangler=mangle_key,
     function_key_generator=default_keygen
-).configure(
-    'dogpile.cache.redis',
-    arguments={
-        'url': 'redis:///var/run/redis/redis.sock',
-        #'host': 'localhost',
-        #'port': 6379,
-        'db': 0,
-        'redis_expiration_time': 60 * 5,   # 5 minutes
-        'distributed_lock': True
-    }
 )
 
-
-region_auth_short_term = make_region(
+region_auth_short_term = PymCacheRegion(
+    name='auth_short_term',
+    key_mangler=mangle_key,
     function_key_generator=auth_short_term_keygen
-).configure(
-    'dogpile.cache.redis',
-    arguments={
-        'url': 'redis:///var/run/redis/redis.sock',
-        #'host': 'localhost',
-        #'port': 6379,
-        'db': 0,
-        'redis_expiration_time': 60 * 10,   # 10 minutes
-        'distributed_lock': True
-    }
 )
 
-
-region_auth_long_term = make_region(
-    function_key_generator=auth_long_term_keygen
-).configure(
-    'dogpile.cache.redis',
-    arguments={
-        'url': 'redis:///var/run/redis/redis.sock',
-        #'host': 'localhost',
-        #'port': 6379,
-        'db': 0,
-        'redis_expiration_time': 60 * 60 * 2,   # 2 hours
-        'distributed_lock': True
-    }
+region_auth_long_term = PymCacheRegion(
+    name='auth_long_term',
+    key_mangler=mangle_key,
+    function_key_generator=auth_long_term_keygen,
+    async_creation_runner=BackgroundRefresher()
 )
 
+REGION_DEFAULTS = {
+    # name: (expiration_time, backend expiration time)
+    'default': (None, 60 * 5),   # 5 minutes
+    'auth_short_term': (None, 60 * 10),   # 10 minutes
+    # Refresh in the background after 1.5 hours, the value stays in the
+    # backend for 2 hours.
+    'auth_long_term': (60 * 90, 60 * 60 * 2),
+}
+"""Default expiration times of the regions in seconds."""
+
+
+def configure_regions(rc):
+    """
+    Configures the cache regions of this module from rc settings.
+
+    Regions that are already configured are left as they are, so it is safe
+    to call this more than once, e.g. by the CLI and by the web app.
+
+    Settings:
+
+    - ``cache.backend``: 'redis' (default) or 'memory'. The memory backend
+      keeps everything in-process and is meant for tests and installs that
+      run in a single process. Several processes would not see each other's
+      invalidations.
+    - ``cache.redis.url``, ``cache.redis.db``, ``cache.redis.max_connections``:
+      Default to ``redis.url``, ``redis.db`` and ``redis.max_connections``.
+    - ``cache.redis.pool_timeout``: Seconds to wait for a free connection of
+      the pool, default 20.
+    - ``cache.<region>.expiration_time``: Seconds a value stays in the
+      backend, e.g. ``cache.auth_short_term.expiration_time``.
+    - ``cache.auth_long_term.refresh_after``: Seconds after which a value is
+      recomputed in the background.
+    - ``cache.local.max_entries``, ``cache.local.max_size``,
+      ``cache.local.expiration_time``: Limits of the in-process tier, see
+      :class:`TwoTierRedisBackend`.
+    - ``cache.negative.ttl``: See :class:`NegativeCache`.
+    - ``cache.stats``: Whether to record :data:`cache_stats`, default true.
+
+    :param rc: Instance of :class:`~pym.rc.Rc`
+    """
+    backend = rc.g('cache.backend', 'redis')
+    if backend not in ('redis', 'memory'):
+        raise ValueError("Unknown cache backend: '{}'".format(backend))
+    local_args = {}
+    for k in ('max_entries', 'max_size', 'expiration_time'):
+        v = rc.g('cache.local.' + k, 0)
+        if v:
+            local_args['local_' + k] = v
+    pool = None
+    if backend == 'redis':
+        pool = get_connection_pool(
+            url=rc.g('cache.redis.url', rc.g('redis.url',
+                'redis://localhost:6379')),
+            db=rc.g('cache.redis.db', rc.g('redis.db', 0)),
+            max_connections=rc.g('cache.redis.max_connections',
+                rc.g('redis.max_connections', 0) or 0),
+            timeout=rc.g('cache.redis.pool_timeout', 20)
+        )
+    for region in (region_default, region_auth_short_term,
+            region_auth_long_term):
+        if 'backend' in region.__dict__:
+            continue
+        expiration_time, backend_expiration_time = REGION_DEFAULTS[
+            region.name]
+        backend_expiration_time = rc.g(
+            'cache.{}.expiration_time'.format(region.name),
+            backend_expiration_time)
+        if expiration_time:
+            expiration_time = rc.g(
+                'cache.{}.refresh_after'.format(region.name), expiration_time)
+        if backend == 'memory':
+            arguments = {
+                'max_entries': local_args.get('local_max_entries', 10000),
+                'max_size': local_args.get('local_max_size',
+                    64 * 1024 * 1024),
+                'expiration_time': backend_expiration_time,
+                'region_name': region.name,
+            }
+            region.configure('pym.cache.memory_lru',
+                expiration_time=expiration_time, arguments=arguments)
+        else:
+            arguments = {
+                'connection_pool': pool,
+                'redis_expiration_time': backend_expiration_time,
+                'distributed_lock': True,
+                'region_name': region.name,
+            }
+            arguments.update(local_args)
+            region.configure('pym.cache.two_tier_redis',
+                expiration_time=expiration_time, arguments=arguments)
+    negative_cache.ttl = rc.g('cache.negative.ttl', negative_cache.ttl)
+    cache_stats.enabled = rc.g('cache.stats', True)
+
+
+TAG_KEY_PREFIX = 'pym:tag:'
+"""Prefix of the keys of the sets that hold the cache keys of a tag."""
+
+# noinspection PyUnusedLocal
+def _evict_memory_tag(tag_key, value):
+    # Nobody could invalidate these keys anymore, so delete them now
+    region, keys = value
+    region.delete_multi(list(keys))
+
+
+_memory_tags = LruCache(max_entries=100000, max_size=1000000,
+    on_evict=_evict_memory_tag)
+"""
+Tags of regions that are not backed by Redis: maps tag key to 2-tuple
+(region, set of cache keys). Bounded by the number of tags and the total
+number of tagged keys. The keys of a discarded tag are deleted from its
+region.
+"""
+_memory_tags_lock = threading.Lock()
+
+
+def _tag_client(region):
+    """
+    Returns the Redis client of the region's backend, or None.
+    """
+    return getattr(region.backend, 'client', None)
+
+
+def _tag_key(region, tag):
+    return '{}{}:{}'.format(TAG_KEY_PREFIX, region.name, tag)
+
+
+def tag_keys(region, keys, tags):
+    """
+    Registers cache keys of a region with tags.
+
+    If the region is backed by Redis, each tag is a Redis set of keys which
+    expires together with the keys. Other backends keep the sets in-process.
+
+    :param region: The cache region
+    :param keys: List of cache keys
+    :param tags: List of tags, e.g. ``['node:42', 'user:7']``
+    """
+    tag_keys_multi(region, [(keys, tags)])
+
+
+def tag_keys_multi(region, items):
+    """
+    Like :func:`tag_keys` for several lists of keys, in one round trip.
+
+    :param region: The cache region
+    :param items: List of 2-tuples (keys, tags)
+    """
+    items = [(keys, tags) for keys, tags in items if keys and tags]
+    if not items:
+        return
+    client = _tag_client(region)
+    if client is None:
+        with _memory_tags_lock:
+            for keys, tags in items:
+                for tag in tags:
+                    k = _tag_key(region, tag)
+                    entry = _memory_tags.get(k)
+                    tagged = entry[1] if entry else set()
+                    tagged.update(keys)
+                    _memory_tags.set(k, (region, tagged), size=len(tagged))
+        return
+    expiration_time = getattr(region.backend, 'redis_expiration_time', None) \
+        or 60 * 60 * 24
+    p = client.pipeline()
+    for keys, tags in items:
+        for tag in tags:
+            k = _tag_key(region, tag)
+            p.sadd(k, *keys)
+            p.expire(k, expiration_time)
+    p.execute()
+
+
+def invalidate_tags(tags, regions=None):
+    """
+    Deletes all cache keys that were registered with one of the tags, and the
+    entries of :data:`negative_cache` under these tags.
+
+    :param tags: List of tags
+    :param regions: Optional. List of regions. Defaults to all regions of this
+        module.
+    """
+    tags = list(tags)
+    if not tags:
+        return
+    if regions is None:
+        regions = (region_default, region_auth_short_term,
+            region_auth_long_term)
+    for region in regions:
+        tag_keys_ = [_tag_key(region, tag) for tag in tags]
+        client = _tag_client(region)
+        if client is None:
+            keys = set()
+            with _memory_tags_lock:
+                for k in tag_keys_:
+                    entry = _memory_tags.get(k)
+                    if entry:
+                        keys.update(entry[1])
+                        _memory_tags.delete(k)
+        else:
+            p = client.pipeline()
+            p.sunion(*tag_keys_)
+            p.delete(*tag_keys_)
+            keys = {k.decode('utf-8') if isinstance(k, bytes) else k
+                for k in p.execute()[0]}
+        if keys:
+            region.delete_multi(list(keys))
+    negative_cache.clear(tags)
+
+
+class VersionCounter(object):
+    """
+    A version number that all processes share via a cache region.
+
+    Use it to tag derived data that is cached in-process: if the version
+    changes, the derived data is outdated. Call :meth:`bump` after the source
+    data has changed.
+
+    To keep lookups cheap, a process asks the region at most every
+    ``check_interval`` seconds for the current version. Hence other processes
+    may see a bumped version with that delay.
+
+    Positional arguments of :meth:`get` and :meth:`bump` are appended to the
+    key, so that one counter may maintain a version per e.g. user ID.
+    """
+
+    def __init__(self, key, region, check_interval=2, max_entries=10000):
+        self.key = key
+        self.region = region
+        self.check_interval = check_interval
+        self._local = LruCache(max_entries)
+
+    def _make_key(self, parts):
+        if not parts:
+            return self.key
+        return self.key + ':' + ':'.join(str(x) for x in parts)
+
+    @staticmethod
+    def _new_version():
+        return int(time.time() * 1000000)
+
+    def get(self, *parts):
+        """
+        Returns current version.
+        """
+        key = self._make_key(parts)
+        now = time.time()
+        local = self._local.get(key)
+        if local and now - local[1] < self.check_interval:
+            return local[0]
+        version = self.region.get_or_create(key, self._new_version,
+            expiration_time=-1)
+        self._local.set(key, (version, now))
+        return version
+
+    def bump(self, *parts):
+        """
+        Sets a new version and returns it.
+        """
+        key = self._make_key(parts)
+        version = self._new_version()
+        self.region.set(key, version)
+        self._local.set(key, (version, time.time()))
+        return version
+
+
+class NegativeCache(object):
+    """
+    Remembers for a short while that a lookup found nothing.
+
+    Use the tag of the looked up key, e.g. 'user-lookup:<principal>', as the
+    key of the entry. Then :func:`invalidate_tags` clears the entry when the
+    missing row is created.
+
+    If the region is backed by Redis, an entry is a Redis key, prefixed with
+    'neg:', which is set with ``SETEX`` and expires after ``ttl`` seconds.
+    Other backends keep the entries in-process. Entries take no space in the
+    region itself and are not tagged.
+    """
+
+    PREFIX = 'neg:'
+
+    def __init__(self, region, ttl=30, max_entries=10000):
+        self.region = region
+        self.ttl = ttl
+        self._local = LruCache(max_entries)
+
+    def _key(self, key):
+        return mangle_key(self.PREFIX + key)
+
+    def is_missing(self, key):
+        """
+        Tells whether a lookup of ``key`` recently found nothing.
+        """
+        if not self.ttl:
+            return False
+        client = _tag_client(self.region)
+        if client is None:
+            expires = self._local.get(self._key(key))
+            missing = expires is not None and expires > time.time()
+        else:
+            missing = bool(client.exists(self._key(key)))
+        cache_stats.record(self.region.name, self.PREFIX + key,
+            **{'hits' if missing else 'misses': 1})
+        return missing
+
+    def set_missing(self, key):
+        """
+        Remembers that a lookup of ``key`` found nothing.
+        """
+        if not self.ttl:
+            return
+        client = _tag_client(self.region)
+        if client is None:
+            self._local.set(self._key(key), time.time() + self.ttl)
+        else:
+            client.setex(self._key(key), self.ttl, 1)
+
+    def clear(self, keys):
+        """
+        Forgets the misses of a list of keys.
+        """
+        keys = [self._key(k) for k in keys]
+        if not keys:
+            return
+        client = _tag_client(self.region)
+        if client is None:
+            for k in keys:
+                self._local.delete(k)
+        else:
+            client.delete(*keys)
+
+
+negative_cache = NegativeCache(region_auth_short_term, ttl=30)
+"""Negative cache for lookups of users and resource nodes."""
+
+
+PREFETCH_KEY = 'pym.cache.prefetched'
+"""Key in ``session.info`` of values fetched by
+:meth:`CachingQuery._prefetch`."""
+
 
 class CachingQuery(saqry.Query):
     """A Query subclass which optionally loads full results from a dogpile
@@ -135,11 +1187,106 @@ class CachingQuery(saqry.Query):
 
         """
         if hasattr(self, '_cache_region'):
-            return self.get_value(createfunc=lambda: list(
-                saqry.Query.__iter__(self)))
+            if isinstance(self._cache_region, FromCache):
+                self._prefetch()
+            if getattr(self._cache_region, 'compact', False):
+                return iter(self._get_compact_value())
+            return self.get_value(createfunc=self._load)
         else:
             return saqry.Query.__iter__(self)
 
+    def _load(self):
+        """
+        Loads the result from the DB, in a separate session if we are called
+        by a :class:`BackgroundRefresher`.
+
+        If :class:`FromCache` was given a ``negative_key``, a recent miss is
+        answered from :data:`negative_cache` without querying the DB, and a
+        new miss is remembered there. We are only called if the cache had no
+        value, so a hit never costs a lookup in the negative cache.
+        """
+        negative_key = getattr(self._cache_region, 'negative_key', None)
+        if negative_key and negative_cache.is_missing(negative_key):
+            return []
+        sess = session_for(self.session)
+        q = self if sess is self.session else self.with_session(sess)
+        rr = list(saqry.Query.__iter__(q))
+        if negative_key and not rr:
+            negative_cache.set_missing(negative_key)
+        return rr
+
+    def _get_compact_value(self):
+        """
+        Returns the result, using a cached :class:`CompactResult`.
+        """
+        created = []
+
+        def creator():
+            rr = self._load()
+            # Only results of our own session may be returned directly
+            if session_for(self.session) is self.session:
+                created.append(rr)
+            return CompactResult(rr)
+
+        value = self.get_value(merge=False, createfunc=creator)
+        # Freshly loaded, the instances are already in our session
+        if created:
+            value.objects = None
+            return created[0]
+        try:
+            rr = value.rebuild(self._propagate_options())
+        except StaleCacheValue:
+            rr = list(saqry.Query.__iter__(self))
+            value = CompactResult(rr)
+            self.set_value(value)
+            value.objects = None
+            return rr
+        return self.merge_result(rr, load=False)
+
+    def _propagate_options(self):
+        """
+        Returns the options that instances loaded by this query keep for
+        their lazy loads.
+        """
+        return frozenset(o for o in self._with_options
+            if o.propagate_to_loaders)
+
+    def _prefetch(self):
+        """
+        Fetches the values of this query and its relationship caches at once.
+
+        Collects the explicit cache keys of all :class:`RelationshipCache`
+        options in the same region as this query's, and fetches them together
+        with this query's key in one round trip. The values are stashed in the
+        session, where :meth:`get_value` of the lazy loads picks them up.
+        The stash is cleared at the end of the transaction.
+
+        We stash the backend's ``CachedValue`` together with the region's
+        generation. :meth:`get_value` checks both before it serves a value.
+        """
+        if self.session is None:
+            return
+        region_name = self._cache_region.region
+        keys = []
+        for opt in self._with_options:
+            if not isinstance(opt, RelationshipCache):
+                continue
+            for ro in opt._relationship_options.values():
+                if ro.region == region_name and ro.cache_key:
+                    keys.append(ro.cache_key)
+        if not keys:
+            return
+        dogpile_region, cache_key = self._get_cache_plus_key()
+        keys.insert(0, cache_key)
+        generation = dogpile_region.generation
+        mangler = dogpile_region.key_mangler
+        values = dogpile_region.backend.get_multi(
+            [mangler(k) for k in keys] if mangler else keys)
+        stash = self.session.info.setdefault(PREFETCH_KEY, {})
+        for k, v in zip(keys, values):
+            if v is not NO_VALUE:
+                stash[(region_name, k)] = (v, generation)
+
     def _get_cache_plus_key(self):
         """Return a cache region plus key."""
 
@@ -166,6 +1313,21 @@ class CachingQuery(saqry.Query):
         """
         dogpile_region, cache_key = self._get_cache_plus_key()
 
+        if not ignore_expiration and self.session is not None:
+            stash = self.session.info.get(PREFETCH_KEY)
+            if stash:
+                cached_value = self._unstash(dogpile_region, stash.pop(
+                    (self._cache_region.region, cache_key), None),
+                    expiration_time)
+                if cached_value is not NO_VALUE:
+                    cache_stats.record(dogpile_region.name, cache_key,
+                        hits=1)
+                    cached_value = cached_value.payload
+                    if merge:
+                        cached_value = self.merge_result(cached_value,
+                            load=False)
+                    return cached_value
+
         # ignore_expiration means, if the value is in the cache
         # but is expired, return it anyway.   This doesn't make sense
         # with createfunc, which says, if the value is expired, generate
@@ -173,6 +1335,14 @@ class CachingQuery(saqry.Query):
         assert not ignore_expiration or not createfunc, \
             "Can't ignore expiration and also provide createfunc"
 
+        tags = getattr(self._cache_region, 'tags', None)
+        on_store = None
+        if createfunc and tags:
+            on_store = self._tagging_callback(dogpile_region, cache_key, tags)
+        should_cache_fn = None
+        if not getattr(self._cache_region, 'cache_empty', True):
+            should_cache_fn = _is_not_empty
+
         if ignore_expiration or not createfunc:
             cached_value = dogpile_region.get(cache_key,
                                 expiration_time=expiration_time,
@@ -181,7 +1351,9 @@ class CachingQuery(saqry.Query):
             cached_value = dogpile_region.get_or_create(
                 cache_key,
                 createfunc,
-                expiration_time=expiration_time
+                expiration_time=expiration_time,
+                should_cache_fn=should_cache_fn,
+                on_store=on_store
             )
         if cached_value is NO_VALUE:
             raise KeyError(cache_key)
@@ -189,11 +1361,175 @@ class CachingQuery(saqry.Query):
             cached_value = self.merge_result(cached_value, load=False)
         return cached_value
 
+    @staticmethod
+    def _unstash(dogpile_region, entry, expiration_time):
+        """
+        Returns a ``CachedValue`` stashed by :meth:`_prefetch`, or NO_VALUE if
+        it may be outdated.
+        """
+        if entry is None:
+            return NO_VALUE
+        cached_value, generation = entry
+        # Keys deleted since the prefetch may include this one
+        if generation != dogpile_region.generation:
+            return NO_VALUE
+        return dogpile_region._unexpired_value_fn(expiration_time,
+            False)(cached_value)
+
     def set_value(self, value):
         """Set the value in the cache for this query."""
 
         dogpile_region, cache_key = self._get_cache_plus_key()
         dogpile_region.set(cache_key, value)
+        tags = getattr(self._cache_region, 'tags', None)
+        if tags:
+            tag_keys(dogpile_region, [cache_key], resolve_tags(tags,
+                value.objects if isinstance(value, CompactResult) else value))
+
+    @staticmethod
+    def _tagging_callback(dogpile_region, cache_key, tags):
+        # Only values that were stored are tagged, not e.g. empty results
+        # that should not be cached.
+        def on_store(value):
+            tag_keys(dogpile_region, [cache_key], resolve_tags(tags,
+                value.objects if isinstance(value, CompactResult) else value))
+        return on_store
+
+
+def _is_not_empty(value):
+    if isinstance(value, CompactResult):
+        return bool(value.rows or value.plain)
+    return bool(value)
+
+
+def resolve_tags(tags, result):
+    """
+    Returns list of tags for a cached query result.
+
+    :param tags: List of tags. Each item is either a string, or a callable
+        which is called with the query result (a list) and returns a list of
+        tags.
+    :param result: The query result
+    """
+    rr = []
+    for t in tags:
+        if callable(t):
+            rr.extend(t(result))
+        else:
+            rr.append(t)
+    return rr
+
+
+class StaleCacheValue(Exception):
+    """
+    A cached value was built for another version of the data model.
+    """
+
+
+UNLOADED = Ellipsis
+"""Marks attributes that were not loaded in a :class:`CompactResult`.
+Ellipsis survives pickling as a singleton."""
+
+_mapper_schemas = {}
+
+
+def _mapper_schema(mapper):
+    """
+    Returns the column attributes we store of instances of this mapper.
+
+    :return: 3-tuple (version, keys, indexes of primary key in keys). The
+        version changes if the mapped columns change.
+    """
+    try:
+        return _mapper_schemas[mapper]
+    except KeyError:
+        keys = tuple(p.key for p in mapper.column_attrs if not p.deferred)
+        pk_idx = tuple(keys.index(mapper.get_property_by_column(c).key)
+            for c in mapper.primary_key)
+        version = zlib.crc32(repr((mapper.class_.__name__, keys)).encode(
+            'utf-8'))
+        schema = (version, keys, pk_idx)
+        _mapper_schemas[mapper] = schema
+        return schema
+
+
+class CompactResult(object):
+    """
+    Compact representation of a query result for the cache.
+
+    Instead of pickling ORM instances with their whole instance state, we
+    store per instance its class, the schema version of its mapper and a tuple
+    of the values of its loaded, non-deferred column attributes.
+
+    Results that are not a list of mapped instances, e.g. of queries with
+    several entities, are stored as they are.
+
+    Attribute ``objects`` holds the original result. It is not pickled and
+    is dropped once tags were resolved, so that the in-process cache tier
+    does not keep instances of a session.
+    """
+
+    def __init__(self, result):
+        self.objects = result
+        self.rows = None
+        self.plain = None
+        try:
+            rows = []
+            for obj in result:
+                state = sa.orm.attributes.instance_state(obj)
+                version, keys, _ = _mapper_schema(state.mapper)
+                d = state.dict
+                rows.append((state.class_, version,
+                    tuple(d.get(k, UNLOADED) for k in keys)))
+            self.rows = rows
+        except sa.orm.exc.NO_STATE:
+            self.plain = result
+
+    def __getstate__(self):
+        return {'rows': self.rows, 'plain': self.plain}
+
+    def __setstate__(self, state):
+        self.objects = None
+        self.rows = state['rows']
+        self.plain = state['plain']
+
+    def rebuild(self, load_options=None):
+        """
+        Builds detached instances from the stored rows.
+
+        A query sets its options that propagate to loaders on each instance it
+        loads, and lazy loads of the instance's relationships apply them, e.g.
+        :class:`RelationshipCache`. We do the same here, and
+        ``Session.merge()`` copies them to the merged instances.
+
+        :param load_options: Optional. Options of the query that propagate to
+            loaders, see :meth:`CachingQuery._propagate_options`.
+        :return: List of instances, ready to be merged into a session.
+        :raises StaleCacheValue: If a mapper changed since the value was
+            stored.
+        """
+        if self.rows is None:
+            return self.plain
+        rr = []
+        for cls, version, values in self.rows:
+            mapper = sa.orm.class_mapper(cls)
+            cur_version, keys, pk_idx = _mapper_schema(mapper)
+            if version != cur_version:
+                raise StaleCacheValue(cls)
+            obj = mapper.class_manager.new_instance()
+            state = sa.orm.attributes.instance_state(obj)
+            if load_options:
+                state.load_options = load_options
+                # Lazy loads find their relationship options by this path
+                state.load_path = mapper._path_registry
+            d = state.dict
+            for k, v in zip(keys, values):
+                if v is not UNLOADED:
+                    d[k] = v
+            state.key = mapper.identity_key_from_primary_key(
+                [values[i] for i in pk_idx])
+            rr.append(obj)
+        return rr
 
 
 def query_callable(regions, query_cls=CachingQuery):
@@ -202,27 +1538,106 @@ def query_callable(regions, query_cls=CachingQuery):
     return query
 
 
-# noinspection PyUnusedLocal
+_SHAPE_ATTRS = ('name', 'fullname', 'key', 'operator', 'modifier',
+    'text', 'keyword', 'isouter', 'recursive', '_limit', '_offset',
+    '_distinct', '_for_update_arg', 'type')
+"""Attributes that tell statements apart which consist of the same
+element classes, e.g. table and column names or operators."""
+
+_ANON_ID = re.compile(r'%\(\d+ ')
+"""Matches the ``id()`` that anonymous names, e.g. of labels or aliases,
+start with."""
+
+_shape_keys = LruCache(max_entries=1000)
+"""Maps the shape of a statement to the hash of its SQL text."""
+
+
+def _statement_shape(stmt, params):
+    """
+    Walks the statement tree once.
+
+    Returns the shape of the statement, i.e. the tuple of its elements
+    without the values of bound parameters, and the list of those values in
+    the order they were visited.
+
+    Bound parameters and other anonymous elements are named after their
+    ``id()``. Those names are left out, so that statements built the same way
+    have the same shape.
+
+    The walk does not visit the table of a column, so we add it to the shape
+    of each column, see :func:`_selectable_shape`. Aliases are numbered in
+    the order they are visited or referred to by a column.
+    """
+    shape = []
+    values = []
+    selectables = {}
+    for elem in sa.sql.visitors.iterate(stmt, {}):
+        shape.append(elem.__class__)
+        if isinstance(elem, sa.sql.expression.Alias):
+            shape.append(('alias', _selectable_shape(elem, selectables)))
+        elif isinstance(elem, sa.sql.expression.ColumnClause):
+            table = getattr(elem, 'table', None)
+            if table is not None:
+                shape.append(('table', _selectable_shape(table,
+                    selectables)))
+        is_bind = isinstance(elem, sa.sql.expression.BindParameter)
+        for attr in _SHAPE_ATTRS:
+            if is_bind and attr == 'key':
+                v = elem._orig_key
+            else:
+                v = elem.__dict__.get(attr)
+            if v is not None:
+                shape.append((attr, _ANON_ID.sub('%(', str(v))))
+        if is_bind:
+            if elem.key in params:
+                values.append(params[elem.key])
+            else:
+                values.append(elem.effective_value)
+    return tuple(shape), values
+
+
+def _selectable_shape(selectable, selectables):
+    """
+    Returns what tells a table, alias or CTE apart from the others of a
+    statement.
+
+    That is its name, or, if it is anonymous, the order in which it first
+    appeared in the statement. Two anonymous aliases of the same table thus
+    differ, yet statements built the same way match.
+
+    :param selectable: The table, alias or CTE
+    :param selectables: Dict that maps ``id()`` of the anonymous selectables
+        seen so far to their order. Updated.
+    """
+    name = getattr(selectable, 'name', None)
+    if name is not None and not _ANON_ID.search(str(name)):
+        return (selectable.__class__, str(name),
+            getattr(selectable, 'schema', None))
+    return (selectable.__class__,
+        selectables.setdefault(id(selectable), len(selectables)))
+
+
 def _key_from_query(query, qualifier=None):
     """Given a Query, create a cache key.
 
-    There are many approaches to this; here we use the simplest,
-    which is to create an md5 hash of the text of the SQL statement,
-    combined with stringified versions of all the bound parameters
-    within it.     There's a bit of a performance hit with
-    compiling out "query.statement" here; other approaches include
-    setting up an explicit cache key with a particular Query,
-    then combining that with the bound parameter values.
+    Compiling the SQL statement for every lookup is expensive. Instead we walk
+    the statement tree once to get its shape and the values of its bound
+    parameters. The SQL text is compiled and hashed only once per shape, and
+    the key is that hash combined with stringified versions of the bound
+    parameters.
 
     """
-
     stmt = query.with_labels().statement
-    compiled = stmt.compile()
-    params = compiled.params
-
-    # here we return the key as a long string.  our "key mangler"
-    # set up with the region will boil it down to an md5.
-    return " ".join([str(compiled)] + [str(params[k]) for k in sorted(params)])
+    shape, values = _statement_shape(stmt, query._params)
+    shape_key = _shape_keys.get(shape)
+    if shape_key is None:
+        shape_key = hashlib.sha1(
+            str(stmt.compile()).encode('utf-8')).hexdigest()
+        _shape_keys.set(shape, shape_key)
+    parts = ['query', shape_key] + [str(v) for v in values]
+    if qualifier:
+        parts.append(str(qualifier))
+    return ":".join(parts)
 
 
 class FromCache(sa.orm.interfaces.MapperOption):
@@ -230,7 +1645,8 @@ class FromCache(sa.orm.interfaces.MapperOption):
 
     propagate_to_loaders = False
 
-    def __init__(self, region="default", cache_key=None):
+    def __init__(self, region="default", cache_key=None, tags=None,
+            compact=False, cache_empty=True, negative_key=None):
         """Construct a new FromCache.
 
         :param region: the cache region.  Should be a
@@ -243,9 +1659,27 @@ class FromCache(sa.orm.interfaces.MapperOption):
         as when using in_()) which correspond more simply to
         some other identifier.
 
+        :param tags: optional.  List of tags to register the cache key
+        with, see :func:`resolve_tags`.  Use :func:`invalidate_tags` to
+        delete all keys of a tag.
+
+        :param compact: optional.  If True, store the result as
+        :class:`CompactResult`.
+
+        :param cache_empty: optional.  If False, empty results are not
+        cached.
+
+        :param negative_key: optional.  Key under which misses are remembered
+        in :data:`negative_cache` for a short while.  Implies
+        ``cache_empty=False``.
+
         """
         self.region = region
         self.cache_key = cache_key
+        self.tags = tags
+        self.compact = compact
+        self.cache_empty = cache_empty and not negative_key
+        self.negative_key = negative_key
 
     def process_query(self, query):
         """Process a Query during normal loading operation."""
@@ -258,7 +1692,8 @@ class RelationshipCache(sa.orm.interfaces.MapperOption):
 
     propagate_to_loaders = True
 
-    def __init__(self, attribute, region="default", cache_key=None):
+    def __init__(self, attribute, region="default", cache_key=None,
+            tags=None, compact=False):
         """Construct a new RelationshipCache.
 
         :param attribute: A Class.attribute which
@@ -271,9 +1706,15 @@ class RelationshipCache(sa.orm.interfaces.MapperOption):
         that will serve as the key to the query, bypassing
         the usual means of forming a key from the Query itself.
 
+        :param tags: optional.  List of tags, as with :class:`FromCache`.
+
+        :param compact: optional.  As with :class:`FromCache`.
+
         """
         self.region = region
         self.cache_key = cache_key
+        self.tags = tags
+        self.compact = compact
         self._relationship_options = {
             (attribute.property.parent.class_, attribute.property.key): self
         }
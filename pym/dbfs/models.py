@@ -92,6 +92,18 @@ class FsNode(pym.res.models.ResourceNode):
     def is_root(self):
         return self.id == self.fs_root_id
 
+    def iter_dir(self, sess, after=None, limit=None, page_size=100):
+        """
+        Iterates over the entries of this directory, page by page.
+
+        Each page is loaded with one query that joins ``fs_tree``; the content
+        columns stay deferred. See
+        :meth:`~pym.res.models.ResourceNode.iter_children` for the arguments.
+        """
+        return self.iter_children(sess, after=after, limit=limit,
+            kinds=[self.__mapper__.polymorphic_identity],
+            page_size=page_size)
+
     def is_dir(self):
         return self.mime_type == self.MIME_TYPE_DIRECTORY
 
@@ -12,6 +12,24 @@ class AuthError(PymError):
     pass
 
 
+class AuthBusyError(AuthError):
+    """
+    Credentials could not be checked now, because of too many concurrent
+    logins.
+    """
+    pass
+
+
+class AuthThrottledError(AuthError):
+    """
+    Too many login attempts for a principal or from an address.
+    """
+
+    def __init__(self, msg, retry_after=None):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
 class SassError(PymError):
 
     def __init__(self, msg, resp=None):
@@ -34,6 +34,7 @@ from sqlalchemy.ext.declarative import (
 )
 from sqlalchemy.sql.expression import (func)
 import sqlalchemy.engine
+import sqlalchemy.event
 
 from psycopg2.extensions import adapt as sqlescape
 # or use the appropiate escape function from your db driver
@@ -289,7 +290,11 @@ def init(settings, prefix, invalidate_caches=False):
     Initialises the module globals ``DbEngine``, ``DbSession`` and ``DbBase``.
     The session is joined into the Zope Transaction Manager.
 
-    :param settings: Dict with settings
+    Also configures the cache regions, see
+    :func:`pym.cache.configure_regions`.
+
+    :param settings: Dict with settings, ``settings['rc']`` must be the
+        :class:`~pym.rc.Rc` instance.
     :param prefix: Prefix for SQLAlchemy settings
     """
     global DbEngine
@@ -300,6 +305,7 @@ def init(settings, prefix, invalidate_caches=False):
     DbSession.configure(bind=DbEngine)
     DbBase.metadata.bind = DbEngine
 
+    pym.cache.configure_regions(settings['rc'])
     add_cache_region('default', pym.cache.region_default)
     add_cache_region('auth_short_term', pym.cache.region_auth_short_term)
     add_cache_region('auth_long_term', pym.cache.region_auth_long_term)
@@ -341,6 +347,84 @@ def add_cache_region(name, region):
     cache_regions[name] = region
 
 
+CACHE_TAGS_KEY = 'pym.cache_tags'
+"""Key in ``session.info`` of the cache tags to invalidate on commit."""
+
+SAVEPOINT_CACHE_TAGS_KEY = 'pym.savepoint_cache_tags'
+"""Key in ``session.info`` of the cache tags at the beginning of each active
+savepoint, by transaction."""
+
+
+# Mapped classes that are cached define a method ``cache_tags()`` which returns
+# the cache tags under which data of the instance may be cached. We collect the
+# tags of all changed instances during the transaction and invalidate them
+# after the commit. Invalidating earlier would let concurrent requests cache
+# the old data again. cache_tags() is called during the flush and must not
+# query, it may only use loaded attributes and the identity map.
+# noinspection PyUnusedLocal
+def cache_tags_after_flush_listener(session, flush_context):
+    tags = session.info.setdefault(CACHE_TAGS_KEY, set())
+    for o in session.new | session.dirty | session.deleted:
+        try:
+            f = o.cache_tags
+        except AttributeError:
+            continue
+        tags.update(f())
+
+
+def cache_tags_after_commit_listener(session):
+    tags = session.info.pop(CACHE_TAGS_KEY, None)
+    if tags:
+        pym.cache.invalidate_tags(tags)
+
+
+# Rolling back a savepoint drops only the tags collected since it began. We
+# keep a copy of the tags at the beginning of each savepoint until the
+# outermost transaction ends.
+# noinspection PyUnusedLocal
+def cache_tags_after_transaction_create_listener(session, transaction):
+    if transaction.nested:
+        session.info.setdefault(SAVEPOINT_CACHE_TAGS_KEY, {})[transaction] = \
+            frozenset(session.info.get(CACHE_TAGS_KEY, ()))
+
+
+def cache_tags_after_soft_rollback_listener(session, previous_transaction):
+    if previous_transaction.nested:
+        tags = session.info.get(SAVEPOINT_CACHE_TAGS_KEY, {}).pop(
+            previous_transaction, None)
+        if tags is not None:
+            session.info[CACHE_TAGS_KEY] = set(tags)
+            return
+    session.info.pop(CACHE_TAGS_KEY, None)
+
+
+def cache_tags_after_transaction_end_listener(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(SAVEPOINT_CACHE_TAGS_KEY, None)
+
+
+# Values that CachingQuery prefetched are only valid within the transaction.
+# This also covers a session that is just closed, as zope.sqlalchemy does for
+# requests that changed nothing.
+# noinspection PyUnusedLocal
+def prefetch_after_transaction_end_listener(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(pym.cache.PREFETCH_KEY, None)
+
+sa.event.listen(sa.orm.Session, 'after_flush',
+    cache_tags_after_flush_listener)
+sa.event.listen(sa.orm.Session, 'after_commit',
+    cache_tags_after_commit_listener)
+sa.event.listen(sa.orm.Session, 'after_transaction_create',
+    cache_tags_after_transaction_create_listener)
+sa.event.listen(sa.orm.Session, 'after_soft_rollback',
+    cache_tags_after_soft_rollback_listener)
+sa.event.listen(sa.orm.Session, 'after_transaction_end',
+    cache_tags_after_transaction_end_listener)
+sa.event.listen(sa.orm.Session, 'after_transaction_end',
+    prefetch_after_transaction_end_listener)
+
+
 def exists(sess, name, schema='public'):
     """
     Checks if given relation exists.
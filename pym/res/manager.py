@@ -0,0 +1,254 @@
+import sqlalchemy as sa
+from zope.sqlalchemy import mark_changed
+
+import pym.auth.models as pam
+from .models import ResourceNode, resolve_iface, invalidate_resource_cache
+
+
+BULK_CHUNK_SIZE = 1000
+"""Max number of rows in a single multi-row INSERT."""
+
+
+def spec_from_paths(paths, **kwargs):
+    """
+    Builds a nested spec for :func:`bulk_create` from a flat list of paths.
+
+    Intermediate nodes that are not listed explicitly are created with the
+    attributes of ``kwargs``.
+
+    :param paths: List of paths, e.g. ``['a', 'a/b', 'a/b/c']``. An item may
+        also be a 2-tuple ``(path, attrs)`` where ``attrs`` is a dict of
+        attributes for this node.
+    :param kwargs: Default attributes, e.g. ``kind``, for all nodes.
+    :return: Nested spec
+    """
+    spec = []
+    index = {}
+    for item in paths:
+        if isinstance(item, str):
+            path, attrs = item, {}
+        else:
+            path, attrs = item
+        names = [x for x in path.split('/') if x]
+        level = spec
+        for i, name in enumerate(names):
+            key = tuple(names[:i + 1])
+            try:
+                node = index[key]
+            except KeyError:
+                node = dict(kwargs)
+                node['name'] = name
+                node['children'] = []
+                index[key] = node
+                level.append(node)
+            level = node['children']
+        node.update(attrs)
+    return spec
+
+
+def _flatten(spec, parent_path, depth, rows):
+    for node in spec:
+        attrs = dict(node)
+        children = attrs.pop('children', None) or []
+        acl = attrs.pop('acl', None) or []
+        path = parent_path + (attrs['name'],)
+        rows.append((depth, path, parent_path, attrs, acl))
+        _flatten(children, path, depth + 1, rows)
+
+
+def _column_map(mapper):
+    """
+    Maps attribute names of a mapper to the columns of its tables.
+    """
+    m = {}
+    for prop in mapper.column_attrs:
+        cols = [c for c in prop.columns if c.table in mapper.tables]
+        if cols:
+            m[prop.key] = cols
+    return m
+
+
+def _insert_multi(sess, table, rows):
+    """
+    Inserts rows with multi-row INSERTs.
+
+    Rows are grouped by their set of keys, because columns omitted in a
+    multi-row INSERT would be set NULL instead of their server default.
+    """
+    groups = {}
+    for r in rows:
+        groups.setdefault(tuple(sorted(r.keys())), []).append(r)
+    for rr in groups.values():
+        for i in range(0, len(rr), BULK_CHUNK_SIZE):
+            sess.execute(table.insert().values(rr[i:i + BULK_CHUNK_SIZE]))
+
+
+def _resolve_ids(sess, cls, col, values):
+    """
+    Resolves names to IDs with one query.
+
+    Integers are taken as IDs, instances are replaced by their ID.
+    """
+    names = {v for v in values if isinstance(v, str)}
+    ids = {}
+    if names:
+        rs = sess.query(cls.id, col).filter(col.in_(names))
+        for r in rs:
+            ids[r[1]] = r[0]
+        missing = names - set(ids.keys())
+        if missing:
+            raise sa.orm.exc.NoResultFound("{} not found: {}".format(
+                cls.__name__, ', '.join(sorted(missing))))
+    for v in values:
+        if isinstance(v, int):
+            ids[v] = v
+        elif v is not None and not isinstance(v, str):
+            ids[v] = v.id
+    return ids
+
+
+def bulk_create(sess, owner, parent, spec, **kwargs):
+    """
+    Creates a whole tree of resource nodes with few statements.
+
+    Unlike :meth:`~pym.res.models.ResourceNode.add_child`, this does not
+    create ORM instances. All IDs are fetched from the sequence in one query,
+    then the nodes are written level by level with multi-row INSERTs, one per
+    table of the polymorphic mapper of each ``kind``. ACEs are written
+    afterwards the same way. Owner, users, groups, permissions and interfaces
+    are resolved only once.
+
+    ``spec`` is a list of dicts. Each dict contains the attributes of a node,
+    at least ``name`` and ``kind``, plus optionally:
+
+    - ``children``: Nested spec of the child nodes.
+    - ``acl``: List of dicts with keys ``allow``, ``permission``, and
+      ``user`` or ``group``, optionally ``sortix``. Values may be IDs, names
+      or instances, as with :meth:`~pym.res.models.ResourceNode.allow`.
+
+    Use :func:`spec_from_paths` to build a spec from a list of paths.
+
+    The mapper is looked up by ``kind``, so attributes of subclasses, e.g.
+    :class:`~pym.dbfs.models.FsNode`, may be given as well. The modules of
+    such classes must have been imported.
+
+    :param sess: A DB session
+    :param owner: ID, ``principal``, or instance of the owning user.
+    :param parent: ID or instance of the parent node, or None to create root
+        nodes.
+    :param spec: The nodes to create.
+    :param kwargs: Default attributes for all nodes, e.g. ``tenant_id``.
+    :return: Dict that maps the path of each created node, relative to
+        ``parent``, e.g. 'a/b', to its ID.
+    """
+    owner_id = pam.User.find(sess, owner).id
+    if parent is None or isinstance(parent, int):
+        parent_id = parent
+    else:
+        parent_id = parent.id
+    rows = []
+    _flatten(spec, (), 0, rows)
+    if not rows:
+        return {}
+
+    # Resolve everything once
+    for r in rows:
+        for k, v in kwargs.items():
+            r[3].setdefault(k, v)
+        if r[3].get('iface'):
+            resolve_iface(r[3]['iface'])
+    aces = [ace for r in rows for ace in r[4]]
+    users = _resolve_ids(sess, pam.User, pam.User.principal,
+        [ace.get('user') for ace in aces])
+    groups = _resolve_ids(sess, pam.Group, pam.Group.name,
+        [ace.get('group') for ace in aces])
+    perms = _resolve_ids(sess, pam.Permission, pam.Permission.name,
+        [ace['permission'].value if isinstance(ace['permission'],
+            pam.Permissions) else ace['permission'] for ace in aces])
+
+    # Allocate all IDs at once
+    seq = sa.func.nextval('pym.resource_tree_id_seq')
+    new_ids = [x[0] for x in sess.execute(
+        sa.select([seq]).select_from(
+            sa.func.generate_series(1, len(rows))))]
+    ids = {r[1]: new_ids[i] for i, r in enumerate(rows)}
+    ids[()] = parent_id
+
+    # Build rows per depth and table. The mpath trigger needs the parent rows
+    # in place, so we insert level by level.
+    base_mapper = sa.inspect(ResourceNode)
+    col_maps = {}
+    levels = {}
+    for depth, path, parent_path, attrs, acl in rows:
+        kind = attrs['kind']
+        mapper = base_mapper.polymorphic_map.get(kind, base_mapper)
+        try:
+            col_map = col_maps[mapper]
+        except KeyError:
+            col_map = col_maps[mapper] = _column_map(mapper)
+        attrs['id'] = ids[path]
+        attrs['parent_id'] = ids[parent_path]
+        attrs['owner_id'] = owner_id
+        table_rows = {t: {} for t in mapper.tables}
+        for k, v in attrs.items():
+            try:
+                cols = col_map[k]
+            except KeyError:
+                # Hybrid properties, e.g. 'name' for column property '_name'
+                try:
+                    cols = col_map['_' + k]
+                except KeyError:
+                    raise AttributeError("{} has no attribute '{}'".format(
+                        mapper.class_.__name__, k))
+            for c in cols:
+                table_rows[c.table][c.key] = v
+        # Python-side scalar defaults are not applied per row by multi-row
+        # INSERTs.
+        for t, tr in table_rows.items():
+            for c in t.c:
+                if c.key not in tr and c.default is not None \
+                        and c.default.is_scalar:
+                    tr[c.key] = c.default.arg
+        level = levels.setdefault(depth, {})
+        for t in mapper.tables:
+            level.setdefault(t, []).append(table_rows[t])
+
+    sorted_tables = {t: i for i, t in enumerate(
+        ResourceNode.metadata.sorted_tables)}
+    for depth in sorted(levels.keys()):
+        level = levels[depth]
+        for t in sorted(level.keys(), key=lambda x: sorted_tables[x]):
+            _insert_multi(sess, t, level[t])
+
+    ace_rows = []
+    for depth, path, parent_path, attrs, acl in rows:
+        for ace in acl:
+            perm = ace['permission']
+            if isinstance(perm, pam.Permissions):
+                perm = perm.value
+            ar = {
+                'owner_id': owner_id,
+                'resource_id': ids[path],
+                'allow': ace['allow'],
+                'permission_id': perms[perm],
+                'user_id': users[ace['user']] if ace.get('user') else None,
+                'group_id': groups[ace['group']] if ace.get('group') else None,
+            }
+            if 'sortix' in ace:
+                ar['sortix'] = ace['sortix']
+            ace_rows.append(ar)
+    if ace_rows:
+        _insert_multi(sess, pam.Ace.__table__, ace_rows)
+
+    # Loaded children of the parent are outdated now
+    if parent is not None and not isinstance(parent, int) \
+            and 'children' in sa.inspect(parent).dict:
+        sess.expire(parent, ['children'])
+    # Cached lookups of the new names, misses included, and the cached children
+    # of the parent are outdated after the commit.
+    invalidate_resource_cache(sess,
+        [(ids[path], attrs['name'], ids[parent_path])
+            for _, path, parent_path, attrs, _ in rows],
+        parent_ids=[parent_id])
+    mark_changed(sess)
+    return {'/'.join(path): ids[path] for _, path, _, _, _ in rows}
@@ -1,21 +1,37 @@
 import pyramid.util
 import sqlalchemy as sa
 import sqlalchemy.event
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import (relationship, backref)
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.ext.hybrid import hybrid_property
 import pyramid.security
 #from pyramid.decorator import reify
 import zope.interface
+import zope.interface.declarations
 
 import pym.lib
 import pym.exc
 import pym.cache
 import pym.auth.models as pam
-from pym.models import (DbBase, DefaultMixin, DbSession)
+from pym.models import (DbBase, DefaultMixin, DbSession, CACHE_TAGS_KEY)
 from pym.models.types import CleanUnicode
 
 
+DEFAULT_SORTIX = 5000
+"""Sort index of resource nodes that have none set."""
+
+_path_misses = pym.cache.LruCache(max_entries=10000)
+"""
+Paths that :meth:`ResourceNode.load_path` recently did not find, keyed by
+(ID of the start node, tuple of names up to the missing one). The miss itself
+is kept in :data:`pym.cache.negative_cache` under the lookup tag of the
+missing name, so it is cleared when a node of that name is created, renamed or
+moved there.
+"""
+
+
 class IRootNode(zope.interface.Interface):
     pass
 
@@ -134,7 +150,8 @@ class ResourceNode(DbBase, DefaultMixin):
     Kind of resource. Default is 'res'. Discriminates resources in polymorphic
     tables.
     """
-    sortix = sa.Column(sa.Integer(), nullable=True, server_default='5000')
+    sortix = sa.Column(sa.Integer(), nullable=True,
+        server_default=str(DEFAULT_SORTIX))
     """
     Sort index; if equal, sort by name.
     """
@@ -149,6 +166,16 @@ class ResourceNode(DbBase, DefaultMixin):
 
     E.g. 'pym.res:IRes'
     """
+    mpath = sa.Column(ARRAY(sa.Integer()), nullable=True,
+        server_default=sa.FetchedValue(), server_onupdate=sa.FetchedValue())
+    """
+    Materialized path: IDs of all nodes from the root down to this node,
+    including the node itself.
+
+    Maintained by DB triggers when a node is inserted or moved (see
+    :mod:`pym.res.setup`). Deletions are handled by the cascading foreign key.
+    Do not set this yourself.
+    """
 
     children = relationship("ResourceNode",
         order_by=lambda: [ResourceNode.sortix, ResourceNode.name],
@@ -372,17 +399,22 @@ class ResourceNode(DbBase, DefaultMixin):
         """
         # CAVEAT: Setup fails if we use cache here!
         if use_cache:
+            tags = lookup_cache_tags(name, None)
             r = sess.query(
                 cls
             ).options(
                 pym.cache.FromCache("auth_long_term",
-                cache_key='resource:{}:None'.format(name))
+                cache_key='resource:{}:None'.format(name),
+                tags=tags + [result_cache_tags],
+                compact=True)
             ).options(
                 pym.cache.RelationshipCache(cls.children, "auth_long_term",
-                cache_key='resource:{}:None:children'.format(name))
+                cache_key='resource:{}:None:children'.format(name),
+                tags=tags, compact=True)
             ).options(
                 # CAVEAT: Program hangs if we use our own cache key here!
-                pym.cache.RelationshipCache(cls.acl, "auth_long_term")  # ,
+                pym.cache.RelationshipCache(cls.acl, "auth_long_term",
+                tags=tags, compact=True)  # ,
                 #cache_key='resource:{}:None:acl'.format(name))
             ).filter(
                 sa.and_(cls.parent_id == None, cls.name == name)
@@ -398,15 +430,398 @@ class ResourceNode(DbBase, DefaultMixin):
     def is_root(self):
         return self.parent_id is None
 
-    def dumps(self, _indent=0):
-        return "   " * _indent \
-            + repr(self) + "\n" \
-            + "".join([c.dumps(_indent + 1) for c in self.children.values()])
+    @property
+    def path_ids(self):
+        """
+        IDs of all nodes from the root down to this node, i.e. ``mpath``.
+
+        Rows written before the mpath trigger existed may lack ``mpath``
+        until :func:`pym.res.setup.rebuild_mpath` ran. Then we walk up the
+        parents.
+        """
+        if self.mpath is not None:
+            return self.mpath
+        ids = []
+        n = self
+        while n is not None:
+            ids.append(n.id)
+            n = n.parent
+        return ids[::-1]
+
+    @property
+    def depth(self):
+        """
+        Depth of this node in its tree. The root node has depth 0.
+        """
+        return len(self.path_ids) - 1
+
+    def ancestors(self, sess):
+        """
+        Returns query for all ancestors of this node, root first.
+
+        Since the IDs of all ancestors are stored in ``mpath``, this is a
+        single lookup by primary key.
+
+        :param sess: A DB session
+        :return: Query
+        """
+        cls = ResourceNode
+        ids = self.path_ids[:-1]
+        q = sess.query(
+            cls
+        ).filter(
+            cls.id.in_(ids)
+        )
+        if ids:
+            q = q.order_by(sa.case(
+                dict((id_, i) for i, id_ in enumerate(ids)), value=cls.id))
+        return q
+
+    def descendants(self, sess, max_depth=None):
+        """
+        Returns query for all descendants of this node.
+
+        Uses the index on ``mpath``. The nodes are ordered by depth first, then
+        by ``sortix`` and name.
+
+        :param sess: A DB session
+        :param max_depth: Optional. Limit result to this many levels below
+            this node, e.g. 1 to get only the children.
+        :return: Query
+        """
+        cls = ResourceNode
+        fil = [
+            cls.mpath.contains([self.id]),
+            cls.id != self.id
+        ]
+        if max_depth is not None:
+            fil.append(sa.func.array_length(cls.mpath, 1)
+                <= len(self.path_ids) + max_depth)
+        return sess.query(
+            cls
+        ).with_polymorphic(
+            cls.polymorphic_spec()
+        ).filter(
+            sa.and_(*fil)
+        ).order_by(
+            sa.func.array_length(cls.mpath, 1), cls.sortix, cls.name
+        )
+
+    def is_descendant_of(self, other):
+        """
+        Tells whether this node is located below the other one.
+
+        Needs no query, since we just look into ``mpath``.
+
+        :param other: Instance or ID of the other node.
+        :return: True or False
+        """
+        other_id = other if isinstance(other, int) else other.id
+        return other_id in self.path_ids[:-1]
+
+    @classmethod
+    def is_under(cls, sess, node_id, ancestor_id):
+        """
+        Tells whether node ``node_id`` is located below node ``ancestor_id``.
+
+        Use this if you do not have an instance of the node at hand,
+        otherwise prefer :meth:`is_descendant_of`.
+
+        :param sess: A DB session
+        :param node_id: ID of the node in question
+        :param ancestor_id: ID of the presumable ancestor
+        :return: True or False
+        """
+        t = ResourceNode.__table__
+        return sess.query(sa.exists().where(sa.and_(
+            t.c.id == node_id,
+            t.c.id != ancestor_id,
+            t.c.mpath.contains([ancestor_id])
+        ))).scalar()
+
+    @classmethod
+    def polymorphic_spec(cls, kinds=None):
+        """
+        Returns the classes to load with ``with_polymorphic()``.
+
+        Querying the base class loads the columns of subclasses with joined
+        table inheritance, e.g. :class:`~pym.dbfs.models.FsNode`, lazily with
+        one SELECT per row. Passing this spec to ``Query.with_polymorphic()``
+        joins the subclass tables, so one query hydrates all. Deferred columns
+        of the subclasses stay deferred.
+
+        :param kinds: Optional. Join only the tables of these kinds.
+        :return: '*' or list of classes.
+        """
+        if not kinds:
+            return '*'
+        pmap = sa.inspect(cls).polymorphic_map
+        return [pmap[k].class_ for k in kinds if k in pmap]
+
+    @staticmethod
+    def _sort_key_cols():
+        cls = ResourceNode
+        return (sa.func.coalesce(cls.sortix, DEFAULT_SORTIX), cls.name, cls.id)
+
+    def iter_children(self, sess, after=None, limit=None, kinds=None,
+            page_size=100):
+        """
+        Iterates over the children of this node, page by page.
+
+        Unlike :attr:`children`, this loads only ``page_size`` children at a
+        time. Children are ordered by ``sortix``, name and ID. Pagination uses
+        the last key of the previous page (keyset pagination) instead of an
+        offset, and is backed by index ``resource_tree_children_ix``, so that
+        fetching a page costs the same, regardless of how far we are into the
+        list.
+
+        To continue in a later request where a previous iteration stopped, pass
+        the last child you got as ``after``.
+
+        :param sess: A DB session
+        :param after: Optional. Start after this child. Either an instance of
+            a child, or its key as 3-tuple (sortix, name, id).
+        :param limit: Optional. Stop after this many children.
+        :param kinds: Optional. List of kinds to restrict the children to.
+        :param page_size: Number of children to fetch per query.
+        :return: Iterator over the child nodes.
+        """
+        cls = ResourceNode
+        key_cols = self._sort_key_cols()
+        fil = [cls.parent_id == self.id]
+        if kinds:
+            fil.append(cls.kind.in_(kinds))
+        if isinstance(after, ResourceNode):
+            after = (DEFAULT_SORTIX if after.sortix is None else after.sortix,
+                after.name, after.id)
+        n = 0
+        while True:
+            size = page_size if limit is None else min(page_size, limit - n)
+            if size <= 0:
+                return
+            page_fil = list(fil)
+            if after:
+                page_fil.append(sa.tuple_(*key_cols) > sa.tuple_(*after))
+            page = sess.query(
+                cls
+            ).with_polymorphic(
+                cls.polymorphic_spec(kinds)
+            ).filter(
+                sa.and_(*page_fil)
+            ).order_by(
+                *key_cols
+            ).limit(size).all()
+            for ch in page:
+                yield ch
+            n += len(page)
+            if len(page) < size:
+                return
+            ch = page[-1]
+            after = (DEFAULT_SORTIX if ch.sortix is None else ch.sortix,
+                ch.name, ch.id)
+
+    def count_children(self, sess, kinds=None):
+        """
+        Counts the children of this node without loading them.
+
+        :param sess: A DB session
+        :param kinds: Optional. List of kinds to restrict the children to.
+        :return: Number of children.
+        """
+        t = ResourceNode.__table__
+        fil = [t.c.parent_id == self.id]
+        if kinds:
+            fil.append(t.c.kind.in_(kinds))
+        return sess.query(sa.func.count(t.c.id)).filter(
+            sa.and_(*fil)).scalar()
+
+    def move_to(self, sess, new_parent):
+        """
+        Moves this node with its whole subtree below another parent.
+
+        This is one UPDATE of this node's ``parent_id``; the DB trigger then
+        rewrites ``mpath`` of all descendants in one statement. No descendant
+        is loaded into the session.
+
+        :param sess: A DB session
+        :param new_parent: Instance of the new parent node.
+        :raises PymError: If the new parent is located in this subtree.
+        """
+        sess.flush()
+        if self.id in new_parent.path_ids:
+            raise pym.exc.PymError("Cannot move node {} below itself".format(
+                self.id))
+        old_parent_id = self.parent_id
+        t = ResourceNode.__table__
+        sess.execute(t.update().where(t.c.id == self.id).values(
+            parent_id=new_parent.id))
+        invalidate_resource_cache(sess, [(self.id, self.name, old_parent_id),
+            (self.id, self.name, new_parent.id)],
+            parent_ids=[old_parent_id, new_parent.id])
+        # Sync the session
+        for o in list(sess.identity_map.values()):
+            if not isinstance(o, ResourceNode):
+                continue
+            if o.id in (old_parent_id, new_parent.id):
+                sess.expire(o, ['children'])
+            mpath = sa.inspect(o).dict.get('mpath')
+            if mpath and self.id in mpath:
+                sess.expire(o, ['mpath'])
+        sess.expire(self, ['parent_id', 'parent', 'mpath'])
+
+    def delete_subtree(self, sess):
+        """
+        Deletes this node with its whole subtree.
+
+        The subtree is deleted with one DELETE statement per table, using the
+        index on ``mpath``. The ACEs are deleted by the cascading foreign key.
+        No descendant is loaded into the session; those already present are
+        expunged.
+
+        :param sess: A DB session
+        """
+        sess.flush()
+        t = ResourceNode.__table__
+        if self.mpath is not None:
+            fil = t.c.mpath.contains([self.id])
+            rows = sess.execute(sa.select([t.c.id, t.c.name, t.c.parent_id])
+                .where(fil)).fetchall()
+        else:
+            # Rows written before the mpath trigger, see path_ids
+            tree = sa.select([t.c.id, t.c.name, t.c.parent_id]).where(
+                t.c.id == self.id).cte('subtree', recursive=True)
+            tree = tree.union_all(sa.select([t.c.id, t.c.name,
+                t.c.parent_id]).where(t.c.parent_id == tree.c.id))
+            rows = sess.execute(sa.select([tree.c.id, tree.c.name,
+                tree.c.parent_id])).fetchall()
+            fil = t.c.id.in_([r[0] for r in rows])
+        subtree = sa.select([t.c.id]).where(fil)
+        # Tables of subclasses first, they reference resource_tree without
+        # cascade.
+        tables = set()
+        for mapper in sa.inspect(ResourceNode).polymorphic_map.values():
+            tables.update(x for x in mapper.tables if x is not t)
+        for st in reversed(ResourceNode.metadata.sorted_tables):
+            if st in tables:
+                sess.execute(st.delete().where(st.c.id.in_(subtree)))
+        sess.execute(t.delete().where(fil))
+        invalidate_resource_cache(sess, rows, parent_ids=[self.parent_id])
+        # Sync the session
+        ids = set(r[0] for r in rows)
+        for o in list(sess.identity_map.values()):
+            if isinstance(o, ResourceNode):
+                if o.id in ids:
+                    sess.expunge(o)
+                elif o.id == self.parent_id:
+                    sess.expire(o, ['children'])
+            elif isinstance(o, pam.Ace) and o.resource_id in ids:
+                sess.expunge(o)
+        sess.info['pym.auth.acl_changed'] = True
+
+    def load_subtree(self, sess, max_depth=None, kinds=None):
+        """
+        Loads the subtree below this node in a single query.
+
+        The nodes are linked to each other in memory: ``parent`` of each node
+        is set, and so is :attr:`children` of each node whose children are
+        known to be complete, i.e. if no ``kinds`` are given and the node is
+        not at ``max_depth``. Accessing these attributes afterwards does not
+        hit the database.
+
+        :param sess: A DB session
+        :param max_depth: Optional. Load only this many levels below this
+            node, e.g. 1 to load only the children.
+        :param kinds: Optional. List of kinds. Nodes of other kinds are
+            skipped together with their subtree.
+        :return: List of loaded nodes, excluding this one, ordered by depth,
+            ``sortix`` and name.
+        """
+        if max_depth is not None and max_depth < 1:
+            return []
+        cls = ResourceNode
+        t = ResourceNode.__table__
+        fil = [t.c.parent_id == self.id]
+        if kinds:
+            fil.append(t.c.kind.in_(kinds))
+        tree = sa.select([
+            t.c.id, sa.literal(1).label('depth')
+        ]).where(
+            sa.and_(*fil)
+        ).cte('resource_subtree', recursive=True)
+        tt = t.alias('tt')
+        fil = [tt.c.parent_id == tree.c.id]
+        if kinds:
+            fil.append(tt.c.kind.in_(kinds))
+        if max_depth is not None:
+            fil.append(tree.c.depth < max_depth)
+        tree = tree.union_all(
+            sa.select([
+                tt.c.id, (tree.c.depth + 1).label('depth')
+            ]).where(
+                sa.and_(*fil)
+            )
+        )
+        rs = sess.query(
+            cls, tree.c.depth
+        ).with_polymorphic(
+            cls.polymorphic_spec(kinds)
+        ).join(
+            tree, cls.id == tree.c.id
+        ).order_by(
+            tree.c.depth, *self._sort_key_cols()
+        )
+        nodes = {self.id: self}
+        children = {self.id: []}
+        result = []
+        for node, depth in rs:
+            set_committed_value(node, 'parent', nodes[node.parent_id])
+            children[node.parent_id].append(node)
+            nodes[node.id] = node
+            if max_depth is None or depth < max_depth:
+                children[node.id] = []
+            result.append(node)
+        if not kinds:
+            for node_id, chh in children.items():
+                set_committed_value(nodes[node_id], 'children', chh)
+        return result
+
+    def dumps(self, sess=None, max_depth=None):
+        """
+        Returns a string with this node and its subtree, one node per line.
+
+        The subtree is loaded with :meth:`load_subtree`.
+
+        :param sess: Optional. A DB session. Defaults to the session this node
+            is bound to.
+        :param max_depth: Optional. Dump only this many levels.
+        """
+        if not sess:
+            sess = sa.inspect(self).session
+            if not sess:
+                sess = DbSession()
+        children = {}
+        for node in self.load_subtree(sess, max_depth=max_depth):
+            children.setdefault(node.parent_id, []).append(node)
+
+        def _dumps(node, indent):
+            return "   " * indent \
+                + repr(node) + "\n" \
+                + "".join([_dumps(c, indent + 1)
+                    for c in children.get(node.id, [])])
+
+        return _dumps(self, 0)
 
     def __acl__(self):
         """
         ACL for Pyramid's authorization policy.
+
+        The ACL is compiled once per node and ACL version, and then served from
+        :data:`pym.auth.models.compiled_acl_cache`.
         """
+        key = (self.id, pam.acl_version.get())
+        acl = pam.compiled_acl_cache.get(key)
+        if acl is not None:
+            return acl
         sess = sa.inspect(self).session
         # Bind ourselves to a new session in case we'd lost our session. This
         # may happen if the current request created an exception, which closes
@@ -417,23 +832,11 @@ class ResourceNode(DbBase, DefaultMixin):
         if not sess:
             sess = DbSession()
             sess.add(self)
-        acl = []
         perms = pam.Permission.load_all(sess)
-        # Convert self.acl into Pyramid's ACL
-        for ace in self.acl:
-            pyr_ace = ace.to_pyramid_ace(perms)
-            acl.append(pyr_ace)
-            # If allow, allow all parents
-            if ace.allow:
-                if perms[ace.permission_id]['parents']:
-                    for p in perms[ace.permission_id]['parents']:
-                        pyr_ace2 = (pyr_ace[0], pyr_ace[1], p['name'])
-                        acl.append(pyr_ace2)
-            # If deny, deny all children
-            else:
-                for ch in perms[ace.permission_id]['children']:
-                    pyr_ace2 = (pyr_ace[0], pyr_ace[1], ch['name'])
-                    acl.append(pyr_ace2)
+        acl = pam.compile_acl(self.acl, perms)
+        # Nodes that are not yet flushed have no ID
+        if self.id is not None:
+            pam.compiled_acl_cache.set(key, acl)
         return acl
 
     @classmethod
@@ -446,22 +849,30 @@ class ResourceNode(DbBase, DefaultMixin):
                 cls.name == id_or_name,
             ]
         if use_cache:
+            tags = lookup_cache_tags(id_or_name, parent_id)
             return sess.query(
                 cls
+            ).with_polymorphic(
+                cls.polymorphic_spec()
             ).options(
                 pym.cache.FromCache("auth_long_term",
                     cache_key='resource:{}:{}'.format(
-                        id_or_name, parent_id))
+                        id_or_name, parent_id),
+                    tags=tags + [result_cache_tags],
+                    compact=True, negative_key=tags[0])
             ).options(
                 pym.cache.RelationshipCache(cls.children, "auth_long_term",
                     cache_key='resource:{}:{}:children'.format(
-                        id_or_name, parent_id))
+                        id_or_name, parent_id),
+                    tags=tags, compact=True)
             ).options(
                 pym.cache.RelationshipCache(cls.acl, "auth_long_term",
                     cache_key='resource:{}:{}:acl'.format(
-                        id_or_name, parent_id))
+                        id_or_name, parent_id),
+                    tags=tags, compact=True)
             ).options(
-                pym.cache.RelationshipCache(cls.parent, "auth_long_term")#,
+                pym.cache.RelationshipCache(cls.parent, "auth_long_term",
+                    tags=[result_cache_tags], compact=True)#,
                     #cache_key='presource:{}:{}:parent'.format(
                     #    id_or_name, parent_id))
             ).filter(
@@ -470,10 +881,149 @@ class ResourceNode(DbBase, DefaultMixin):
         else:
             return sess.query(
                 cls
+            ).with_polymorphic(
+                cls.polymorphic_spec()
             ).filter(
                 sa.and_(*fil)
             ).one()
 
+    @classmethod
+    def load_path(cls, sess, parent, names):
+        """
+        Loads the nodes along a path of names in a single query.
+
+        Traversal by :meth:`__getitem__` costs one query per path segment.
+        This method resolves the whole path with one recursive query and links
+        the loaded nodes to each other, so that walking up the lineage via
+        ``__parent__`` does not hit the database again.
+
+        The path is resolved as far as possible: if a segment is not found,
+        the resolution stops there and only the nodes found so far are
+        returned.
+
+        A missing segment is remembered in the negative cache. If the same
+        path is requested again, the nodes found before are loaded with the
+        cached :meth:`load_child` and we do not query for the missing one.
+
+        :param sess: A DB session
+        :param parent: Instance of the node where the path starts.
+        :param names: Sequence of node names, top-most first.
+        :return: List of nodes, top-most first. May be shorter than ``names``
+            or even empty.
+        """
+        names = list(names)
+        if not names:
+            return []
+        lineage = cls._load_path_of_miss(sess, parent, names)
+        if lineage is not None:
+            return lineage
+        t = ResourceNode.__table__
+        a_names = sa.literal(names, ARRAY(sa.Unicode))
+        path = sa.select([
+            t.c.id, sa.literal(1).label('depth')
+        ]).where(
+            sa.and_(t.c.parent_id == parent.id, t.c.name == names[0])
+        ).cte('resource_path', recursive=True)
+        tt = t.alias('tt')
+        path = path.union_all(
+            sa.select([
+                tt.c.id, (path.c.depth + 1).label('depth')
+            ]).where(
+                sa.and_(
+                    tt.c.parent_id == path.c.id,
+                    path.c.depth < len(names),
+                    tt.c.name == a_names[path.c.depth + 1]
+                )
+            )
+        )
+        rs = sess.query(
+            cls, path.c.depth
+        ).with_polymorphic(
+            cls.polymorphic_spec()
+        ).join(
+            path, cls.id == path.c.id
+        ).order_by(
+            path.c.depth
+        )
+        lineage = []
+        for node, depth in rs:
+            # Same as load_child(): a name must be unique within its parent
+            if depth <= len(lineage):
+                raise sa.orm.exc.MultipleResultsFound(
+                    "Multiple nodes named '{}' in parent {}".format(
+                        names[depth - 1], lineage[-1].parent_id
+                        if lineage else parent.id))
+            set_committed_value(node, 'parent',
+                lineage[-1] if lineage else parent)
+            lineage.append(node)
+        if len(lineage) < len(names):
+            i = len(lineage)
+            pym.cache.negative_cache.set_missing(lookup_cache_tags(names[i],
+                lineage[-1].id if lineage else parent.id)[0])
+            _path_misses.set((parent.id, tuple(names[:i + 1])), True)
+        return lineage
+
+    @classmethod
+    def _load_path_of_miss(cls, sess, parent, names):
+        """
+        Returns the lineage of a path whose lookup recently failed, see
+        :meth:`load_path`.
+
+        :return: List of the nodes found, or None if the path did not fail
+            recently.
+        """
+        for i in range(len(names)):
+            if _path_misses.get((parent.id, tuple(names[:i + 1]))):
+                break
+        else:
+            return None
+        lineage = []
+        node = parent
+        try:
+            for name in names[:i]:
+                child = cls.load_child(sess, name, node.id)
+                set_committed_value(child, 'parent', node)
+                lineage.append(child)
+                node = child
+        except sa.orm.exc.NoResultFound:
+            return None
+        if not pym.cache.negative_cache.is_missing(
+                lookup_cache_tags(names[i], node.id)[0]):
+            _path_misses.delete((parent.id, tuple(names[:i + 1])))
+            return None
+        return lineage
+
+    def cache_tags(self):
+        """
+        Returns the cache tags to invalidate if this node changed.
+
+        Includes the tags of the parent, whose set of children may have
+        changed, and the tags of the former name or parent.
+
+        Called during the flush, so it must not query. Tags of nodes that are
+        not loaded are resolved after the flush, see
+        :func:`node_cache_tags_by_id`.
+        """
+        state = sa.inspect(self)
+        sess = state.session
+        id_ = state.dict.get('id') or state.identity[0]
+        names = set(state.attrs._name.history.deleted)
+        parent_ids = set(state.attrs.parent_id.history.deleted)
+        if state.unloaded & {'_name', 'parent_id'}:
+            # Expired, so neither renamed nor moved. Look up both later.
+            _defer_node_cache_tags(sess, id_, with_parent=True)
+        else:
+            names.add(state.dict['_name'])
+            parent_ids.add(state.dict['parent_id'])
+        tags = ['node:{}'.format(id_)]
+        for name in names:
+            for parent_id in parent_ids:
+                tags.append('node-lookup:{}:{}'.format(name, parent_id))
+        for parent_id in parent_ids:
+            if parent_id is not None:
+                tags += node_cache_tags_by_id(sess, parent_id)
+        return tags
+
     def __getitem__(self, item):
         cls = self.__class__
         sess = sa.inspect(self).session
@@ -559,6 +1109,15 @@ class ResourceNode(DbBase, DefaultMixin):
 
     @property
     def root(self):
+        if self.parent_id is None:
+            return self
+        if self.mpath:
+            sess = sa.inspect(self).session
+            if not sess:
+                sess = DbSession()
+            # Looks into the identity map first
+            return sess.query(ResourceNode).get(self.mpath[0])
+        # Not yet flushed, so we have no mpath
         n = self
         while n.parent:
             n = n.parent
@@ -571,11 +1130,201 @@ class ResourceNode(DbBase, DefaultMixin):
         return self.root.__user__
 
 
+def lookup_cache_tags(id_or_name, parent_id):
+    """
+    Returns cache tags for the lookup of a node by ID or by name.
+
+    :meth:`ResourceNode.load_child` caches the node, its children and its ACL
+    under keys built from its arguments. All of them are tagged like this.
+    """
+    if isinstance(id_or_name, int):
+        return ['node:{}'.format(id_or_name)]
+    return ['node-lookup:{}:{}'.format(id_or_name, parent_id)]
+
+
+def result_cache_tags(result):
+    """
+    Returns cache tags for a cached list of nodes.
+    """
+    return ['node:{}'.format(n.id) for n in result]
+
+
+def node_cache_tags(node):
+    """
+    Returns all cache tags under which data of this node may be cached.
+
+    Invalidate these if the node, its ACL or its set of children changed.
+    """
+    return ['node:{}'.format(node.id),
+        'node-lookup:{}:{}'.format(node.name, node.parent_id)]
+
+
+UNRESOLVED_NODES_KEY = 'pym.res.unresolved_nodes'
+"""
+Key in ``session.info`` of the nodes whose cache tags are looked up after the
+flush. Maps node ID to a flag whether to include the tags of its parent.
+"""
+
+
+def node_cache_tags_by_id(sess, id_):
+    """
+    Returns the cache tags of a node, see :func:`node_cache_tags`, without
+    querying.
+
+    The node is taken from the identity map of the session. If it is not
+    loaded there, we return just its ID tag and look up the others after the
+    flush.
+
+    :param sess: A DB session
+    :param id_: ID of the node
+    :return: List of tags
+    """
+    node = sess.identity_map.get(sa.orm.util.identity_key(ResourceNode, id_)) \
+        if sess is not None else None
+    if node is not None \
+            and not sa.inspect(node).unloaded & {'_name', 'parent_id'}:
+        return node_cache_tags(node)
+    _defer_node_cache_tags(sess, id_)
+    return ['node:{}'.format(id_)]
+
+
+def _defer_node_cache_tags(sess, id_, with_parent=False):
+    if sess is None:
+        return
+    unresolved = sess.info.setdefault(UNRESOLVED_NODES_KEY, {})
+    unresolved[id_] = unresolved.get(id_, False) or with_parent
+
+
+def invalidate_resource_cache(sess, nodes, parent_ids=None):
+    """
+    Deletes cached nodes from the cache regions after the transaction is
+    committed.
+
+    Use this after changing nodes with plain SQL, bypassing the ORM. Changes
+    through the ORM are handled by :meth:`ResourceNode.cache_tags`.
+
+    :param sess: A DB session
+    :param nodes: List of 3-tuples (id, name, parent_id)
+    :param parent_ids: Optional. IDs of parents whose cached list of children
+        is to be deleted too.
+    """
+    tags = []
+    for id_, name, parent_id in nodes:
+        tags += ['node:{}'.format(id_),
+            'node-lookup:{}:{}'.format(name, parent_id)]
+    if parent_ids:
+        t = ResourceNode.__table__
+        parent_ids = [x for x in parent_ids if x is not None]
+        if parent_ids:
+            rs = sess.execute(sa.select([t.c.id, t.c.name, t.c.parent_id])
+                .where(t.c.id.in_(parent_ids)))
+            for id_, name, parent_id in rs:
+                tags += ['node:{}'.format(id_),
+                    'node-lookup:{}:{}'.format(name, parent_id)]
+    sess.info.setdefault(CACHE_TAGS_KEY, set()).update(tags)
+
+
+_ifaces = {}
+_provides_specs = {}
+
+
+def resolve_iface(name):
+    """
+    Resolves the dotted name of an interface.
+
+    Each name is resolved only once per process.
+
+    :param name: Dotted Python name, e.g. 'pym.res:IRes'
+    :return: The interface
+    """
+    try:
+        return _ifaces[name]
+    except KeyError:
+        iface = pyramid.util.DottedNameResolver(None).resolve(name)
+        _ifaces[name] = iface
+        return iface
+
+
+def get_provides_spec(cls, name):
+    """
+    Returns the declaration that instances of ``cls`` directly provide
+    interface ``name``.
+
+    The spec is built only once per class and interface. Assign it to the
+    instance's ``__provides__``, as :func:`zope.interface.directlyProvides`
+    would do.
+
+    :param cls: Class of the instance
+    :param name: Dotted Python name of the interface
+    :return: Instance of :class:`zope.interface.declarations.Provides`
+    """
+    key = (cls, name)
+    try:
+        return _provides_specs[key]
+    except KeyError:
+        spec = zope.interface.declarations.Provides(cls, resolve_iface(name))
+        _provides_specs[key] = spec
+        return spec
+
+
 # When we load a node from DB attach the stored interface to the instance.
+# A freshly loaded instance provides nothing directly yet, so we may set the
+# precomputed spec instead of calling alsoProvides().
 # noinspection PyUnusedLocal
 def resource_node_load_listener(target, context):
     if target.iface:
-        iface = pyramid.util.DottedNameResolver(None).resolve(target.iface)
-        zope.interface.alsoProvides(target, iface)
+        target.__provides__ = get_provides_spec(target.__class__, target.iface)
 
 sa.event.listen(ResourceNode, 'load', resource_node_load_listener)
+
+
+sa.Index('resource_tree_children_ix', ResourceNode.__table__.c.parent_id,
+    sa.func.coalesce(ResourceNode.__table__.c.sortix, DEFAULT_SORTIX),
+    ResourceNode.__table__.c.name, ResourceNode.__table__.c.id)
+sa.Index('resource_tree_mpath_ix', ResourceNode.__table__.c.mpath,
+    postgresql_using='gin')
+
+
+# The DB trigger updates mpath of all descendants of a moved node. Expire those
+# we hold in the session, so they get reloaded on next access.
+# noinspection PyUnusedLocal
+def resource_node_after_flush_listener(session, flush_context):
+    moved = set()
+    for o in session.dirty:
+        if isinstance(o, ResourceNode) \
+                and sa.inspect(o).attrs.parent_id.history.has_changes():
+            moved.add(o.id)
+    if not moved:
+        return
+    for o in list(session.identity_map.values()):
+        if not isinstance(o, ResourceNode):
+            continue
+        mpath = sa.inspect(o).dict.get('mpath')
+        if mpath and moved.intersection(mpath):
+            session.expire(o, ['mpath'])
+
+sa.event.listen(sa.orm.Session, 'after_flush',
+    resource_node_after_flush_listener)
+
+
+# The after_flush listeners must not query, so cache_tags() only noted the
+# nodes that were not loaded. Look up their tags now, still within the
+# transaction. Deleted rows are gone by now, their ID tag has to do.
+# noinspection PyUnusedLocal
+def resource_node_after_flush_postexec_listener(session, flush_context):
+    unresolved = session.info.pop(UNRESOLVED_NODES_KEY, None)
+    if not unresolved:
+        return
+    t = ResourceNode.__table__
+    rs = session.execute(sa.select([t.c.id, t.c.name, t.c.parent_id])
+        .where(t.c.id.in_(list(unresolved.keys()))))
+    nodes = []
+    parent_ids = set()
+    for id_, name, parent_id in rs:
+        nodes.append((id_, name, parent_id))
+        if unresolved[id_]:
+            parent_ids.add(parent_id)
+    invalidate_resource_cache(session, nodes, parent_ids=parent_ids)
+
+sa.event.listen(sa.orm.Session, 'after_flush_postexec',
+    resource_node_after_flush_postexec_listener)
@@ -4,6 +4,142 @@ from .models import ResourceNode
 from .const import *
 
 
+# Maintains the materialized path of a node (column ``mpath``) on insert and
+# when it is moved to another parent. Refuses to move a node below itself.
+# If the parent has no path yet, e.g. in a tree created before this trigger,
+# its path is computed from the parent IDs.
+SQL_FUNC_RESOURCE_TREE_MPATH = """
+CREATE OR REPLACE FUNCTION pym.resource_tree_mpath() RETURNS TRIGGER AS
+$$
+DECLARE
+    parent_mpath INTEGER[];
+BEGIN
+    IF TG_OP = 'UPDATE' AND NEW.parent_id IS NOT DISTINCT FROM OLD.parent_id
+    THEN
+        RETURN NEW;
+    END IF;
+    IF NEW.parent_id IS NULL THEN
+        NEW.mpath := ARRAY [NEW.id];
+    ELSE
+        SELECT mpath INTO parent_mpath
+        FROM pym.resource_tree
+        WHERE id = NEW.parent_id;
+        IF parent_mpath IS NULL THEN
+            WITH RECURSIVE a (id, parent_id, depth) AS
+            (
+                SELECT id, parent_id, 0
+                FROM pym.resource_tree
+                WHERE id = NEW.parent_id
+
+                UNION ALL
+
+                SELECT p.id, p.parent_id, a.depth + 1
+                FROM pym.resource_tree AS p
+                JOIN a ON p.id = a.parent_id
+            )
+            SELECT array_agg(id ORDER BY depth DESC) INTO parent_mpath
+            FROM a;
+        END IF;
+        IF NEW.id = ANY (parent_mpath) THEN
+            RAISE EXCEPTION 'Cannot move resource % below itself', NEW.id;
+        END IF;
+        NEW.mpath := parent_mpath || NEW.id;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+# After a node was moved, replace the old path prefix of all its descendants.
+# If the node had no path, its descendants may lack it as well, and we compute
+# theirs from scratch.
+SQL_FUNC_RESOURCE_TREE_MPATH_MOVE = """
+CREATE OR REPLACE FUNCTION pym.resource_tree_mpath_move() RETURNS TRIGGER AS
+$$
+BEGIN
+    IF NEW.mpath IS DISTINCT FROM OLD.mpath THEN
+        IF OLD.mpath IS NULL THEN
+            WITH RECURSIVE t (id, mpath) AS
+            (
+                SELECT id, NEW.mpath || id
+                FROM pym.resource_tree
+                WHERE parent_id = NEW.id
+
+                UNION ALL
+
+                SELECT c.id, t.mpath || c.id
+                FROM pym.resource_tree AS c
+                JOIN t ON c.parent_id = t.id
+            )
+            UPDATE pym.resource_tree AS rt
+            SET mpath = t.mpath
+            FROM t
+            WHERE rt.id = t.id;
+        ELSE
+            UPDATE pym.resource_tree
+            SET mpath = NEW.mpath
+                || mpath [array_length(OLD.mpath, 1) + 1 : array_length(mpath, 1)]
+            WHERE mpath @> ARRAY [NEW.id]
+            AND id <> NEW.id;
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+SQL_TRIGGERS_RESOURCE_TREE_MPATH = [
+    "DROP TRIGGER IF EXISTS resource_tree_mpath_trg ON pym.resource_tree",
+    """
+    CREATE TRIGGER resource_tree_mpath_trg
+    BEFORE INSERT OR UPDATE OF parent_id ON pym.resource_tree
+    FOR EACH ROW EXECUTE PROCEDURE pym.resource_tree_mpath()
+    """,
+    "DROP TRIGGER IF EXISTS resource_tree_mpath_move_trg ON pym.resource_tree",
+    """
+    CREATE TRIGGER resource_tree_mpath_move_trg
+    AFTER UPDATE OF parent_id ON pym.resource_tree
+    FOR EACH ROW EXECUTE PROCEDURE pym.resource_tree_mpath_move()
+    """
+]
+
+# Computes the materialized path of all nodes from scratch. Use this to
+# populate ``mpath`` of an existing tree.
+SQL_REBUILD_RESOURCE_TREE_MPATH = """
+WITH RECURSIVE t (id, mpath) AS
+(
+    SELECT id, ARRAY [id]
+    FROM pym.resource_tree
+    WHERE parent_id IS NULL
+
+    UNION ALL
+
+    SELECT c.id, t.mpath || c.id
+    FROM pym.resource_tree AS c
+    JOIN t ON c.parent_id = t.id
+)
+UPDATE pym.resource_tree AS rt
+SET mpath = t.mpath
+FROM t
+WHERE rt.id = t.id
+AND rt.mpath IS DISTINCT FROM t.mpath
+"""
+
+
+def create_triggers(sess):
+    sess.execute(SQL_FUNC_RESOURCE_TREE_MPATH)
+    sess.execute(SQL_FUNC_RESOURCE_TREE_MPATH_MOVE)
+    for sql in SQL_TRIGGERS_RESOURCE_TREE_MPATH:
+        sess.execute(sql)
+
+
+def rebuild_mpath(sess):
+    """
+    Rebuilds the materialized path of all resource nodes.
+    """
+    sess.execute(SQL_REBUILD_RESOURCE_TREE_MPATH)
+
+
 def setup_resources(sess):
     n_root = ResourceNode.create_root(sess=sess, owner=SYSTEM_UID, kind="res",
         name=NODE_NAME_ROOT, title='Root',
@@ -27,6 +163,7 @@ def setup_acl(sess, n_root):
 
 def setup(sess, schema_only=False):
     #create_views(sess)
+    create_triggers(sess)
     if not schema_only:
         n_root = setup_resources(sess)
         setup_acl(sess, n_root)
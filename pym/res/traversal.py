@@ -0,0 +1,77 @@
+from pyramid.exceptions import URLDecodeError
+from pyramid.traversal import (ResourceTreeTraverser, split_path_info,
+    VH_ROOT_KEY)
+import sqlalchemy as sa
+
+from pym.models import DbSession
+from .models import ResourceNode
+
+
+class ResourceNodeTraverser(ResourceTreeTraverser):
+    """
+    Traverser for a tree of :class:`~pym.res.models.ResourceNode`.
+
+    Pyramid's default traverser calls ``__getitem__`` for every segment of
+    the path, i.e. a URL with 6 levels costs 6 queries. We instead resolve
+    all segments up to the first view selector in one query with
+    :meth:`~pym.res.models.ResourceNode.load_path` and hand Pyramid the
+    pre-linked lineage.
+
+    Requests matched by a route or using a virtual root are handled by the
+    default traverser.
+
+    Register with::
+
+        config.add_traverser(ResourceNodeTraverser, ResourceNode)
+    """
+
+    def __call__(self, request):
+        if request.matchdict is not None \
+                or VH_ROOT_KEY in request.environ:
+            return super().__call__(request)
+
+        root = self.root
+        try:
+            # empty if mounted under a path in mod_wsgi, for example
+            path = request.path_info or '/'
+        except KeyError:
+            # if environ['PATH_INFO'] is just not there
+            path = '/'
+        except UnicodeDecodeError as e:
+            raise URLDecodeError(e.encoding, e.object, e.start, e.end,
+                e.reason)
+        vpath_tuple = () if path == '/' else split_path_info(path)
+        names = []
+        for segment in vpath_tuple:
+            if segment[:2] == self.VIEW_SELECTOR:
+                break
+            names.append(segment)
+
+        if names:
+            sess = sa.inspect(root).session
+            if not sess:
+                sess = DbSession()
+            lineage = ResourceNode.load_path(sess, root, names)
+        else:
+            lineage = []
+
+        i = len(lineage)
+        ob = lineage[-1] if lineage else root
+        if i == len(vpath_tuple):
+            return {'context': ob,
+                    'view_name': '',
+                    'subpath': (),
+                    'traversed': vpath_tuple,
+                    'virtual_root': root,
+                    'virtual_root_path': (),
+                    'root': root}
+        segment = vpath_tuple[i]
+        if segment[:2] == self.VIEW_SELECTOR:
+            segment = segment[2:]
+        return {'context': ob,
+                'view_name': segment,
+                'subpath': vpath_tuple[i + 1:],
+                'traversed': vpath_tuple[:i],
+                'virtual_root': root,
+                'virtual_root_path': (),
+                'root': root}
@@ -18,6 +18,7 @@ The sub-commands are::
     list-rolemembers    List rolemembers
     create-rolemember      Create rolemember
     delete-rolemember   Delete rolemember with given ID
+    warm-cache          Preload the cache regions
 
 Type ``pym -h`` for general help and a list of the sub-commands,
 ``pym sub-command -h`` to get help for that sub-command.
@@ -215,6 +216,15 @@ class PymCli(pym.cli.Cli):
     def delete_group_member(self):
         authmgr.delete_group_member(self.args.id)
 
+    def warm_cache(self):
+        import pym.warmup
+        pym.warmup.warm_up(self._sess,
+            root_name=self.args.root,
+            max_depth=self.args.depth,
+            users_since_days=self.args.users_since,
+            batch_size=self.args.batch_size,
+            lgg=self.lgg)
+
     def _build_query(self, entity):
         sess = pym.models.DbSession()
         if isinstance(entity, list):
@@ -361,6 +371,20 @@ def parse_args(app_class, runner):
         help="Delete group-member with given ID")
     parser_delete_group_member.set_defaults(func=runner.delete_group_member)
 
+    # Parser cmd warm-cache
+    parser_warm_cache = subparsers.add_parser('warm-cache',
+        help="Preload the cache regions, e.g. after a deploy")
+    parser_warm_cache.add_argument('--root', default='root',
+        help="Name of the root node, default 'root'")
+    parser_warm_cache.add_argument('--depth', type=int, default=2,
+        help="Preload this many levels of the resource tree, default 2")
+    parser_warm_cache.add_argument('--users-since', type=int, default=30,
+        help="Preload groups of users that logged in within this many days,"
+            " default 30")
+    parser_warm_cache.add_argument('--batch-size', type=int, default=500,
+        help="Number of nodes or users per batch, default 500")
+    parser_warm_cache.set_defaults(func=runner.warm_cache)
+
     return parser.parse_args()
 
 
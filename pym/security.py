@@ -1,5 +1,9 @@
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 import os
 import logging
+import multiprocessing
+import threading
 
 import passlib.context
 import pyramid.security
@@ -9,6 +13,7 @@ from pyramid.httpexceptions import HTTPForbidden, HTTPNotFound
 from pyramid.view import forbidden_view_config, notfound_view_config
 from pyramid.events import subscriber, NewRequest
 import pym.i18n
+import pym.exc
 import Crypto
 
 
@@ -65,6 +70,149 @@ pwd_context = passlib.context.CryptContext(
 )
 
 
+KEEP_SCHEMES = ('ldap_salted_sha1', 'ldap_plaintext')
+"""Schemes whose hashes are not replaced on login, because Dovecot reads
+them."""
+
+
+def configure_pwd_context(scheme, rounds=None, keep_schemes=KEEP_SCHEMES):
+    """
+    Sets the scheme and rounds of new password hashes.
+
+    Hashes of other schemes, or with fewer rounds, are then marked as
+    deprecated, so that :meth:`PasswordVerifier.verify_and_update` replaces
+    them on the next successful login.
+
+    :param scheme: Name of the scheme, e.g. 'pbkdf2_sha512'
+    :param rounds: Optional. Number of rounds, if the scheme has them.
+    :param keep_schemes: Optional. Schemes that are not deprecated, default
+        :data:`KEEP_SCHEMES`.
+    """
+    deprecated = [x for x in pwd_context.schemes()
+        if x != scheme and x not in keep_schemes]
+    kw = {'default': scheme, 'deprecated': deprecated}
+    if rounds:
+        kw[scheme + '__default_rounds'] = rounds
+        kw[scheme + '__min_rounds'] = rounds
+    pwd_context.update(**kw)
+
+
+_worker_contexts = {}
+
+
+def _verify_and_update(config, secret, hash_):
+    """
+    Runs in a worker process of :class:`PasswordVerifier`.
+    """
+    try:
+        ctx = _worker_contexts[config]
+    except KeyError:
+        ctx = _worker_contexts[config] = \
+            passlib.context.CryptContext.from_string(config)
+    return ctx.verify_and_update(secret, hash_)
+
+
+class PasswordVerifier(object):
+    """
+    Verifies passwords in a pool of worker processes.
+
+    Key derivation with many rounds occupies a CPU for a while. Done on the
+    request thread, a burst of logins blocks all threads of a WSGI worker, and
+    because of the GIL other threads cannot step in. The pool keeps this off
+    the request threads and bounds the CPU spent on it.
+
+    At most ``max_pending`` verifications may be queued or running, further
+    ones fail immediately, as do verifications that take longer than
+    ``timeout`` seconds. Both raise :class:`pym.exc.AuthBusyError`.
+
+    With ``max_workers`` 0, passwords are verified on the calling thread.
+
+    Workers are started by a fork server, or spawned where that is not
+    available. Forking the threaded WSGI process itself could copy locks that
+    other threads hold at that moment into the worker.
+    """
+
+    def __init__(self, max_workers=2, max_pending=20, timeout=10):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def configure(self, max_workers=None, max_pending=None, timeout=None):
+        """
+        Changes the settings. The pool is restarted on its next use.
+        """
+        with self._lock:
+            if max_workers is not None:
+                self.max_workers = max_workers
+            if max_pending is not None:
+                self.max_pending = max_pending
+                self._pending = threading.BoundedSemaphore(max_pending)
+            if timeout is not None:
+                self.timeout = timeout
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _get_executor(self):
+        # Worker processes belong to the process that started them
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                methods = multiprocessing.get_all_start_methods()
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context(
+                        'forkserver' if 'forkserver' in methods
+                        else 'spawn'))
+                self._pid = os.getpid()
+            return self._executor
+
+    def verify_and_update(self, secret, hash_):
+        """
+        Verifies a password against its hash.
+
+        :param secret: The password
+        :param hash_: The stored hash
+        :return: 2-tuple (ok, new_hash). ``new_hash`` is None, unless the
+            password is correct and its hash should be replaced, because it
+            does not use the configured scheme and rounds, see
+            :func:`configure_pwd_context`.
+        :raises pym.exc.AuthBusyError: If too many verifications are pending
+            or if it took too long.
+        """
+        if not self.max_workers:
+            return pwd_context.verify_and_update(secret, hash_)
+        pending = self._pending
+        if not pending.acquire(blocking=False):
+            mlgg.warning("Too many pending password verifications")
+            raise pym.exc.AuthBusyError("Too many logins, try again later")
+        try:
+            fut = self._get_executor().submit(_verify_and_update,
+                pwd_context.to_string(), secret, hash_)
+        except Exception:
+            pending.release()
+            raise
+        # Release when done, not on timeout: the worker is still busy then.
+        fut.add_done_callback(lambda f: pending.release())
+        try:
+            return fut.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            mlgg.warning("Password verification timed out")
+            raise pym.exc.AuthBusyError("Too many logins, try again later")
+        except BrokenProcessPool:
+            mlgg.exception("Password verification pool failed, restarting")
+            with self._lock:
+                self._executor = None
+            raise pym.exc.AuthBusyError("Too many logins, try again later")
+
+
+pwd_verifier = PasswordVerifier()
+"""Verifier used by the login functions of :mod:`pym.auth.manager`."""
+
+
 # ====================================================
 #   Views
 # ====================================================
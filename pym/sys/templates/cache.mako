@@ -0,0 +1,44 @@
+<%!
+    import datetime
+%>
+<%inherit file="pym:templates/_layouts/sys.mako" />
+<%block name="meta_title">Cache Statistics</%block>
+<%block name="styles">
+${parent.styles()}
+</%block>
+<%block name="scripts">
+${parent.scripts()}
+</%block>
+<%def name="sec(v)">${'' if v is None else '{:.1f}'.format(v * 1000)}</%def>
+
+<div class="outer-gutter">
+% if not enabled:
+<p>Recording is disabled, see setting <code>cache.stats</code>.</p>
+% endif
+<p>Numbers of this process since ${datetime.datetime.fromtimestamp(since).strftime('%Y-%m-%d %H:%M:%S')}.
+    Times in ms, sizes in bytes. As JSON: <a href="${request.resource_url(request.context, '@@cache_stats')}">cache_stats</a></p>
+<table>
+    <thead>
+        <tr><th>Region</th><th>Prefix</th><th>Hits</th><th>Misses</th><th>Hit Ratio</th>
+            <th>Creates</th><th>Avg Create</th><th>Sets</th><th>Avg Size</th>
+            <th>Lock Waits</th><th>Avg Lock Wait</th></tr>
+    </thead>
+    <tbody>
+    % for r in rows:
+        <tr>
+            <td>${r['region']}</td>
+            <td>${r['prefix']}</td>
+            <td>${r['hits']}</td>
+            <td>${r['misses']}</td>
+            <td>${'' if r['hit_ratio'] is None else '{:.1%}'.format(r['hit_ratio'])}</td>
+            <td>${r['creates']}</td>
+            <td>${sec(r['avg_create_time'])}</td>
+            <td>${r['sets']}</td>
+            <td>${'' if r['avg_size'] is None else '{:.0f}'.format(r['avg_size'])}</td>
+            <td>${r['lock_waits']}</td>
+            <td>${sec(r['avg_lock_wait_time'])}</td>
+        </tr>
+    % endfor
+    </tbody>
+</table>
+</div>
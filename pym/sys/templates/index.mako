@@ -13,5 +13,7 @@ ${parent.scripts()}
 <div class="outer-gutter">
 <ul>
     <li><a href="${request.resource_url(request.context[NODE_NAME_SYS_AUTH_MGR])}">Authentication Manager</a></li>
+    <li><a href="${request.resource_url(request.context, '@@tree')}">Resource Tree</a></li>
+    <li><a href="${request.resource_url(request.context, '@@cache')}">Cache Statistics</a></li>
 </ul>
 </div>
@@ -0,0 +1,28 @@
+<%inherit file="pym:templates/_layouts/sys.mako" />
+<%block name="meta_title">Resource Tree</%block>
+<%block name="styles">
+${parent.styles()}
+</%block>
+<%block name="scripts">
+${parent.scripts()}
+</%block>
+
+<div class="outer-gutter">
+<p>Showing ${max_depth} levels.</p>
+<table>
+    <thead>
+        <tr><th>Name</th><th>Title</th><th>Kind</th><th>ID</th><th>Sortix</th></tr>
+    </thead>
+    <tbody>
+    % for depth, node in rows:
+        <tr>
+            <td style="padding-left: ${depth * 1.5}em;">${node.name}</td>
+            <td>${node.title}</td>
+            <td>${node.kind}</td>
+            <td>${node.id}</td>
+            <td>${node.sortix}</td>
+        </tr>
+    % endfor
+    </tbody>
+</table>
+</div>
@@ -2,7 +2,10 @@
 
 from pyramid.view import view_config
 import logging
+import os
+import sqlalchemy as sa
 
+import pym.cache
 import pym.res.models
 
 L = logging.getLogger('Pym')
@@ -18,3 +21,62 @@ def index(context, request):
     return dict()
 
 
+@view_config(
+    name='tree',
+    context=pym.res.models.ISystemNode,
+    renderer='pym:sys/templates/tree.mako',
+    permission='admin'
+)
+def tree(context, request):
+    try:
+        max_depth = int(request.GET.get('depth', 3))
+    except ValueError:
+        max_depth = 3
+    root = context.root
+    sess = sa.inspect(context).session
+    nodes = root.load_subtree(sess, max_depth=max_depth)
+    # Flatten the tree in display order
+    children = {}
+    for n in nodes:
+        children.setdefault(n.parent_id, []).append(n)
+    rows = []
+
+    def walk(node, depth):
+        rows.append((depth, node))
+        for ch in children.get(node.id, []):
+            walk(ch, depth + 1)
+
+    walk(root, 0)
+    return dict(rows=rows, max_depth=max_depth)
+
+
+@view_config(
+    name='cache',
+    context=pym.res.models.ISystemNode,
+    renderer='pym:sys/templates/cache.mako',
+    permission='admin'
+)
+def cache(context, request):
+    stats = pym.cache.cache_stats
+    return dict(rows=stats.snapshot(), since=stats.since,
+        enabled=stats.enabled)
+
+
+@view_config(
+    name='cache_stats',
+    context=pym.res.models.ISystemNode,
+    renderer='json',
+    permission='admin'
+)
+def cache_stats(context, request):
+    """
+    Returns the cache statistics of the process that serves the request.
+
+    Send POST with ``reset=1`` to set them to zero afterwards.
+    """
+    stats = pym.cache.cache_stats
+    resp = dict(pid=os.getpid(), since=stats.since, enabled=stats.enabled,
+        rows=stats.snapshot())
+    if request.method == 'POST' and request.POST.get('reset'):
+        stats.reset()
+    return resp
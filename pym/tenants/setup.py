@@ -10,7 +10,9 @@ from . import manager as tmgr
 
 def setup_resources(sess):
     n_root = ResourceNode.load_root(sess, name=NODE_NAME_ROOT, use_cache=False)
-    n_sys_auth = n_root[NODE_NAME_SYS][NODE_NAME_SYS_AUTH_MGR]
+    # Links the top levels of the tree, so we need no further queries
+    n_root.load_subtree(sess, max_depth=2)
+    n_sys_auth = n_root.children[NODE_NAME_SYS].children[NODE_NAME_SYS_AUTH_MGR]
 
     n_sys_auth.add_child(
         sess=sess, owner=SYSTEM_UID,
@@ -77,6 +77,37 @@ def create_unit_tester(lgg, sess):
     return p
 
 
+class StatementCounter(object):
+    """
+    Counts the SQL statements an engine executes, e.g. to check that cached
+    data is served without querying the DB::
+
+        with StatementCounter(pym.models.DbEngine) as counter:
+            node.children
+        assert counter.count == 0
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    # noinspection PyUnusedLocal
+    def _listener(self, conn, cursor, statement, parameters, context,
+            executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        sa.event.listen(self.engine, 'before_cursor_execute', self._listener)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        sa.event.remove(self.engine, 'before_cursor_execute', self._listener)
+
+
 # noinspection PyUnusedLocal
 class BaseMock(object):
 
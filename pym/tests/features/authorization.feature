@@ -0,0 +1,12 @@
+Feature: Authorization
+  Test that the bitmask authorization policy decides like the ACL policy
+
+
+  Scenario: bitmask and ACL policy decide the same
+      Given a resource tree "authz"/"unittest" with ACEs on each level
+      Then the bitmask policy decides like the ACL policy
+
+
+  Scenario: unknown permissions are not granted by other permissions
+      Given a resource tree "authz"/"unittest" with ACEs on each level
+      Then permission "frobnicate" is denied to the users group
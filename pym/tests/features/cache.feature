@@ -0,0 +1,106 @@
+Feature: Cache
+  Test keys, prefetching and invalidation of cached queries
+
+
+  Scenario: prefetched values are dropped at the end of the transaction
+      Given a value is prefetched into my session
+      When I roll back the transaction
+      Then the prefetched values are gone
+
+
+  Scenario: prefetched values are dropped when the session is closed
+      Given a value is prefetched into my session
+      When I close the session
+      Then the prefetched values are gone
+
+
+  Scenario: prefetched values are not served after an invalidation
+      Given a value is prefetched into my session
+      When a key of its region is deleted
+      Then the prefetched value is not served
+
+
+  Scenario: rolling back a savepoint drops only the cache tags collected in it
+      Given the cache tag "test:outer" is collected
+      And the ACLs were marked as changed
+      When I begin a savepoint
+      And I collect the cache tag "test:inner"
+      And I roll back the savepoint
+      Then the collected cache tags are "test:outer"
+      And the ACLs are marked as changed
+
+
+  Scenario: a released savepoint keeps its cache tags until the rollback
+      Given the cache tag "test:outer" is collected
+      When I begin a savepoint
+      And I collect the cache tag "test:inner"
+      And I release the savepoint
+      Then the collected cache tags are "test:outer/test:inner"
+      When I roll back the transaction
+      Then the collected cache tags are ""
+
+
+  Scenario: identical queries built separately have the same cache key shape
+      Given I build a query for the user "foo" twice
+      Then both queries have the same shape and cache key
+
+
+  Scenario: filters on the same column of joined tables have different cache keys
+      Given I build queries that filter by column "id" of either joined table
+      Then the queries have different cache keys
+
+
+  Scenario: filters on the same column of two entities have different cache keys
+      Given I build queries for two entities that filter by column "id" of either
+      Then the queries have different cache keys
+
+
+  Scenario: filters on the same column of two aliases have different cache keys
+      Given I build queries that filter by column "id" of either of two aliases
+      Then the queries have different cache keys
+
+
+  Scenario: a background refresh does not store values that should not be cached
+      Given a cached value that is refreshed in the background
+      When the refresh creates an empty value
+      Then the refreshed value is not stored
+
+
+  Scenario: cache tags of a parent that is not loaded are collected without loading it
+      Given a resource tree "tags"/"unittest" with ACEs on each level
+      When I change a node whose parent is expired
+      Then the tags of the parent are collected and the parent stays expired
+
+
+  Scenario: relationships of a node from a compact cache hit are loaded from the cache
+      Given a resource tree "compact"/"unittest" with ACEs on each level
+      And the child "a" and its children are cached
+      When I load the child "a" from the cache in a fresh session
+      Then its children are loaded without querying the DB
+
+
+  Scenario: a warm lookup of a node and its relationships needs no query
+      Given a resource tree "warm"/"unittest" with ACEs on each level
+      And the child "a", its children and its ACL are cached
+      When I load the child "a" from the cache in a fresh session
+      Then its relationships are served from the prefetched values
+
+
+  Scenario: values that should not be cached are not tagged
+      Given a creator whose values are tagged when they are stored
+      When the creator returns an empty value that should not be cached
+      Then the value is neither stored nor tagged
+      When the creator returns a value that should be cached
+      Then the value is tagged after it was stored
+
+
+  Scenario: a full LRU cache reports the entries it discards
+      Given an LRU cache for 2 entries
+      When I set the keys "a", "b" and "c"
+      Then the entry "a" was discarded and reported
+
+
+  Scenario: readers of an in-process cache get their own copy
+      Given an in-process cache backend with the value "a" in a list
+      When I append "b" to the list I got from it
+      Then the backend still has the value "a" in a list
@@ -0,0 +1,36 @@
+Feature: Current user
+  Test the snapshot of the current user in the session
+
+
+  Scenario: the current user is restored from its snapshot
+      Given the unit tester has a snapshot in the session
+      Then the current user is restored from the snapshot
+
+
+  Scenario: the preferred locale is restored from the snapshot
+      Given the unit tester has a snapshot with the preferred locale "de"
+      Then the current user is restored with the preferred locale "de"
+
+
+  Scenario: a snapshot of another format is rejected
+      Given the unit tester has a snapshot in the session
+      When the snapshot has format 0
+      Then the current user is not restored from the snapshot
+
+
+  Scenario: a snapshot with other versions is rejected
+      Given the unit tester has a snapshot in the session
+      When the versions of the snapshot do not match
+      Then the current user is not restored from the snapshot
+
+
+  Scenario: changing the user invalidates the snapshot
+      Given the unit tester has a snapshot in the session
+      When the user version of the unit tester is bumped
+      Then the current user is not restored from the snapshot
+
+
+  Scenario: changing group memberships invalidates the snapshot
+      Given the unit tester has a snapshot in the session
+      When the group version is bumped
+      Then the current user is not restored from the snapshot
@@ -0,0 +1,24 @@
+Feature: Listing directories of the DB filesystem
+
+  Scenario: a mixed listing is loaded with the subclass columns in one query
+      Given a directory "docs" with the files "a.txt/b.txt" and the nodes "x/y"
+      When I list the children of "docs"
+      Then it took 1 query
+      And I get the files "a.txt/b.txt" and the nodes "x/y"
+      And the content of the files is not loaded
+
+
+  Scenario: a directory lists only its files
+      Given a directory "docs" with the files "a.txt/b.txt" and the nodes "x/y"
+      When I list the directory "docs"
+      Then it took 1 query
+      And I get the files "a.txt/b.txt" and the nodes ""
+      And the content of the files is not loaded
+
+
+  Scenario: a child is loaded with its subclass columns in one query
+      Given a directory "docs" with the files "a.txt/b.txt" and the nodes "x/y"
+      When I load the child "b.txt" of "docs"
+      Then it took 1 query
+      And I get the files "b.txt" and the nodes ""
+      And the content of the files is not loaded
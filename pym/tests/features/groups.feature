@@ -0,0 +1,32 @@
+Feature: Group memberships
+  Nested groups are resolved with one recursive query.
+
+
+  Scenario: nested groups are resolved, even if they form a cycle
+      Given a user "nested" in group "g1"
+      And group "g1" is member of group "g2"
+      And group "g2" is member of group "g3"
+      And group "g3" is member of group "g1"
+      When I load the groups of user "nested"
+      Then it took 1 query
+      And the user is member of the groups "g1/g2/g3"
+
+
+  Scenario: the groups of a user are cached until the group version changes
+      Given a user "cached" in group "h1"
+      And group "h1" is member of group "h2"
+      And the groups of user "cached" are cached
+      And group "h2" is member of group "h4"
+      When I load all groups of user "cached"
+      Then it took 0 query
+      And the user is member of the groups "h1/h2"
+      When the group version is bumped
+      And I load all groups of user "cached"
+      Then the user is member of the groups "h1/h2/h4"
+
+
+  Scenario: a user is wheel via a nested group
+      Given a user "wheeled" in group "w1"
+      And group "w1" is member of group "wheel"
+      When the group version is bumped
+      Then the current user "wheeled" is wheel
@@ -17,4 +17,129 @@ Feature: Resource Tree
   Scenario: create existing root node with different kind
       Given root node "root"/"unittest" already exists
       When I create a new root node with this name but different kind
-      Then a ValueError exception is thrown
\ No newline at end of file
+      Then a ValueError exception is thrown
+
+
+  Scenario: a path that was not found is answered from the negative cache
+      Given a resource tree "probe"/"unittest" with ACEs on each level
+      And the path "a/missing" was not found twice
+      When I load the path "a/missing"
+      Then I get the lineage "a" without querying the DB
+
+
+  Scenario: a path that was not found is found once the node is created
+      Given a resource tree "probe"/"unittest" with ACEs on each level
+      And the path "a/missing" was not found twice
+      When I create the node "missing" below "a" and its cache is invalidated
+      And I load the path "a/missing"
+      Then I get the lineage "a/missing"
+
+
+  Scenario Outline: depth and ancestors are taken from the materialized path
+      Given a resource tree "mpath"/"unittest" with ACEs on each level
+      And the materialized paths are <state>
+      Then node "b" has depth 2 and the ancestors "mpath/a"
+      And node "b" is a descendant of "a"
+
+    Examples:
+      | state   |
+      | kept    |
+      | cleared |
+
+
+  Scenario Outline: a moved subtree gets new materialized paths
+      Given a resource tree "mpath"/"unittest" with ACEs on each level
+      And a node "c" below "mpath"
+      And the materialized paths are <state>
+      When I move node "a" below "c"
+      Then node "b" has depth 3 and the ancestors "mpath/c/a"
+      And the materialized path of node "b" is "mpath/c/a/b"
+
+    Examples:
+      | state   |
+      | kept    |
+      | cleared |
+
+
+  Scenario: a node cannot be moved below itself
+      Given a resource tree "mpath"/"unittest" with ACEs on each level
+      Then moving node "a" below "b" raises a PymError
+      And moving node "a" below "a" raises a PymError
+
+
+  Scenario: moving a subtree invalidates the cached nodes and parents
+      Given a resource tree "mpath"/"unittest" with ACEs on each level
+      And a node "c" below "mpath"
+      When I move node "a" below "c"
+      Then the cache tags of the nodes "a/mpath/c" are collected
+      And the lookup of "a" below "c" is invalidated
+
+
+  Scenario: deleting a subtree invalidates the cache and syncs the session
+      Given a resource tree "mpath"/"unittest" with ACEs on each level
+      When I delete the subtree of node "a"
+      Then the cache tags of the nodes "a/b/mpath" are collected
+      And the nodes "a/b" and their ACEs are no longer in the session
+      And the ACLs are marked as changed
+
+
+  Scenario Outline: a deleted subtree is gone
+      Given a resource tree "mpath"/"unittest" with ACEs on each level
+      And the materialized paths are <state>
+      When I delete the subtree of node "a"
+      Then the nodes "a/b" are gone
+      And node "mpath" is still there
+
+    Examples:
+      | state   |
+      | kept    |
+      | cleared |
+
+
+  Scenario: nested specs are built from paths
+      When I build a spec from the paths "x/y/z, x/v, w"
+      Then the spec has the nodes "x(y(z), v), w"
+
+
+  Scenario: a tree is created in bulk
+      Given a resource tree "bulk"/"unittest" with ACEs on each level
+      When I create the nodes "x/y/z, x/v, w" in bulk below "b", readable by the users group
+      Then the nodes were created below "b" with the returned IDs
+      And the new IDs are taken from the sequence in order
+      And the materialized path of each new node ends with its parent's
+      And each new node allows "read" to the users group
+      And the cache tags of the new nodes and of "b" are collected
+      And the bulk creation took at most 10 queries
+
+
+  Scenario: a subtree is loaded in a single query and linked in memory
+      Given a resource tree "sub"/"unittest" with ACEs on each level
+      And a node "c" below "sub"
+      And a node "d" below "a"
+      When I load the subtree of "sub"
+      Then I get the nodes "a, c, b, d"
+      And it took 1 query
+      And the children of each loaded node are known without a query
+
+
+  Scenario: a subtree is loaded down to a max depth
+      Given a resource tree "sub"/"unittest" with ACEs on each level
+      And a node "c" below "sub"
+      When I load the subtree of "sub" down to depth 1
+      Then I get the nodes "a, c"
+      And the children of "sub" are known, those of "a" are not
+
+
+  Scenario: a subtree is loaded with nodes of some kinds only
+      Given a resource tree "sub"/"unittest" with ACEs on each level
+      And a "other" node "x" below "sub"
+      And a node "y" below "x"
+      When I load the subtree of "sub" with kind "unittest"
+      Then I get the nodes "a, b"
+
+
+  Scenario: a subtree is dumped
+      Given a resource tree "sub"/"unittest" with ACEs on each level
+      And a node "c" below "sub"
+      When I dump the tree "sub"
+      Then the dump shows "sub" with "a" and "c", and "b" below "a"
@@ -0,0 +1,42 @@
+Feature: Password verification
+  Passwords are verified in a pool of worker processes.
+
+
+  Scenario Outline: a password is verified
+      Given a password verifier with <workers> workers
+      And the password "secret" hashed with "pbkdf2_sha512"
+      Then the password "secret" is accepted and the hash is kept
+      And the password "wrong" is rejected
+
+    Examples:
+      | workers |
+      | 0       |
+      | 1       |
+
+
+  Scenario: a hash of another scheme is replaced on login
+      Given a password verifier with 1 workers
+      And the password "secret" hashed with "sha512_crypt"
+      When the password scheme is "pbkdf2_sha512" with 1000 rounds
+      Then the password "secret" is accepted and rehashed with "pbkdf2_sha512"
+
+
+  Scenario: a hash with fewer rounds is replaced on login
+      Given a password verifier with 1 workers
+      And the password "secret" hashed with "pbkdf2_sha512"
+      When the password scheme is "pbkdf2_sha512" with 30000 rounds
+      Then the password "secret" is accepted and rehashed with "pbkdf2_sha512"
+
+
+  Scenario: a hash that Dovecot reads is kept
+      Given a password verifier with 1 workers
+      And the password "secret" hashed with "ldap_salted_sha1"
+      When the password scheme is "pbkdf2_sha512" with 1000 rounds
+      Then the password "secret" is accepted and the hash is kept
+
+
+  Scenario: too many or too slow verifications are refused
+      Given a password verifier with 1 workers, 1 pending and a timeout of 0.01 seconds
+      And the password "secret" hashed with "pbkdf2_sha512" in 500000 rounds
+      Then verifying the password "secret" raises AuthBusyError
+      And verifying the password "secret" raises AuthBusyError again at once
@@ -0,0 +1,63 @@
+from behave import (
+    given, then
+)
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.security import Everyone, Authenticated
+from pym.auth.authorization import BitmaskAuthorizationPolicy
+from pym.auth.const import UNIT_TESTER_UID, USERS_RID, UNIT_TESTERS_RID
+from pym.auth.models import Permissions
+from pym.res.models import ResourceNode
+
+
+def _principals():
+    base = [Everyone, Authenticated]
+    return [
+        [Everyone],
+        base + ['g:{}'.format(USERS_RID)],
+        base + ['g:{}'.format(UNIT_TESTERS_RID)],
+        base + ['g:{}'.format(USERS_RID), 'g:{}'.format(UNIT_TESTERS_RID)],
+        base + ['g:{}'.format(USERS_RID), 'u:{}'.format(UNIT_TESTER_UID)],
+    ]
+
+
+@given('a resource tree "{name}"/"{kind}" with ACEs on each level')
+def step_impl(context, name, kind):
+    sess = context.sess
+    root = ResourceNode.create_root(sess, owner=UNIT_TESTER_UID, name=name,
+        kind=kind)
+    child = root.add_child(sess, UNIT_TESTER_UID, kind, 'a')
+    grandchild = child.add_child(sess, UNIT_TESTER_UID, kind, 'b')
+    sess.flush()
+    root.allow(sess, UNIT_TESTER_UID, Permissions.read, group=USERS_RID)
+    root.allow(sess, UNIT_TESTER_UID, Permissions.write,
+        group=UNIT_TESTERS_RID)
+    child.deny(sess, UNIT_TESTER_UID, Permissions.write, group=USERS_RID,
+        sortix=1)
+    child.allow(sess, UNIT_TESTER_UID, Permissions.delete,
+        group=UNIT_TESTERS_RID, sortix=2)
+    grandchild.allow(sess, UNIT_TESTER_UID, Permissions.all,
+        user=UNIT_TESTER_UID)
+    sess.flush()
+    context.nodes = [root, child, grandchild]
+
+
+@then('the bitmask policy decides like the ACL policy')
+def step_impl(context):
+    acl_policy = ACLAuthorizationPolicy()
+    bitmask_policy = BitmaskAuthorizationPolicy()
+    perms = [p.value for p in Permissions if p is not Permissions.all]
+    perms.append('frobnicate')
+    for node in context.nodes:
+        for principals in _principals():
+            for perm in perms:
+                expected = bool(acl_policy.permits(node, principals, perm))
+                actual = bool(bitmask_policy.permits(node, principals, perm))
+                assert actual == expected, (node.name, principals, perm)
+
+
+@then('permission "{permission}" is denied to the users group')
+def step_impl(context, permission):
+    policy = BitmaskAuthorizationPolicy()
+    principals = [Everyone, Authenticated, 'g:{}'.format(USERS_RID)]
+    for node in context.nodes:
+        assert not policy.permits(node, principals, permission), node.name
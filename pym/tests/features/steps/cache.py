@@ -0,0 +1,349 @@
+from behave import (
+    given, when, then
+)
+import sqlalchemy as sa
+# noinspection PyPackageRequirements
+from dogpile.cache.api import NO_VALUE
+from pym.cache import (CachingQuery, PREFETCH_KEY, region_auth_long_term,
+    _statement_shape, _key_from_query, BackgroundRefresher, LruCache,
+    MemoryLruBackend)
+from pym.auth.models import User
+from pym.models import CACHE_TAGS_KEY
+import pym.models
+from pym.res.models import ResourceNode
+from pym.testing import StatementCounter
+
+
+STASH_KEY = 'test:prefetch'
+
+
+@given('a value is prefetched into my session')
+def step_impl(context):
+    region = region_auth_long_term
+    region.set(STASH_KEY, ['foo'])
+    cached_value = region.backend.get(region.key_mangler(STASH_KEY))
+    context.stash_entry = (cached_value, region.generation)
+    context.sess.info[PREFETCH_KEY] = {
+        (region.name, STASH_KEY): context.stash_entry}
+    assert CachingQuery._unstash(region, context.stash_entry,
+        None) is not NO_VALUE
+
+
+@when('I roll back the transaction')
+def step_impl(context):
+    context.sess.rollback()
+
+
+@given('the cache tag "{tag}" is collected')
+def step_impl(context, tag):
+    context.sess.info[CACHE_TAGS_KEY] = {tag}
+
+
+@given('the ACLs were marked as changed')
+def step_impl(context):
+    context.sess.info['pym.auth.acl_changed'] = True
+
+
+@when('I begin a savepoint')
+def step_impl(context):
+    context.savepoint = context.sess.begin_nested()
+
+
+@when('I collect the cache tag "{tag}"')
+def step_impl(context, tag):
+    context.sess.info.setdefault(CACHE_TAGS_KEY, set()).add(tag)
+
+
+@when('I roll back the savepoint')
+def step_impl(context):
+    context.savepoint.rollback()
+
+
+@when('I release the savepoint')
+def step_impl(context):
+    context.savepoint.commit()
+
+
+@then('the collected cache tags are "{tags}"')
+def step_impl(context, tags):
+    expected = set(tags.split('/')) if tags else set()
+    assert context.sess.info.get(CACHE_TAGS_KEY, set()) == expected, \
+        context.sess.info.get(CACHE_TAGS_KEY)
+
+
+@when('I close the session')
+def step_impl(context):
+    context.sess.close()
+
+
+@when('a key of its region is deleted')
+def step_impl(context):
+    region_auth_long_term.delete(STASH_KEY)
+
+
+@then('the prefetched values are gone')
+def step_impl(context):
+    assert PREFETCH_KEY not in context.sess.info
+
+
+@then('the prefetched value is not served')
+def step_impl(context):
+    assert CachingQuery._unstash(region_auth_long_term, context.stash_entry,
+        None) is NO_VALUE
+
+
+# --
+
+
+@given('I build a query for the user "{principal}" twice')
+def step_impl(context, principal):
+    context.queries = [
+        context.sess.query(User).filter(User.principal == principal)
+        for _ in range(2)
+    ]
+
+
+@then('both queries have the same shape and cache key')
+def step_impl(context):
+    q1, q2 = context.queries
+    shape1, values1 = _statement_shape(q1.with_labels().statement,
+        q1._params)
+    shape2, values2 = _statement_shape(q2.with_labels().statement,
+        q2._params)
+    assert shape1 == shape2
+    assert values1 == values2
+    assert _key_from_query(q1) == _key_from_query(q2)
+
+
+@given('I build queries that filter by column "{col}" of either joined'
+    ' table')
+def step_impl(context, col):
+    context.queries = [
+        context.sess.query(ResourceNode).filter(
+            ResourceNode.owner_id == User.id
+        ).filter(getattr(cls, col) == 1)
+        for cls in (ResourceNode, User)
+    ]
+
+
+@given('I build queries for two entities that filter by column "{col}" of'
+    ' either')
+def step_impl(context, col):
+    context.queries = [
+        context.sess.query(ResourceNode, User).filter(getattr(cls, col) == 1)
+        for cls in (ResourceNode, User)
+    ]
+
+
+@given('I build queries that filter by column "{col}" of either of two'
+    ' aliases')
+def step_impl(context, col):
+    context.queries = []
+    for i in range(2):
+        parents = [sa.orm.aliased(ResourceNode) for _ in range(2)]
+        context.queries.append(context.sess.query(ResourceNode).join(
+            parents[0], ResourceNode.parent_id == parents[0].id
+        ).join(
+            parents[1], parents[0].parent_id == parents[1].id
+        ).filter(getattr(parents[i], col) == 1))
+
+
+@then('the queries have different cache keys')
+def step_impl(context):
+    q1, q2 = context.queries
+    assert _key_from_query(q1) != _key_from_query(q2)
+
+
+# --
+
+
+REFRESH_KEY = 'test:refresh'
+
+
+class _Mutex(object):
+
+    def __init__(self):
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+@given('a cached value that is refreshed in the background')
+def step_impl(context):
+    region_auth_long_term.set(REFRESH_KEY, ['foo'])
+
+
+@when('the refresh creates an empty value')
+def step_impl(context):
+    def creator():
+        return []
+    creator.should_cache_fn = bool
+    context.mutex = _Mutex()
+    BackgroundRefresher()._run(region_auth_long_term, REFRESH_KEY, creator,
+        context.mutex)
+
+
+@then('the refreshed value is not stored')
+def step_impl(context):
+    assert context.mutex.released
+    assert region_auth_long_term.get(REFRESH_KEY) == ['foo']
+
+
+# --
+
+
+@when('I change a node whose parent is expired')
+def step_impl(context):
+    root, child = context.nodes[:2]
+    context.sess.expire(root)
+    context.sess.info.pop(CACHE_TAGS_KEY, None)
+    child.sortix = 42
+    context.sess.flush()
+
+
+@then('the tags of the parent are collected and the parent stays expired')
+def step_impl(context):
+    root, child = context.nodes[:2]
+    assert '_name' in sa.inspect(root).unloaded
+    tags = context.sess.info[CACHE_TAGS_KEY]
+    assert 'node-lookup:{}:{}'.format(child.name, root.id) in tags
+    assert 'node-lookup:{}:None'.format(root.name) in tags
+
+
+# --
+
+
+@given('the child "{name}" and its children are cached')
+def step_impl(context, name):
+    root = context.nodes[0]
+    node = ResourceNode.load_child(context.sess, name, root.id)
+    context.child_names = [c.name for c in node.children]
+    assert context.child_names
+
+
+@when('I load the child "{name}" from the cache in a fresh session')
+def step_impl(context, name):
+    root_id = context.nodes[0].id
+    context.sess.expunge_all()
+    with StatementCounter(pym.models.DbEngine) as counter:
+        context.node = ResourceNode.load_child(context.sess, name, root_id)
+    assert counter.count == 0, counter.statements
+    assert sa.inspect(context.node).load_options
+
+
+@then('its children are loaded without querying the DB')
+def step_impl(context):
+    with StatementCounter(pym.models.DbEngine) as counter:
+        names = [c.name for c in context.node.children]
+    assert counter.count == 0, counter.statements
+    assert names == context.child_names
+
+
+@given('the child "{name}", its children and its ACL are cached')
+def step_impl(context, name):
+    root = context.nodes[0]
+    node = ResourceNode.load_child(context.sess, name, root.id)
+    context.child_names = [c.name for c in node.children]
+    context.ace_ids = [a.id for a in node.acl]
+    assert context.child_names and context.ace_ids
+
+
+@then('its relationships are served from the prefetched values')
+def step_impl(context):
+    node = context.node
+    region_name = region_auth_long_term.name
+    key = 'resource:{}:{}'.format(node.name, node.parent_id)
+    stash = context.sess.info[PREFETCH_KEY]
+    assert (region_name, key + ':children') in stash
+    assert (region_name, key + ':acl') in stash
+    with StatementCounter(pym.models.DbEngine) as counter:
+        names = [c.name for c in node.children]
+        ace_ids = [a.id for a in node.acl]
+    assert counter.count == 0, counter.statements
+    assert names == context.child_names
+    assert ace_ids == context.ace_ids
+    assert (region_name, key + ':children') not in stash
+    assert (region_name, key + ':acl') not in stash
+
+
+# --
+
+
+ON_STORE_KEY = 'test:on-store'
+
+
+@given('a creator whose values are tagged when they are stored')
+def step_impl(context):
+    region_auth_long_term.delete(ON_STORE_KEY)
+    context.stored = []
+
+    def on_store(value):
+        context.stored.append((value, region_auth_long_term.get(
+            ON_STORE_KEY)))
+    context.on_store = on_store
+
+
+@when('the creator returns an empty value that should not be cached')
+def step_impl(context):
+    region_auth_long_term.get_or_create(ON_STORE_KEY, lambda: [],
+        should_cache_fn=bool, on_store=context.on_store)
+
+
+@then('the value is neither stored nor tagged')
+def step_impl(context):
+    assert region_auth_long_term.get(ON_STORE_KEY) is NO_VALUE
+    assert not context.stored
+
+
+@when('the creator returns a value that should be cached')
+def step_impl(context):
+    region_auth_long_term.get_or_create(ON_STORE_KEY, lambda: ['foo'],
+        should_cache_fn=bool, on_store=context.on_store)
+
+
+@then('the value is tagged after it was stored')
+def step_impl(context):
+    assert context.stored == [(['foo'], ['foo'])]
+
+
+# --
+
+
+@given('an LRU cache for {n:d} entries')
+def step_impl(context, n):
+    context.evicted = []
+    context.lru = LruCache(max_entries=n,
+        on_evict=lambda k, v: context.evicted.append(k))
+
+
+@when('I set the keys "{a}", "{b}" and "{c}"')
+def step_impl(context, a, b, c):
+    for k in (a, b, c):
+        context.lru.set(k, k.upper())
+
+
+@then('the entry "{key}" was discarded and reported')
+def step_impl(context, key):
+    assert key not in context.lru
+    assert context.evicted == [key]
+
+
+# --
+
+
+@given('an in-process cache backend with the value "{value}" in a list')
+def step_impl(context, value):
+    context.backend = MemoryLruBackend({})
+    context.backend.set('test:list', [value])
+
+
+@when('I append "{value}" to the list I got from it')
+def step_impl(context, value):
+    context.backend.get('test:list').append(value)
+
+
+@then('the backend still has the value "{value}" in a list')
+def step_impl(context, value):
+    assert context.backend.get('test:list') == [value]
+    assert context.backend.get_multi(['test:list']) == [[value]]
@@ -0,0 +1,76 @@
+from behave import (
+    given, when, then
+)
+import babel
+import pyramid.testing
+from pym.auth.const import UNIT_TESTER_UID
+from pym.auth.models import CurrentUser, User, user_version, group_version
+
+
+def _current_user(context):
+    request = pyramid.testing.DummyRequest(session=context.session)
+    request.registry = context.configurator.registry
+    return CurrentUser(request)
+
+
+@given('the unit tester has a snapshot in the session')
+def step_impl(context):
+    context.session = {}
+    context.user = context.sess.query(User).get(UNIT_TESTER_UID)
+    _current_user(context).init_from_user(context.user)
+    assert CurrentUser.SESS_KEY in context.session
+
+
+@given('the unit tester has a snapshot with the preferred locale "{loc}"')
+def step_impl(context, loc):
+    context.session = {}
+    context.user = context.sess.query(User).get(UNIT_TESTER_UID)
+    cusr = _current_user(context)
+    cusr._metadata['preferred_locale'] = loc
+    cusr.init_from_user(context.user)
+
+
+@when('the snapshot has format {fmt:d}')
+def step_impl(context, fmt):
+    snapshot = context.session[CurrentUser.SESS_KEY]
+    context.session[CurrentUser.SESS_KEY] = (fmt,) + snapshot[1:]
+
+
+@when('the versions of the snapshot do not match')
+def step_impl(context):
+    snapshot = context.session[CurrentUser.SESS_KEY]
+    versions = tuple(v - 1 for v in snapshot[1])
+    context.session[CurrentUser.SESS_KEY] = \
+        snapshot[:1] + (versions,) + snapshot[2:]
+
+
+@when('the user version of the unit tester is bumped')
+def step_impl(context):
+    user_version.bump(UNIT_TESTER_UID)
+
+
+@when('the group version is bumped')
+def step_impl(context):
+    group_version.bump()
+
+
+@then('the current user is restored from the snapshot')
+def step_impl(context):
+    cusr = _current_user(context)
+    assert cusr.init_from_snapshot(context.user.principal)
+    assert cusr.uid == context.user.id
+    assert cusr.principal == context.user.principal
+    assert cusr.display_name == context.user.display_name
+
+
+@then('the current user is restored with the preferred locale "{loc}"')
+def step_impl(context, loc):
+    cusr = _current_user(context)
+    assert cusr.init_from_snapshot(context.user.principal)
+    assert cusr.preferred_locale == babel.Locale(loc)
+
+
+@then('the current user is not restored from the snapshot')
+def step_impl(context):
+    assert not _current_user(context).init_from_snapshot(
+        context.user.principal)
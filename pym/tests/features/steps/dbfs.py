@@ -0,0 +1,102 @@
+from behave import (
+    given, when, then
+)
+import sqlalchemy as sa
+from pym.res.models import ResourceNode
+from pym.dbfs.models import FsNode
+from pym.tenants.models import Tenant
+from pym.auth.const import UNIT_TESTER_UID
+from pym.testing import StatementCounter
+import pym.models
+
+
+def _names(names):
+    return names.split('/') if names else []
+
+
+def _tenant(sess):
+    ten = sess.query(Tenant).filter(Tenant.name == 'unittest-fs').first()
+    if not ten:
+        ten = Tenant()
+        ten.owner_id = UNIT_TESTER_UID
+        ten.name = 'unittest-fs'
+        sess.add(ten)
+        sess.flush()
+    return ten
+
+
+@given('a directory "{name}" with the files "{files}" and the nodes "{others}"')
+def step_impl(context, name, files, others):
+    sess = context.sess
+    ten = _tenant(sess)
+    parent = ResourceNode.create_root(sess, owner=UNIT_TESTER_UID, name='fs',
+        kind='unittest')
+    # The directory is the root of its FS and references itself
+    id_ = sess.execute(sa.select([
+        sa.func.nextval('pym.resource_tree_id_seq')])).scalar()
+    d = FsNode(owner_id=UNIT_TESTER_UID, name=name, kind='file', id=id_,
+        tenant_id=ten.id, fs_root_id=id_, mime_type=FsNode.MIME_TYPE_DIRECTORY,
+        size=0)
+    d.parent = parent
+    sess.flush()
+    for x in _names(files):
+        f = FsNode(owner_id=UNIT_TESTER_UID, name=x, kind='file',
+            tenant_id=ten.id, fs_root_id=d.id, mime_type='text/plain', size=3,
+            content_text='foo')
+        f.parent = d
+    for x in _names(others):
+        d.add_child(sess, UNIT_TESTER_UID, 'unittest', x)
+    sess.flush()
+    context.dirs = {name: d}
+    # Load everything afresh
+    sess.expire_all()
+    d.id
+
+
+@when('I list the children of "{name}"')
+def step_impl(context, name):
+    d = context.dirs[name]
+    with StatementCounter(pym.models.DbEngine) as counter:
+        context.listing = list(d.iter_children(context.sess))
+        for n in context.listing:
+            if isinstance(n, FsNode):
+                n.mime_type, n.size, n.fs_root_id
+    context.statements = counter.statements
+
+
+@when('I list the directory "{name}"')
+def step_impl(context, name):
+    d = context.dirs[name]
+    with StatementCounter(pym.models.DbEngine) as counter:
+        context.listing = list(d.iter_dir(context.sess))
+        for n in context.listing:
+            n.mime_type, n.size, n.fs_root_id
+    context.statements = counter.statements
+
+
+@when('I load the child "{child}" of "{name}"')
+def step_impl(context, child, name):
+    d = context.dirs[name]
+    with StatementCounter(pym.models.DbEngine) as counter:
+        n = ResourceNode.load_child(context.sess, child, parent_id=d.id,
+            use_cache=False)
+        n.mime_type, n.size, n.fs_root_id
+    context.listing = [n]
+    context.statements = counter.statements
+
+
+@then('I get the files "{files}" and the nodes "{others}"')
+def step_impl(context, files, others):
+    assert [n.name for n in context.listing if isinstance(n, FsNode)] == \
+        _names(files), context.listing
+    assert [n.name for n in context.listing if not isinstance(n, FsNode)] == \
+        _names(others), context.listing
+
+
+@then('the content of the files is not loaded')
+def step_impl(context):
+    for n in context.listing:
+        if isinstance(n, FsNode):
+            d = sa.inspect(n).dict
+            for k in ('content_text', 'content_bin', 'content_json', 'meta'):
+                assert k not in d, (n, k)
@@ -0,0 +1,80 @@
+from behave import (
+    given, when, then
+)
+import pyramid.testing
+from pym.auth.const import UNIT_TESTER_UID
+from pym.auth.manager import create_user, create_group, create_group_member
+from pym.auth.models import CurrentUser, User, Group, GroupMember
+from pym.testing import StatementCounter
+import pym.models
+
+
+def _user(sess, principal):
+    u = sess.query(User).filter(User.principal == principal).first()
+    if not u:
+        u = create_user(sess, UNIT_TESTER_UID, is_enabled=True,
+            principal=principal, pwd=None,
+            email='{}@localhost.localdomain'.format(principal), groups=False)
+    return u
+
+
+def _group(sess, name):
+    g = sess.query(Group).filter(Group.tenant_id == None,
+        Group.name == name).first()
+    if not g:
+        g = create_group(sess, UNIT_TESTER_UID, name)
+    return g
+
+
+@given('a user "{principal}" in group "{name}"')
+def step_impl(context, principal, name):
+    u = _user(context.sess, principal)
+    g = _group(context.sess, name)
+    if not context.sess.query(GroupMember).filter(GroupMember.group_id == g.id,
+            GroupMember.member_user_id == u.id).first():
+        create_group_member(context.sess, UNIT_TESTER_UID, g, member_user=u)
+
+
+@given('group "{member}" is member of group "{name}"')
+def step_impl(context, member, name):
+    m = _group(context.sess, member)
+    g = _group(context.sess, name)
+    if not context.sess.query(GroupMember).filter(GroupMember.group_id == g.id,
+            GroupMember.member_group_id == m.id).first():
+        create_group_member(context.sess, UNIT_TESTER_UID, g, member_group=m)
+
+
+@given('the groups of user "{principal}" are cached')
+def step_impl(context, principal):
+    _user(context.sess, principal).load_all_groups()
+
+
+@when('I load the groups of user "{principal}"')
+def step_impl(context, principal):
+    uid = _user(context.sess, principal).id
+    with StatementCounter(pym.models.DbEngine) as counter:
+        context.groups = User.load_groups_for_users(context.sess, [uid])[uid]
+    context.statements = counter.statements
+
+
+@when('I load all groups of user "{principal}"')
+def step_impl(context, principal):
+    u = _user(context.sess, principal)
+    with StatementCounter(pym.models.DbEngine) as counter:
+        context.groups = u.load_all_groups()
+    context.statements = counter.statements
+
+
+@then('the user is member of the groups "{names}"')
+def step_impl(context, names):
+    assert sorted(g[1] for g in context.groups) == sorted(names.split('/')), \
+        context.groups
+
+
+@then('the current user "{principal}" is wheel')
+def step_impl(context, principal):
+    request = pyramid.testing.DummyRequest(session={})
+    request.registry = context.configurator.registry
+    cusr = CurrentUser(request)
+    cusr.init_from_user(_user(context.sess, principal))
+    assert cusr.is_wheel()
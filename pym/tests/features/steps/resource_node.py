@@ -1,8 +1,16 @@
 from behave import (
     given, when, then
 )
+import sqlalchemy as sa
+import pym.cache
+import pym.exc
+import pym.models
 from pym.res.models import ResourceNode
-from pym.auth.const import UNIT_TESTER_UID
+from pym.res.manager import bulk_create, spec_from_paths
+import pym.auth.models as pam
+from pym.auth.const import UNIT_TESTER_UID, USERS_RID
+from pym.models import CACHE_TAGS_KEY
+from pym.testing import StatementCounter
 
 
 @given('my root node is {name}/{kind}')
@@ -75,3 +83,343 @@ def step_impl(context):
         assert False  # No exception occurred
 
 
+# --
+
+
+@given('the path "{path}" was not found twice')
+def step_impl(context, path):
+    root = context.nodes[0]
+    # The first time records the miss, the second caches the nodes found
+    for _ in range(2):
+        lineage = ResourceNode.load_path(context.sess, root, path.split('/'))
+        assert len(lineage) < len(path.split('/'))
+
+
+@when('I load the path "{path}"')
+def step_impl(context, path):
+    with StatementCounter(pym.models.DbEngine) as counter:
+        context.lineage = ResourceNode.load_path(context.sess,
+            context.nodes[0], path.split('/'))
+    context.statements = counter.statements
+
+
+@when('I create the node "{name}" below "{parent}" and its cache is'
+    ' invalidated')
+def step_impl(context, name, parent):
+    sess = context.sess
+    parent = [n for n in context.nodes if n.name == parent][0]
+    parent.add_child(sess, UNIT_TESTER_UID, parent.kind, name)
+    sess.flush()
+    # As on commit
+    pym.cache.invalidate_tags(sess.info.pop(CACHE_TAGS_KEY))
+
+
+@then('I get the lineage "{path}" without querying the DB')
+def step_impl(context, path):
+    assert [n.name for n in context.lineage] == path.split('/')
+    assert not context.statements, context.statements
+
+
+@then('I get the lineage "{path}"')
+def step_impl(context, path):
+    assert [n.name for n in context.lineage] == path.split('/')
+
+
+# --
+
+
+def _node(context, name):
+    return [n for n in context.nodes if n.name == name][0]
+
+
+@given('a node "{name}" below "{parent}"')
+def step_impl(context, name, parent):
+    parent = _node(context, parent)
+    context.nodes.append(parent.add_child(context.sess, UNIT_TESTER_UID,
+        parent.kind, name))
+    context.sess.flush()
+
+
+@given('the materialized paths are kept')
+def step_impl(context):
+    pass
+
+
+@given('the materialized paths are cleared')
+def step_impl(context):
+    # As in a tree created before the mpath trigger
+    t = ResourceNode.__table__
+    context.sess.execute(t.update().where(
+        t.c.id.in_([n.id for n in context.nodes])).values(mpath=None))
+    for n in context.nodes:
+        context.sess.expire(n, ['mpath'])
+        assert n.mpath is None
+
+
+@when('I move node "{name}" below "{parent}"')
+def step_impl(context, name, parent):
+    context.sess.info.pop(CACHE_TAGS_KEY, None)
+    _node(context, name).move_to(context.sess, _node(context, parent))
+
+
+@when('I delete the subtree of node "{name}"')
+def step_impl(context, name):
+    context.sess.info.pop(CACHE_TAGS_KEY, None)
+    context.sess.info.pop('pym.auth.acl_changed', None)
+    context.aces = [o for o in context.sess.identity_map.values()
+        if isinstance(o, pam.Ace)]
+    _node(context, name).delete_subtree(context.sess)
+
+
+@then('moving node "{name}" below "{parent}" raises a PymError')
+def step_impl(context, name, parent):
+    try:
+        _node(context, name).move_to(context.sess, _node(context, parent))
+    except pym.exc.PymError:
+        pass
+    else:
+        assert False, "Moved node below itself"
+
+
+@then('the cache tags of the nodes "{names}" are collected')
+def step_impl(context, names):
+    tags = context.sess.info[CACHE_TAGS_KEY]
+    for x in names.split('/'):
+        assert 'node:{}'.format(_node(context, x).id) in tags, x
+
+
+@then('the lookup of "{name}" below "{parent}" is invalidated')
+def step_impl(context, name, parent):
+    assert 'node-lookup:{}:{}'.format(name, _node(context, parent).id) in \
+        context.sess.info[CACHE_TAGS_KEY]
+
+
+@then('the nodes "{names}" and their ACEs are no longer in the session')
+def step_impl(context, names):
+    nodes = [_node(context, x) for x in names.split('/')]
+    ids = [n.id for n in nodes]
+    for n in nodes:
+        assert n not in context.sess
+    aces = [o for o in context.aces if o.resource_id in ids]
+    assert aces
+    for o in aces:
+        assert o not in context.sess
+
+
+@then('the ACLs are marked as changed')
+def step_impl(context):
+    assert context.sess.info.get('pym.auth.acl_changed')
+
+
+@then('node "{name}" has depth {depth:d} and the ancestors "{path}"')
+def step_impl(context, name, depth, path):
+    node = _node(context, name)
+    assert node.depth == depth
+    assert [n.name for n in node.ancestors(context.sess)] == path.split('/')
+
+
+@then('node "{name}" is a descendant of "{other}"')
+def step_impl(context, name, other):
+    node = _node(context, name)
+    assert node.is_descendant_of(_node(context, other))
+    assert not _node(context, other).is_descendant_of(node)
+
+
+@then('the materialized path of node "{name}" is "{path}"')
+def step_impl(context, name, path):
+    node = _node(context, name)
+    context.sess.expire(node, ['mpath'])
+    assert node.mpath == [_node(context, x).id for x in path.split('/')]
+
+
+@then('the nodes "{names}" are gone')
+def step_impl(context, names):
+    t = ResourceNode.__table__
+    ids = [_node(context, x).id for x in names.split('/')]
+    assert not context.sess.execute(sa.select([t.c.id]).where(
+        t.c.id.in_(ids))).fetchall()
+
+
+@then('node "{name}" is still there')
+def step_impl(context, name):
+    assert context.sess.query(ResourceNode).get(_node(context, name).id)
+
+
+# --
+
+
+def _paths(paths):
+    return [x.strip() for x in paths.split(',')]
+
+
+def _spec_str(spec):
+    return ', '.join(n['name'] + ('({})'.format(_spec_str(n['children']))
+        if n['children'] else '') for n in spec)
+
+
+@when('I build a spec from the paths "{paths}"')
+def step_impl(context, paths):
+    context.spec = spec_from_paths(_paths(paths), kind='unittest')
+
+
+@then('the spec has the nodes "{nodes}"')
+def step_impl(context, nodes):
+    assert _spec_str(context.spec) == nodes, _spec_str(context.spec)
+
+
+@when('I create the nodes "{paths}" in bulk below "{parent}", readable by'
+    ' the users group')
+def step_impl(context, paths, parent):
+    sess = context.sess
+    parent = _node(context, parent)
+    len(parent.children)
+    sess.info.pop(CACHE_TAGS_KEY, None)
+    spec = spec_from_paths(_paths(paths), kind='unittest',
+        acl=[{'allow': True, 'permission': pam.Permissions.read,
+            'group': USERS_RID}])
+    with StatementCounter(pym.models.DbEngine) as counter:
+        context.ids = bulk_create(sess, UNIT_TESTER_UID, parent, spec)
+    context.statements = counter.statements
+    context.bulk_parent = parent
+    context.bulk_paths = _paths(paths)
+
+
+@then('the nodes were created below "{parent}" with the returned IDs')
+def step_impl(context, parent):
+    parent = _node(context, parent)
+    assert 'children' not in sa.inspect(parent).dict
+    expected = set()
+    for path in context.bulk_paths:
+        names = path.split('/')
+        for i in range(len(names)):
+            expected.add('/'.join(names[:i + 1]))
+    assert set(context.ids.keys()) == expected
+    for path, id_ in context.ids.items():
+        lineage = ResourceNode.load_path(context.sess, parent,
+            path.split('/'))
+        assert [n.name for n in lineage] == path.split('/')
+        assert lineage[-1].id == id_
+        assert lineage[-1].owner_id == UNIT_TESTER_UID
+
+
+@then('the new IDs are taken from the sequence in order')
+def step_impl(context):
+    ids = [context.ids[k] for k in ('x', 'x/y', 'x/y/z', 'x/v', 'w')]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+
+
+@then("the materialized path of each new node ends with its parent's")
+def step_impl(context):
+    parent = context.bulk_parent
+    for path, id_ in context.ids.items():
+        node = context.sess.query(ResourceNode).get(id_)
+        if '/' in path:
+            parent_path = context.sess.query(ResourceNode).get(
+                context.ids[path.rsplit('/', 1)[0]]).mpath
+        else:
+            parent_path = parent.mpath
+        assert node.mpath == parent_path + [id_]
+
+
+@then('each new node allows "{perm}" to the users group')
+def step_impl(context, perm):
+    rs = context.sess.query(pam.Ace, pam.Permission.name).join(
+        pam.Permission, pam.Ace.permission_id == pam.Permission.id
+    ).filter(pam.Ace.resource_id.in_(list(context.ids.values())))
+    aces = {ace.resource_id: (ace.allow, ace.group_id, name)
+        for ace, name in rs}
+    assert aces == {id_: (True, USERS_RID, perm)
+        for id_ in context.ids.values()}
+
+
+@then('the cache tags of the new nodes and of "{parent}" are collected')
+def step_impl(context, parent):
+    parent = _node(context, parent)
+    tags = context.sess.info[CACHE_TAGS_KEY]
+    for path, id_ in context.ids.items():
+        assert 'node:{}'.format(id_) in tags
+        names = path.split('/')
+        parent_id = context.ids['/'.join(names[:-1])] if len(names) > 1 \
+            else parent.id
+        assert 'node-lookup:{}:{}'.format(names[-1], parent_id) in tags
+    assert 'node-lookup:{}:{}'.format(parent.name, parent.parent_id) in tags
+
+
+@then('the bulk creation took at most {n:d} queries')
+def step_impl(context, n):
+    assert len(context.statements) <= n, context.statements
+
+
+# --
+
+
+@given('a "{kind}" node "{name}" below "{parent}"')
+def step_impl(context, kind, name, parent):
+    parent = _node(context, parent)
+    context.nodes.append(parent.add_child(context.sess, UNIT_TESTER_UID,
+        kind, name))
+    context.sess.flush()
+
+
+def _load_subtree(context, name, **kw):
+    node = _node(context, name)
+    # Refresh the expired node itself before counting
+    node.id
+    with StatementCounter(pym.models.DbEngine) as counter:
+        context.subtree = node.load_subtree(context.sess, **kw)
+    context.statements = counter.statements
+
+
+@when('I load the subtree of "{name}"')
+def step_impl(context, name):
+    context.sess.expire_all()
+    _load_subtree(context, name)
+
+
+@when('I load the subtree of "{name}" down to depth {depth:d}')
+def step_impl(context, name, depth):
+    context.sess.expire_all()
+    _load_subtree(context, name, max_depth=depth)
+
+
+@when('I load the subtree of "{name}" with kind "{kind}"')
+def step_impl(context, name, kind):
+    context.sess.expire_all()
+    _load_subtree(context, name, kinds=[kind])
+
+
+@then('I get the nodes "{names}"')
+def step_impl(context, names):
+    assert [n.name for n in context.subtree] == _paths(names)
+
+
+@then('the children of each loaded node are known without a query')
+def step_impl(context):
+    with StatementCounter(pym.models.DbEngine) as counter:
+        for n in context.subtree:
+            assert n.parent is not None
+            for c in n.children:
+                assert c.parent is n
+    assert counter.count == 0, counter.statements
+
+
+@then('the children of "{name}" are known, those of "{other}" are not')
+def step_impl(context, name, other):
+    assert 'children' in sa.inspect(_node(context, name)).dict
+    assert 'children' not in sa.inspect(_node(context, other)).dict
+
+
+@when('I dump the tree "{name}"')
+def step_impl(context, name):
+    context.dump = _node(context, name).dumps(context.sess)
+
+
+@then('the dump shows "{name}" with "{a}" and "{c}", and "{b}" below "{a2}"')
+def step_impl(context, name, a, c, b, a2):
+    lines = context.dump.splitlines()
+    expected = [(0, name), (1, a), (2, b), (1, c)]
+    assert len(lines) == len(expected), context.dump
+    for line, (indent, x) in zip(lines, expected):
+        assert line.startswith('   ' * indent + '<'), context.dump
+        assert "name='{}'".format(x) in line, context.dump
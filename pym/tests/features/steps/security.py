@@ -0,0 +1,90 @@
+from behave import (
+    given, when, then
+)
+import pym.exc
+import pym.security
+from pym.security import pwd_context, PasswordVerifier, configure_pwd_context
+
+
+@given('a password verifier with {n:d} workers')
+def step_impl(context, n):
+    context.verifier = PasswordVerifier(max_workers=n)
+    context.pwd_config = None
+
+
+@given('a password verifier with {n:d} workers, {pending:d} pending and a'
+    ' timeout of {timeout:f} seconds')
+def step_impl(context, n, pending, timeout):
+    context.verifier = PasswordVerifier(max_workers=n, max_pending=pending,
+        timeout=timeout)
+    context.pwd_config = None
+
+
+@given('the password "{pwd}" hashed with "{scheme}"')
+def step_impl(context, pwd, scheme):
+    context.hash = pwd_context.encrypt(pwd, scheme)
+
+
+@given('the password "{pwd}" hashed with "{scheme}" in {rounds:d} rounds')
+def step_impl(context, pwd, scheme, rounds):
+    context.hash = pwd_context.encrypt(pwd, scheme, rounds=rounds)
+
+
+@when('the password scheme is "{scheme}" with {rounds:d} rounds')
+def step_impl(context, scheme, rounds):
+    # Restored after verifying, the context is global
+    context.pwd_config = pwd_context.to_string()
+    configure_pwd_context(scheme, rounds=rounds)
+
+
+def _verify(context, pwd):
+    try:
+        return context.verifier.verify_and_update(pwd, context.hash)
+    finally:
+        if context.pwd_config:
+            pwd_context.load(context.pwd_config)
+            context.pwd_config = None
+
+
+@then('the password "{pwd}" is accepted and the hash is kept')
+def step_impl(context, pwd):
+    assert _verify(context, pwd) == (True, None)
+
+
+@then('the password "{pwd}" is rejected')
+def step_impl(context, pwd):
+    assert _verify(context, pwd) == (False, None)
+
+
+@then('the password "{pwd}" is accepted and rehashed with "{scheme}"')
+def step_impl(context, pwd, scheme):
+    ok, new_hash = _verify(context, pwd)
+    assert ok
+    assert new_hash and new_hash != context.hash
+    assert pwd_context.identify(new_hash) == scheme
+    assert pwd_context.verify(pwd, new_hash)
+
+
+@then('verifying the password "{pwd}" raises AuthBusyError')
+def step_impl(context, pwd):
+    try:
+        _verify(context, pwd)
+    except pym.exc.AuthBusyError:
+        pass
+    else:
+        assert False, "Verification was not refused"
+
+
+@then('verifying the password "{pwd}" raises AuthBusyError again at once')
+def step_impl(context, pwd):
+    # The worker is still busy with the previous one, so this is refused
+    # without waiting for the timeout.
+    context.verifier.timeout = 60
+    try:
+        _verify(context, pwd)
+    except pym.exc.AuthBusyError:
+        pass
+    else:
+        assert False, "Verification was not refused"
+    finally:
+        context.verifier.configure()
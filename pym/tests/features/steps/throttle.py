@@ -0,0 +1,111 @@
+from behave import (
+    given, when, then
+)
+from pym.auth.throttle import MemoryBucketStore, LoginThrottle
+from pym.exc import AuthThrottledError
+
+
+class FailingStore(object):
+
+    def take(self, buckets, now=None):
+        raise ConnectionError("Store is down")
+
+    def reset(self, key):
+        raise ConnectionError("Store is down")
+
+
+def _try_login(throttle, login, addr):
+    try:
+        throttle.check(login, addr)
+    except AuthThrottledError:
+        return False
+    return True
+
+
+@given('a bucket store with a bucket of {capacity:d} tokens per {interval:d}'
+       ' seconds')
+def step_impl(context, capacity, interval):
+    context.store = MemoryBucketStore()
+    context.bucket = ('test', capacity, 1 / interval)
+    context.now = 1000000.0
+
+
+@when('I take {n:d} tokens at once')
+def step_impl(context, n):
+    for _ in range(n):
+        allowed, wait = context.store.take([context.bucket], now=context.now)
+        assert allowed
+
+
+@then('the next token is refused for {seconds:d} seconds')
+def step_impl(context, seconds):
+    allowed, wait = context.store.take([context.bucket], now=context.now)
+    assert not allowed
+    assert abs(wait - seconds) < 0.001, wait
+
+
+@then('a token is granted after {seconds:d} seconds')
+def step_impl(context, seconds):
+    allowed, wait = context.store.take([context.bucket],
+        now=context.now + seconds)
+    assert allowed
+
+
+# --
+
+
+@given('a login throttle with {login_capacity:d} attempts per login and'
+       ' {addr_capacity:d} per address')
+def step_impl(context, login_capacity, addr_capacity):
+    context.throttle = LoginThrottle(MemoryBucketStore(),
+        login_capacity=login_capacity, login_rate=1 / 3600,
+        addr_capacity=addr_capacity, addr_rate=1 / 3600)
+
+
+@when('"{login}" tried to log in {n:d} times from "{addr}"')
+def step_impl(context, login, n, addr):
+    context.results = [_try_login(context.throttle, login, addr)
+        for _ in range(n)]
+
+
+@then('"{login}" may log in once more from "{addr}"')
+def step_impl(context, login, addr):
+    assert context.results == [True, True, False], context.results
+    assert _try_login(context.throttle, login, addr)
+    assert not _try_login(context.throttle, login, addr)
+
+
+# --
+
+
+@given('a login throttle whose store fails')
+def step_impl(context):
+    context.throttle = LoginThrottle(FailingStore(), login_capacity=2,
+        login_rate=1 / 3600)
+
+
+@then('"{login}" may log in twice from "{addr}"')
+def step_impl(context, login, addr):
+    context.addr = addr
+    assert _try_login(context.throttle, login, addr)
+    assert _try_login(context.throttle, login, addr)
+
+
+@then('the third login of "{login}" is refused')
+def step_impl(context, login):
+    assert not _try_login(context.throttle, login, context.addr)
+
+
+# --
+
+
+@given('a login throttle behind proxy "{proxy}"')
+def step_impl(context, proxy):
+    context.throttle = LoginThrottle(MemoryBucketStore(),
+        trusted_proxies=[proxy])
+
+
+@then('the client of "{remote_addr}" forwarded for "{forwarded_for}" is'
+      ' "{addr}"')
+def step_impl(context, remote_addr, forwarded_for, addr):
+    assert context.throttle.client_addr(remote_addr, forwarded_for) == addr
@@ -0,0 +1,74 @@
+from behave import (
+    when, then
+)
+import pyramid.testing
+from pyramid.traversal import VH_ROOT_KEY
+import pym.models
+from pym.res.traversal import ResourceNodeTraverser
+from pym.testing import StatementCounter
+
+
+def _traverse(context, path, matchdict=None, environ=None):
+    request = pyramid.testing.DummyRequest(path=path, environ=environ)
+    request.path_info = path
+    request.matchdict = matchdict
+    context.info = ResourceNodeTraverser(context.nodes[0])(request)
+
+
+@when('I traverse "{path}"')
+def step_impl(context, path):
+    _traverse(context, path)
+
+
+@when('I traverse the matchdict path "{path}"')
+def step_impl(context, path):
+    _traverse(context, '/', matchdict={'traverse': path})
+
+
+@when('I traverse "{path}" below the virtual root "{vroot}"')
+def step_impl(context, path, vroot):
+    _traverse(context, path, environ={VH_ROOT_KEY: vroot})
+
+
+@then('the context is "{name}" and the view name is "{view_name}"')
+def step_impl(context, name, view_name):
+    assert context.info['context'].name == name
+    assert context.info['view_name'] == view_name
+
+
+@then('the context is "{name}" and the view name is ""')
+def step_impl(context, name):
+    assert context.info['context'].name == name
+    assert context.info['view_name'] == ''
+
+
+@then('the traversed path is "{path}"')
+def step_impl(context, path):
+    assert list(context.info['traversed']) == path.split('/')
+
+
+@then('the traversed path is ""')
+def step_impl(context):
+    assert not context.info['traversed']
+
+
+@then('the virtual root is "{name}"')
+def step_impl(context, name):
+    assert context.info['virtual_root'].name == name
+
+
+@then('it took {n:d} query')
+def step_impl(context, n):
+    assert len(context.statements) == n, context.statements
+
+
+@then('walking up the lineage of "{name}" needs no query')
+def step_impl(context, name):
+    node = [n for n in context.lineage if n.name == name][0]
+    names = []
+    with StatementCounter(pym.models.DbEngine) as counter:
+        while node is not None:
+            names.append(node.name)
+            node = node.__parent__
+    assert counter.count == 0, counter.statements
+    assert names[-1] == context.nodes[0].name
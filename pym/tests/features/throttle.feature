@@ -0,0 +1,27 @@
+Feature: Login throttle
+  Test the token buckets that throttle login attempts
+
+
+  Scenario: a bucket allows a burst and then one attempt per interval
+      Given a bucket store with a bucket of 3 tokens per 60 seconds
+      When I take 3 tokens at once
+      Then the next token is refused for 60 seconds
+      And a token is granted after 60 seconds
+
+
+  Scenario: refused attempts take no token from the other bucket
+      Given a login throttle with 2 attempts per login and 3 per address
+      When "alice" tried to log in 3 times from "10.0.0.1"
+      Then "bob" may log in once more from "10.0.0.1"
+
+
+  Scenario: a failing store falls back to in-process buckets
+      Given a login throttle whose store fails
+      Then "alice" may log in twice from "10.0.0.1"
+      And the third login of "alice" is refused
+
+
+  Scenario: the forwarded address is only trusted from proxies
+      Given a login throttle behind proxy "10.0.0.254"
+      Then the client of "10.0.0.254" forwarded for "1.2.3.4, 10.0.0.254" is "1.2.3.4"
+      And the client of "10.0.0.9" forwarded for "1.2.3.4" is "10.0.0.9"
@@ -0,0 +1,45 @@
+Feature: Traversal
+  Test resolving URL paths to resource nodes
+
+
+  Scenario: a path is loaded in a single query
+      Given a resource tree "trav"/"unittest" with ACEs on each level
+      When I load the path "a/b"
+      Then I get the lineage "a/b"
+      And it took 1 query
+      And walking up the lineage of "b" needs no query
+
+
+  Scenario: a path is loaded as far as it is found
+      Given a resource tree "trav"/"unittest" with ACEs on each level
+      When I load the path "a/x/b"
+      Then I get the lineage "a"
+
+
+  Scenario Outline: the traverser resolves nodes and view names
+      Given a resource tree "trav"/"unittest" with ACEs on each level
+      When I traverse "<path>"
+      Then the context is "<context>" and the view name is "<view_name>"
+      And the traversed path is "<traversed>"
+
+    Examples:
+      | path          | context | view_name | traversed |
+      | /             | trav    |           |           |
+      | /a/b          | b       |           | a/b       |
+      | /a/b/edit     | b       | edit      | a/b       |
+      | /a/@@edit/b   | a       | edit      | a         |
+      | /a/x/b        | a       | x         | a         |
+
+
+  Scenario: the traverser leaves routes with a matchdict to Pyramid
+      Given a resource tree "trav"/"unittest" with ACEs on each level
+      When I traverse the matchdict path "a/b/edit"
+      Then the context is "b" and the view name is "edit"
+      And the traversed path is "a/b"
+
+
+  Scenario: the traverser leaves virtual roots to Pyramid
+      Given a resource tree "trav"/"unittest" with ACEs on each level
+      When I traverse "/b/edit" below the virtual root "/a"
+      Then the context is "b" and the view name is "edit"
+      And the virtual root is "a"
@@ -0,0 +1,231 @@
+"""
+Preloads the cache regions after a deploy.
+
+Initialising the app empties the regions, see :func:`pym.models.init`. Then
+the first requests all rebuild the same values at once. :func:`warm_up`
+loads the most used values beforehand:
+
+- the root node, its children and ACL via :meth:`ResourceNode.load_root`,
+- the lookups of the top levels of the resource tree, as done by
+  :meth:`ResourceNode.load_child` during traversal,
+- the permission tree of :meth:`pym.auth.models.Permission.load_all`,
+- the groups of users that logged in recently.
+
+Nodes and groups are loaded from the DB with one query per batch and written
+with one ``set_multi`` per batch. Keys that are already cached are skipped.
+
+Run it with ``pym -c production.ini warm-cache``, or in each gunicorn worker
+via :func:`post_worker_init`.
+"""
+import datetime
+import logging
+import time
+
+import transaction
+import sqlalchemy as sa
+# noinspection PyPackageRequirements
+from dogpile.cache.api import NO_VALUE
+
+from pym.cache import region_auth_long_term, CompactResult, tag_keys_multi
+import pym.models
+import pym.auth.models as pam
+from pym.res.models import ResourceNode, lookup_cache_tags
+
+
+mlgg = logging.getLogger(__name__)
+
+WARMUP_BATCH_SIZE = 500
+"""Default number of nodes or users loaded per batch."""
+
+
+def _batches(items, batch_size):
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+
+def _children_sort_key(node):
+    # Order of relationship ResourceNode.children, NULLs last like PostgreSQL
+    return node.sortix is None, node.sortix or 0, node.name
+
+
+def warm_resources(sess, root_name='root', max_depth=2,
+        batch_size=WARMUP_BATCH_SIZE, lgg=mlgg):
+    """
+    Preloads the root node and the nodes of the top levels of the tree.
+
+    For each node, the cached lookup by name and parent, its children and its
+    ACL are written, with the same keys and tags as
+    :meth:`~pym.res.models.ResourceNode.load_child` uses.
+
+    :param sess: A DB session
+    :param root_name: Name of the root node
+    :param max_depth: Number of levels below the root node to preload
+    :param batch_size: Number of nodes per batch
+    :param lgg: Logger for progress messages
+    :return: Number of nodes written to the cache
+    """
+    root = ResourceNode.load_root(sess, root_name)
+    # Lazy loads of cached relationships fill the cache
+    len(root.children)
+    len(root.acl)
+    if max_depth < 1:
+        return 0
+    # Load one level more, then the children of all warmed nodes are complete
+    nodes = root.load_subtree(sess, max_depth=max_depth + 1)
+    depths = {root.id: 0}
+    children = {}
+    warm = []
+    for n in nodes:
+        depth = depths[n.id] = depths[n.parent_id] + 1
+        children.setdefault(n.parent_id, []).append(n)
+        if depth <= max_depth:
+            warm.append(n)
+    lgg.info("Warming {} resource nodes".format(len(warm)))
+    region = region_auth_long_term
+    done = written = 0
+    for batch in _batches(warm, batch_size):
+        keys = {}
+        for n in batch:
+            k = 'resource:{}:{}'.format(n.name, n.parent_id)
+            keys[n] = (k, k + ':children', k + ':acl')
+        all_keys = [k for kk in keys.values() for k in kk]
+        cached = dict(zip(all_keys, region.get_multi(all_keys)))
+        missing = [n for n in batch
+            if any(cached[k] is NO_VALUE for k in keys[n])]
+        if missing:
+            acls = {n.id: [] for n in missing}
+            rs = sess.query(pam.Ace).filter(
+                pam.Ace.resource_id.in_(list(acls.keys()))
+            ).order_by(
+                pam.Ace.resource_id, pam.Ace.allow, pam.Ace.sortix
+            )
+            for ace in rs:
+                acls[ace.resource_id].append(ace)
+            mapping = {}
+            tags = []
+            for n in missing:
+                k, kc, ka = keys[n]
+                mapping[k] = CompactResult([n])
+                mapping[kc] = CompactResult(sorted(children.get(n.id, []),
+                    key=_children_sort_key))
+                mapping[ka] = CompactResult(acls[n.id])
+                tags.append(((k, kc, ka), lookup_cache_tags(n.name,
+                    n.parent_id)))
+                tags.append(((k,), ['node:{}'.format(n.id)]))
+            region.set_multi(mapping)
+            tag_keys_multi(region, tags)
+            written += len(missing)
+        done += len(batch)
+        lgg.info("Resource nodes: {}/{}, {} written".format(done, len(warm),
+            written))
+    return written
+
+
+def warm_permissions(sess, lgg=mlgg):
+    """
+    Preloads the permission tree.
+    """
+    perms = pam.Permission.load_all(sess)
+    lgg.info("Permissions: {}".format(len(perms) // 2))
+
+
+def warm_groups(sess, since_days=30, batch_size=WARMUP_BATCH_SIZE, lgg=mlgg):
+    """
+    Preloads the groups of users that logged in recently.
+
+    :param sess: A DB session
+    :param since_days: Preload users that logged in within this many days.
+    :param batch_size: Number of users per batch
+    :param lgg: Logger for progress messages
+    :return: Number of users whose groups were written to the cache
+    """
+    since = datetime.datetime.now() - datetime.timedelta(days=since_days)
+    user_ids = [r[0] for r in sess.query(pam.User.id).filter(
+        sa.and_(
+            pam.User.is_enabled == True,
+            pam.User.is_blocked == False,
+            pam.User.login_time >= since
+        )
+    ).order_by(pam.User.id)]
+    lgg.info("Warming groups of {} users".format(len(user_ids)))
+    region = region_auth_long_term
+    done = written = 0
+    for batch in _batches(user_ids, batch_size):
+        keys = {uid: pam.User.groups_cache_key(uid) for uid in batch}
+        missing = [uid for uid, v in zip(batch,
+                region.get_multi([keys[uid] for uid in batch]))
+            if v is NO_VALUE]
+        if missing:
+            groups = pam.User.load_groups_for_users(sess, missing)
+            region.set_multi({keys[uid]: groups[uid] for uid in missing})
+            tag_keys_multi(region, [([keys[uid]], ['user:{}'.format(uid)])
+                for uid in missing])
+            written += len(missing)
+        done += len(batch)
+        lgg.info("Users: {}/{}, {} written".format(done, len(user_ids),
+            written))
+    return written
+
+
+def warm_up(sess, root_name='root', max_depth=2, users_since_days=30,
+        batch_size=WARMUP_BATCH_SIZE, lgg=mlgg):
+    """
+    Preloads all, see module description.
+
+    :param sess: A DB session
+    :param root_name: Name of the root node
+    :param max_depth: Number of levels below the root node to preload
+    :param users_since_days: Preload groups of users that logged in within
+        this many days.
+    :param batch_size: Number of nodes or users per batch
+    :param lgg: Logger for progress messages
+    """
+    start_time = time.time()
+    warm_permissions(sess, lgg=lgg)
+    warm_resources(sess, root_name=root_name, max_depth=max_depth,
+        batch_size=batch_size, lgg=lgg)
+    warm_groups(sess, since_days=users_since_days, batch_size=batch_size,
+        lgg=lgg)
+    lgg.info("Cache warmed up in {:.2f} secs".format(time.time() - start_time))
+
+
+def post_worker_init(worker):
+    """
+    Gunicorn hook that warms up the cache in each new worker.
+
+    Gunicorn's ``post_fork`` runs before the worker loaded the app, so we use
+    this hook instead. Put into the gunicorn config file::
+
+        from pym.warmup import post_worker_init
+
+    Does nothing unless the rc setting ``cache.warmup.on_start`` is true.
+    Settings ``cache.warmup.max_depth`` and ``cache.warmup.users_since_days``
+    are passed to :func:`warm_up`. Only one worker at a time warms up, the
+    others skip it.
+    """
+    registry = getattr(worker.wsgi, 'registry', None)
+    if registry is None:
+        mlgg.warning("Cannot warm up cache: App has no registry")
+        return
+    rc = registry.settings['rc']
+    if not rc.g('cache.warmup.on_start', False):
+        return
+    # Expires, in case the worker dies while holding it
+    client = getattr(region_auth_long_term.backend, 'client', None)
+    mutex = client.lock('_lock:pym:cache:warmup', timeout=600) \
+        if client is not None else None
+    if mutex is not None and not mutex.acquire(blocking=False):
+        mlgg.info("Cache is warmed up by another worker")
+        return
+    transaction.begin()
+    # noinspection PyBroadException
+    try:
+        warm_up(pym.models.DbSession(),
+            max_depth=rc.g('cache.warmup.max_depth', 2),
+            users_since_days=rc.g('cache.warmup.users_since_days', 30))
+    except Exception:
+        mlgg.exception("Failed to warm up cache")
+    finally:
+        transaction.abort()
+        if mutex is not None:
+            mutex.release()